@@ -0,0 +1,228 @@
+import asyncio
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+import database
+import limits
+import passwords
+import sessions
+import tls
+import users
+from commands import command_tables
+from connections import presence
+from metrics import metrics, profiler
+from outbound import active_writers
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'uuu'
+
+COUNTER_HELP = {
+    'sessions_opened': 'Websocket sessions accepted.',
+    'sessions_closed': 'Websocket sessions ended.',
+    'logins': 'Successful logins.',
+    'login_failures': 'Failed logins by reason.',
+    'registrations': 'Accounts registered.',
+    'resumes': 'Sessions restored from a resume token.',
+    'connections_rejected': 'Connections refused before the login prompt, by reason.',
+    'sessions_timed_out': 'Sessions closed for not logging in (preauth) or not sending anything (idle) in time.',
+    'messages_limited': 'Messages dropped by the per-connection or per-IP rate limit.',
+    'ws_frames': 'Outgoing websocket messages by how they were compressed.',
+    'ws_payload_bytes': 'Outgoing websocket payload bytes before (raw) and after (sent) compression.',
+    'slow_consumers': 'Outbound messages dropped or sessions disconnected because the client read too slowly.',
+}
+
+HISTOGRAM_HELP = {
+    'db_acquire': 'Time waiting for a pooled database connection.',
+    'db_query': 'Time spent running a database query.',
+    'bcrypt': 'Time spent hashing or verifying one password.',
+    'event_loop_lag': 'How late the event loop woke up for a scheduled sleep.',
+    'send': 'Time from queueing an outbound message to writing its frame.',
+}
+
+
+def _labels(**labels):
+    pairs = ','.join(f'{key}="{value}"' for key, value in labels.items() if value is not None)
+    return f'{{{pairs}}}' if pairs else ''
+
+
+def _histogram_lines(name, histogram, **labels):
+    cumulative = 0
+    lines = []
+    for bound, count in zip(histogram.bounds, histogram.buckets):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.calls}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.total_time}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.calls}")
+    return lines
+
+
+def _gauge_lines(name, help_text, values):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{_labels(**labels)} {value}" for labels, value in values)
+    return lines
+
+
+def render_metrics():
+    # Prometheus text exposition format, built from the live counters on every scrape
+    lines = []
+
+    counters = {}
+    for (name, label), value in metrics.counters.items():
+        counters.setdefault(name, []).append((label, value))
+    for name, help_text in COUNTER_HELP.items():
+        metric = f"{PREFIX}_{name}_total"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        for label, value in counters.get(name, [(None, 0)]):
+            lines.append(f"{metric}{_labels(reason=label)} {value}")
+
+    context_counts = {}
+    for info in presence.local_sessions():
+        context_counts[info.context] = context_counts.get(info.context, 0) + 1
+    lines += _gauge_lines(f"{PREFIX}_sessions", 'Logged-in players on this worker by context.',
+                          [({'context': context}, count) for context, count in sorted(context_counts.items(),
+                                                                                    key=lambda item: str(item[0]))])
+
+    for name, help_text in HISTOGRAM_HELP.items():
+        metric = f"{PREFIX}_{name}_seconds"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        lines += _histogram_lines(metric, metrics.histogram(name))
+    lines += _gauge_lines(f"{PREFIX}_event_loop_lag_last_seconds", 'Lag measured by the most recent probe.',
+                          [({}, metrics.loop_lag)])
+    lines += _gauge_lines(f"{PREFIX}_event_loop_lag_max_seconds", 'Worst lag seen since startup.',
+                          [({}, metrics.loop_lag_max)])
+
+    metric = f"{PREFIX}_command_seconds"
+    lines += [f"# HELP {metric} Command handler latency.", f"# TYPE {metric} histogram"]
+    errors = []
+    for table in command_tables:
+        for name, stats in table.stats().items():
+            lines += _histogram_lines(metric, stats, context=table.name, command=name)
+            errors.append(({'context': table.name, 'command': name}, stats.errors))
+    metric = f"{PREFIX}_command_errors_total"
+    lines += [f"# HELP {metric} Command handlers that raised.", f"# TYPE {metric} counter"]
+    lines.extend(f"{metric}{_labels(**labels)} {value}" for labels, value in errors)
+
+    lines += _gauge_lines(f"{PREFIX}_outbound_queued", 'Messages waiting in session send queues.',
+                          [({}, sum(writer.stats()['queued'] for writer in active_writers))])
+
+    if database.db_pool is not None:
+        pool = database.db_pool.stats()
+        lines += _gauge_lines(f"{PREFIX}_db_pool_connections", 'Database pool connections by state.',
+                              [({'state': state}, pool[state]) for state in ('idle', 'in_use', 'waiting')])
+        lines += _gauge_lines(f"{PREFIX}_db_pool_timeouts", 'Acquires that timed out.', [({}, pool['timeouts'])])
+    if passwords.password_hasher is not None:
+        hasher = passwords.password_hasher.stats()
+        lines += _gauge_lines(f"{PREFIX}_bcrypt_pending", 'Password hashes running or queued.',
+                              [({}, hasher['pending'])])
+        lines += _gauge_lines(f"{PREFIX}_bcrypt_rejected", 'Password hashes refused because the queue was full.',
+                              [({}, hasher['rejected'])])
+        lines += _gauge_lines(f"{PREFIX}_bcrypt_failed", 'Password hashes that raised an error.',
+                              [({}, hasher['failed'])])
+    if limits.limiter is not None:
+        limiter = limits.limiter.stats()
+        lines += _gauge_lines(f"{PREFIX}_limiter_tracked", 'Addresses and accounts with rate-limit state.',
+                              [({'table': 'ips'}, limiter['tracked_ips']),
+                               ({'table': 'logins'}, limiter['tracked_logins'])])
+        lines += _gauge_lines(f"{PREFIX}_preauth_sessions", 'Sessions that have not logged in yet.',
+                              [({}, limiter['preauth_sessions'])])
+        lines += _gauge_lines(f"{PREFIX}_connections", 'Open connections, handshakes included.',
+                              [({}, limiter['connections'])])
+    if sessions.resume_tokens is not None:
+        resume = sessions.resume_tokens.stats()
+        lines += _gauge_lines(f"{PREFIX}_resume_sessions", 'Sessions that can be resumed with a token.',
+                              [({}, resume['sessions'])])
+        lines += _gauge_lines(f"{PREFIX}_resume_tokens", 'Resume tokens by outcome.',
+                              [({'outcome': outcome}, resume[outcome])
+                               for outcome in ('issued', 'resumed', 'rejected', 'evicted')])
+    if users.user_store is not None:
+        lines += _gauge_lines(f"{PREFIX}_lookup_cache_hit_rate", 'Username and email lookup cache hit rate.',
+                              [({'cache': cache}, stats['hit_rate'])
+                               for cache, stats in users.user_store.stats().items()])
+    handshakes = tls.tls_stats()
+    if handshakes is not None:
+        lines += _gauge_lines(f"{PREFIX}_tls_handshakes", 'TLS handshakes by kind.',
+                              [({'kind': kind}, handshakes[kind]) for kind in ('full', 'resumed', 'failed')])
+        lines += _gauge_lines(f"{PREFIX}_tls_resumption_rate", 'Share of TLS handshakes that resumed a session.',
+                              [({}, handshakes['resumption_rate'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def render_sessions():
+    # One line per session, deepest send queue first
+    columns = ('session', 'user', 'queued', 'max_depth', 'messages', 'frames', 'dropped', 'mean_send_ms',
+               'max_send_ms')
+    rows = sorted((writer.stats() for writer in active_writers), key=lambda stats: stats['queued'], reverse=True)
+    lines = ['\t'.join(columns)]
+    for stats in rows:
+        lines.append('\t'.join(f"{stats[column]:.3f}" if isinstance(stats[column], float) else str(stats[column])
+                               for column in columns))
+    return '\n'.join(lines) + '\n'
+
+
+async def profile_for(seconds):
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return profiler.report()
+
+
+async def handle_request(path, query):
+    # Returns (status, body)
+    if path == '/metrics':
+        return '200 OK', render_metrics()
+    if path == '/sessions':
+        return '200 OK', render_sessions()
+    if path == '/profile':
+        # Samples for a while and returns the hottest stacks in one request
+        seconds = min(float(query.get('seconds', ['5'])[0]), 60.0)
+        return '200 OK', await profile_for(seconds)
+    if path == '/profile/start':
+        profiler.start()
+        return '200 OK', "Profiler started.\n"
+    if path == '/profile/stop':
+        if not profiler.running:
+            return '409 Conflict', "Profiler is not running.\n"
+        profiler.stop()
+        return '200 OK', profiler.report()
+    return '404 Not Found', "Not found.\n"
+
+
+async def handle_connection(reader, writer):
+    try:
+        request_line = (await asyncio.wait_for(reader.readline(), 5.0)).decode('latin-1')
+        # Skip the headers; nothing here needs them
+        while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != 'GET':
+            status, body = '405 Method Not Allowed', "Only GET is supported.\n"
+        else:
+            url = urlsplit(parts[1])
+            try:
+                status, body = await handle_request(url.path, parse_qs(url.query))
+            except ValueError as e:
+                status, body = '400 Bad Request', f"{e}\n"
+        data = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_admin_server(host, port, sockets=None):
+    # Bound to localhost by default: the metrics and profiler are for operators, not players. With sockets (from a
+    # handover), serve those instead of binding the port, which the previous process still holds
+    if sockets:
+        servers = [await asyncio.start_server(handle_connection, sock=sock) for sock in sockets]
+    else:
+        servers = [await asyncio.start_server(handle_connection, host, port)]
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return servers
@@ -0,0 +1,107 @@
+# Compares outgoing compression policies (compression.py) on a typical session's messages.
+#
+# Each policy negotiates permessage-deflate the way a browser offer would, then encodes the same message mix for
+# many sessions: the MOTD and command-list screens, a full page of 'who', and short replies. It reports bytes on
+# the wire relative to the raw payload, CPU per message, and memory held per session by the compressor.
+#
+# Usage: python benchmarks/bench_compression.py [--sessions 200] [--rounds 20]
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from websockets.frames import Frame, Opcode  # noqa: E402
+
+import compression  # noqa: E402
+from connections import WHO_PAGE_SIZE  # noqa: E402
+from screens import render_command_list, render_file  # noqa: E402
+from settings import CompressionSettings  # noqa: E402
+
+# What a browser offers: permessage-deflate; client_max_window_bits
+CLIENT_OFFER = [('client_max_window_bits', None)]
+
+POLICIES = [
+    ('off', CompressionSettings(enabled=False)),
+    ('all', CompressionSettings(min_size=0)),
+    ('threshold', CompressionSettings()),
+    ('no-takeover', CompressionSettings(context_takeover=False)),
+    ('precompressed', CompressionSettings(context_takeover=False, precompress_screens=True)),
+]
+
+
+COMMANDS = {
+    'who': 'List connected users',
+    'help': 'Get help about commands',
+    'manage': 'Enter account management screen',
+    'messages': 'Enter your message screen',
+    'commands': 'List all available commands',
+    '/quit': 'type /quit to close exit the world',
+}
+
+
+def who_page(round_number):
+    # Idle times move on between rounds, as they do between two 'who' commands
+    return "\n".join(["Connected users (page 1/40, 2000 total):"] +
+                     [f"player{i:04}  [lobby]  idle {(i + round_number * 7) % 59}s"
+                      for i in range(WHO_PAGE_SIZE)]).encode()
+
+
+def session_messages(round_number):
+    # (payload, is a cached screen) in the order one round of a session sends them
+    motd = render_file(os.path.join(ROOT, 'motd.txt')).encode()
+    listing = render_command_list(COMMANDS).encode()
+    return [(motd, True), (b'Help Menu', False), (listing, True), (b'Account Management', False),
+            (who_page(round_number), False),
+            (b"Unrecognized Lobby command. Type 'help', 'commands', 'manage', or 'messages' for more information.",
+             False)]
+
+
+def run(settings, sessions, rounds):
+    compression.init_compression(settings)
+    rounds_of_frames = []
+    for round_number in range(rounds):
+        messages = session_messages(round_number)
+        for data, screen in messages:
+            if screen:
+                compression.precompress(data)
+        rounds_of_frames.append([Frame(Opcode.TEXT, data) for data, _ in messages])
+    factories = compression.create_extensions(settings)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    extensions = [factories[0].process_request_params(CLIENT_OFFER, [])[1] if factories else None
+                  for _ in range(sessions)]
+
+    raw = sent = 0
+    messages = 0
+    start = time.process_time()
+    for frames in rounds_of_frames:
+        for extension in extensions:
+            for frame in frames:
+                encoded = extension.encode(frame) if extension is not None else frame
+                raw += len(frame.data)
+                sent += len(encoded.data)
+                messages += 1
+    cpu = time.process_time() - start
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return sent / raw, cpu / messages, held / sessions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    for name, settings in POLICIES:
+        ratio, cpu, held = run(settings, args.sessions, args.rounds)
+        print(f"{name:14} wire/raw={ratio:6.1%} cpu={cpu * 1e6:6.2f}us/message memory={held / 1024:7.1f}KiB/session")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Measures context switches across many concurrent sessions: latency, memory and background tasks.
+#
+# "legacy" switches the way set_context used to. Each switch calls import_module, derives the class name from the
+# module name and builds a fresh context. Like the old constructors, the context gets an instance __dict__ and its
+# own copy of the command listing, and its greeting is fired off as an untracked task. The instance it replaces is
+# thrown away. "registry" is the current ContextManager. It looks the class up in the startup registry, reuses the
+# session's instances and awaits the greeting.
+#
+# A switch is timed together with one pass of the event loop, so the legacy greeting task runs inside the
+# measurement rather than after it. A second, untimed pass under tracemalloc reports the contexts built and thrown
+# away, the peak number of pending tasks, and peak and retained traced memory.
+#
+# Usage: python benchmarks/bench_context_switch.py [--sessions 5000] [--rounds 5] [--config config.ini.example]
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from importlib import import_module
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from context_manager import ContextManager, context_class_name, register_contexts  # noqa: E402
+from settings import get_settings, load_settings  # noqa: E402
+
+ROUTE = ['c_help', 'c_management', 'c_lobby', 'c_lobby']
+
+legacy_classes = {}
+contexts_built = 0
+
+
+class NullWebSocket:
+    async def send(self, message):
+        pass
+
+
+def legacy_class(context_class):
+    # The context as the old constructors built it
+    legacy = legacy_classes.get(context_class)
+    if legacy is None:
+        def __init__(self, *args):
+            global contexts_built
+            context_class.__init__(self, *args)
+            contexts_built += 1
+            self.available_commands = self.commands.listing()
+            asyncio.create_task(self.on_enter())
+
+        # No __slots__, so every instance carries a __dict__ again
+        legacy = legacy_classes[context_class] = type(f'Legacy{context_class.__name__}', (context_class,),
+                                                      {'__init__': __init__})
+    return legacy
+
+
+class LegacyContextManager(ContextManager):
+    async def set_context(self, context_name, additional_args=None):
+        context_module = import_module(f'contexts.{context_name}')
+        context_class = legacy_class(getattr(context_module, context_class_name(context_name)))
+        self.current_context = context_class(self.websocket, self.db_config, self.registration_enabled,
+                                             self.messages, self.switch_context, self.username, self.start_flow)
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def create_managers(manager_class, sessions):
+    settings = get_settings()
+    return [manager_class(NullWebSocket(), settings.database, settings.registration, settings.messages,
+                          username=f'player{i}') for i in range(sessions)]
+
+
+async def switch(manager, context_name):
+    await manager.set_context(context_name)
+    await asyncio.sleep(0)  # Lets a greeting left as a task run
+
+
+async def time_switches(manager_class, sessions, rounds):
+    managers = create_managers(manager_class, sessions)
+    samples = []
+    for _ in range(rounds):
+        for manager in managers:
+            for context_name in ROUTE:
+                start = time.perf_counter()
+                await switch(manager, context_name)
+                samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples
+
+
+async def measure_resources(manager_class, sessions, rounds):
+    global contexts_built
+    contexts_built = 0
+    gc.collect()
+    tracemalloc.start()
+    managers = create_managers(manager_class, sessions)
+    peak_tasks = 0
+    for _ in range(rounds):
+        for manager in managers:
+            for context_name in ROUTE:
+                await manager.set_context(context_name)
+                peak_tasks = max(peak_tasks, len(asyncio.all_tasks()) - 1)
+                await asyncio.sleep(0)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    live = {id(context) for manager in managers
+            for context in (*manager.contexts.values(), manager.current_context) if context is not None}
+    if manager_class is ContextManager:
+        contexts_built = len(live)
+    return {
+        'contexts': contexts_built,
+        'discarded': contexts_built - len(live),
+        'peak_tasks': peak_tasks,
+        'peak_kib': peak / 1024,
+        'retained_kib': retained / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config.ini.example'))
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    load_settings(os.path.abspath(args.config))
+    # Relative paths in the config (motd.txt) resolve against the repository root
+    os.chdir(ROOT)
+    register_contexts()
+
+    for name, manager_class in [('legacy', LegacyContextManager), ('registry', ContextManager)]:
+        samples = asyncio.run(time_switches(manager_class, args.sessions, args.rounds))
+        resources = asyncio.run(measure_resources(manager_class, args.sessions, args.rounds))
+        mean = sum(samples) / len(samples)
+        print(f"{name:8} switches={len(samples):8} mean={mean * 1e6:7.2f}us "
+              f"p50={percentile(samples, 0.50) * 1e6:7.2f}us p99={percentile(samples, 0.99) * 1e6:7.2f}us "
+              f"contexts={resources['contexts']:7} discarded={resources['discarded']:7} "
+              f"peak_tasks={resources['peak_tasks']:3} "
+              f"peak={resources['peak_kib']:9.0f}KiB retained={resources['retained_kib']:9.0f}KiB")
+
+
+if __name__ == '__main__':
+    main()
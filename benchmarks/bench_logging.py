@@ -0,0 +1,81 @@
+# Measures what a context-switch log line costs the event loop.
+#
+# "print" writes two lines per switch to stdout the way set_context used to; "queue" logs one structured
+# record through the queue-backed pipeline (logs.py), which formats and writes on a background thread;
+# "sampled" is the same pipeline with context switches sampled at the default rate.
+# stdout is sent to a pipe read by a deliberately slow consumer, as a terminal or log shipper would be.
+#
+# Usage: python benchmarks/bench_logging.py [--events 100000]
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from logs import setup_logging, stop_logging, logging_stats  # noqa: E402
+from settings import LoggingSettings  # noqa: E402
+
+SLOW_READER = "import sys, time\nfor line in sys.stdin:\n    time.sleep(0.00002)\n"
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_print(events, stream):
+    samples = []
+    for i in range(events):
+        start = time.perf_counter()
+        print(f"Loading context: c_lobby for player: player{i}", file=stream)
+        print(f"Context set to: c_lobby for player: player{i}", file=stream)
+        stream.flush()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_logging(events):
+    logger = logging.getLogger('context_manager')
+    samples = []
+    for i in range(events):
+        start = time.perf_counter()
+        logger.info("Context set to %s", 'c_lobby', extra={'session': i, 'user': f'player{i}', 'context': 'c_lobby',
+                                                            'event': 'context_switch', 'latency_ms': 0.05})
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    print(f"{name:8} mean={mean * 1e6:7.2f}us p99={percentile(samples, 0.99) * 1e6:8.2f}us "
+          f"max={samples[-1] * 1e3:7.2f}ms", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+
+    reader = subprocess.Popen([sys.executable, '-c', SLOW_READER], stdin=subprocess.PIPE, text=True)
+    report('print', run_print(args.events, reader.stdin))
+    reader.stdin.close()
+    reader.wait()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'server.log')
+        for name, rates in [('queue', {}), ('sampled', None)]:
+            settings = LoggingSettings(file=path) if rates is None else LoggingSettings(file=path, sample_rates=rates)
+            setup_logging(settings)
+            samples = run_logging(args.events)
+            dropped = logging_stats()['dropped']
+            stop_logging()
+            report(name, samples)
+            print(f"{'':8} dropped={dropped}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
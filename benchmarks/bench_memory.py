@@ -0,0 +1,168 @@
+# Measures what an idle session costs the server: traced memory and file descriptors per connection.
+#
+# The stand-in server (standin.py) runs in a child process with tracemalloc on. This process opens many sessions
+# and leaves them idle, first at the login prompt ("preauth") and then logged in and sitting in the lobby
+# ("lobby"). After each phase the server reports the growth over its empty baseline, divided by the number of
+# sessions. Each variant switches one per-session cost off, to show what it contributes.
+#
+# Usage: python benchmarks/bench_memory.py [--sessions 2000] [--top 0]
+import argparse
+import asyncio
+import configparser
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import websockets  # noqa: E402
+
+import server_auth  # noqa: E402
+import standin  # noqa: E402
+from loadgen import LOGIN_FAILURES, expect  # noqa: E402
+from logs import setup_logging  # noqa: E402
+from settings import load_settings  # noqa: E402
+
+PORT = 7496
+
+# Every variant leaves the sessions connected however long a phase takes, and admits all of them
+COMMON = {'Server': {'preauth_timeout': '0', 'idle_timeout': '0', 'flow_step_timeout': '3600'},
+          'Limits': {'max_connections': '0'}}
+
+VARIANTS = [
+    ('default', {}),
+    ('no pings', {'Server': {'ping_interval': '0'}}),
+    ('no takeover', {'Compression': {'context_takeover': 'False'}}),
+    ('no compression', {'Compression': {'enabled': 'False'}}),
+    ('no resume', {'Sessions': {'resume_enabled': 'False'}}),
+]
+
+
+def raise_fd_limit():
+    # Thousands of sockets need more than the usual 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:  # Not Linux
+        return 0
+
+
+def write_config(directory, overrides):
+    path = standin.write_config(directory, PORT, rounds=4)
+    config = configparser.ConfigParser()
+    config.read(path)
+    for sections in (COMMON, overrides):
+        for name, options in sections.items():
+            if not config.has_section(name):
+                config.add_section(name)
+            config[name].update(options)
+    with open(path, 'w') as file:
+        config.write(file)
+    return path
+
+
+def serve(directory, overrides, sessions, top, control):
+    # Runs in its own process, so every variant starts from fresh module state
+    raise_fd_limit()
+    config_path = write_config(directory, overrides)
+    standin.create_database(os.path.join(directory, 'standin.db'), sessions, rounds=4)
+    os.chdir(ROOT)
+
+    async def main():
+        settings = load_settings(config_path)
+        setup_logging(settings.logging)
+        await server_auth.init_services(settings)
+        async with server_auth.serve(server_auth.server_handler, settings.server.host, settings.server.port,
+                                     **server_auth.serve_options(settings)):
+            gc.collect()
+            tracemalloc.start(10 if top else 1)
+            baseline = tracemalloc.take_snapshot() if top else None
+            traced, fds = tracemalloc.get_traced_memory()[0], open_fds()
+            control.send('ready')
+            while (phase := await asyncio.to_thread(control.recv)) is not None:
+                # Let replies finish writing and anything transient be freed
+                await asyncio.sleep(1.0)
+                gc.collect()
+                growth = tracemalloc.get_traced_memory()[0] - traced
+                sites = []
+                if top:
+                    stats = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')
+                    sites = [(str(stat.traceback[0]), stat.size_diff) for stat in stats[:top]]
+                control.send((phase, growth / sessions, (open_fds() - fds) / sessions, sites))
+        tracemalloc.stop()
+
+    asyncio.run(main())
+
+
+async def drive(sessions, control):
+    # Opens the sessions, then logs them in, asking the server to measure after each phase
+    url = f'ws://127.0.0.1:{PORT}'
+    timeout = 60.0
+    slots = asyncio.Semaphore(200)
+    # Logins share the stand-in's small database pool; more at once only time out waiting for it
+    logins = asyncio.Semaphore(20)
+
+    async def connect():
+        async with slots:
+            websocket = await websockets.connect(url)
+            await expect(websocket, lambda reply: reply.startswith("Type 'login'"), timeout)
+            return websocket
+
+    async def login(index, websocket):
+        async with logins:
+            await websocket.send('login')
+            await expect(websocket, lambda reply: reply == 'Enter username:', timeout)
+            await websocket.send(standin.username(index))
+            await expect(websocket, lambda reply: reply == 'Enter password:', timeout)
+            await websocket.send(standin.PASSWORD)
+            await expect(websocket, lambda reply: not reply.startswith(LOGIN_FAILURES), timeout)
+
+    results = []
+    websockets_open = await asyncio.gather(*(connect() for _ in range(sessions)))
+    control.send('preauth')
+    results.append(await asyncio.to_thread(control.recv))
+    await asyncio.gather(*(login(index, websocket) for index, websocket in enumerate(websockets_open)))
+    control.send('lobby')
+    results.append(await asyncio.to_thread(control.recv))
+    control.send(None)
+    await asyncio.gather(*(websocket.close() for websocket in websockets_open))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--top', type=int, default=0, help='also list the largest allocation sites per phase')
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    for name, overrides in VARIANTS:
+        with tempfile.TemporaryDirectory() as directory:
+            control, child_control = multiprocessing.Pipe()
+            server = multiprocessing.Process(target=serve, args=(directory, overrides, args.sessions, args.top,
+                                                                 child_control), daemon=True)
+            server.start()
+            control.recv()
+            try:
+                results = asyncio.run(drive(args.sessions, control))
+            finally:
+                server.join(30)
+                if server.is_alive():
+                    server.terminate()
+            for phase, per_session, fds, sites in results:
+                print(f"{name:15} {phase:8} {per_session / 1024:7.2f}KiB/session {fds:5.2f} fds/session")
+                for site, size in sites:
+                    print(f"    {size / args.sessions:9.0f} B/session  {site}")
+
+
+if __name__ == '__main__':
+    main()
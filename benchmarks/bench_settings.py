@@ -0,0 +1,70 @@
+# Compares the per-connection cost of reading config.ini before and after the shared settings object.
+#
+# Before: server_handler parsed config.ini once per connection and the lobby parsed it twice more
+# (display_motd and load_motd). After: every reader gets the already-parsed Settings snapshot.
+#
+# Usage: python benchmarks/bench_settings.py [--config config.ini.example] [--connections 10000]
+import argparse
+import configparser
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import settings  # noqa: E402
+
+
+def legacy_connection(path):
+    # server_handler -> load_config()
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    config.getboolean('Settings', 'Registration')
+    config.getboolean('Settings', 'MOTD')
+    config['Database'], config['SSL'], config['Server'], config['Messages']
+
+    # CLobby.display_motd
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    config.getboolean('Settings', 'MOTD')
+
+    # CLobby.load_motd
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    return config['Messages']['motd_file']
+
+
+def shared_connection():
+    current = settings.get_settings()
+    current.registration, current.database, current.messages
+    settings.get_settings().motd_enabled
+    return settings.get_settings().messages['motd_file']
+
+
+def measure(func, connections):
+    start = time.perf_counter()
+    for _ in range(connections):
+        func()
+    return (time.perf_counter() - start) / connections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config.ini.example'))
+    parser.add_argument('--connections', type=int, default=10000)
+    args = parser.parse_args()
+
+    settings.load_settings(args.config)
+
+    before = measure(lambda: legacy_connection(args.config), args.connections)
+    after = measure(shared_connection, args.connections)
+
+    print(f"connections simulated: {args.connections}")
+    print(f"before (3 config.ini parses): {before * 1e6:9.2f} us/connection")
+    print(f"after (shared settings):      {after * 1e6:9.2f} us/connection")
+    print(f"speedup: {before / after:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
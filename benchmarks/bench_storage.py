@@ -0,0 +1,127 @@
+# Compares login throughput on the storage backends (database.py).
+#
+# Each backend is seeded with --users accounts through the server's own pool, then --concurrency coroutines log in
+# over and over. One login is the storage work the server does for it: the password hash lookup, the bcrypt check
+# (at --bcrypt-rounds; 0 leaves it out, to compare the storage alone) and the unread message count. It reports
+# logins per second and p50/p99 login latency.
+# sqlite always runs, on a scratch file. MariaDB/MySQL runs when --mysql-database is given; the benchmark's users
+# are deleted from it afterwards.
+#
+# Usage: python benchmarks/bench_storage.py [--logins 5000] [--concurrency 50] [--bcrypt-rounds 4]
+#            [--mysql-host localhost --mysql-user uuu --mysql-password secret --mysql-database uuu]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database  # noqa: E402
+from mailboxes import init_message_store, unread_counters  # noqa: E402
+from passwords import close_password_hasher, get_password_hasher, init_password_hasher  # noqa: E402
+from settings import DatabaseSettings  # noqa: E402
+from users import init_user_store  # noqa: E402
+
+PASSWORD = 'benchmark'
+USERNAME_PREFIX = 'storagebench'
+
+
+def username(index):
+    return f'{USERNAME_PREFIX}{index:06d}'
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def seed(pool, store, users):
+    # Inserted with the store's own SQL for the backend, in one transaction
+    hashed = await get_password_hasher().hash(PASSWORD)
+    async with pool.acquire() as connection:
+        await clear(connection, store)
+        for index in range(users):
+            await connection.execute(store.queries['insert_user_query'],
+                                     (f'{username(index)}@example.com', username(index), hashed), prepared=True)
+        await connection.commit()
+
+
+async def clear(connection, store):
+    await connection.execute(f"DELETE FROM users WHERE username LIKE {store.placeholder}", (f'{USERNAME_PREFIX}%',))
+
+
+async def clean_up(pool, store):
+    async with pool.acquire() as connection:
+        await clear(connection, store)
+        await connection.commit()
+
+
+async def run(db_config, args):
+    # (logins per second, sorted latencies, pool size) for one backend
+    pool = await database.init_db_pool(db_config, max_size=args.pool_size)
+    store = init_user_store(cache_ttl=0, negative_cache_ttl=0)
+    init_message_store()
+    hasher = get_password_hasher()
+    try:
+        await seed(pool, store, args.users)
+        latencies = []
+        next_login = iter(range(args.logins))
+
+        async def log_in_repeatedly():
+            for index in next_login:
+                name = username(index % args.users)
+                start = time.perf_counter()
+                hashed = await store.get_password_hash(name)
+                if hashed is None or (args.bcrypt_rounds and not await hasher.verify(PASSWORD, hashed)):
+                    raise RuntimeError(f"login failed for {name}")
+                await unread_counters.get(name)
+                latencies.append(time.perf_counter() - start)
+                # The next login of this user counts again, as after a logout
+                unread_counters.forget(name)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(log_in_repeatedly() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        if db_config.backend == 'mysql':
+            await clean_up(pool, store)
+        return len(latencies) / elapsed, sorted(latencies), pool.max_size
+    finally:
+        await database.close_db_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--bcrypt-rounds', type=int, default=4)
+    parser.add_argument('--pool-size', type=int, default=10, help='connections for the mysql backend')
+    parser.add_argument('--mysql-host', default='localhost')
+    parser.add_argument('--mysql-user', default='')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--mysql-database', help='run the mysql backend against this database too')
+    args = parser.parse_args()
+    # The seeded hash still needs a valid cost even when the check is left out
+    init_password_hasher(workers=os.cpu_count() or 2, max_queue=args.concurrency,
+                         rounds=max(args.bcrypt_rounds, 4))
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [('sqlite', DatabaseSettings(host='', user='', password='', backend='sqlite',
+                                                database=os.path.join(directory, 'bench.db')))]
+        if args.mysql_database:
+            backends.append(('mysql', DatabaseSettings(host=args.mysql_host, user=args.mysql_user,
+                                                       password=args.mysql_password, database=args.mysql_database)))
+        for name, db_config in backends:
+            try:
+                rate, latencies, pool_size = asyncio.run(run(db_config, args))
+            except database.DatabaseError as e:
+                print(f"{name:7} skipped: {e}")
+                continue
+            print(f"{name:7} connections={pool_size:<3} logins/s={rate:8.0f} "
+                  f"p50={percentile(latencies, 0.50) * 1e3:6.2f}ms p99={percentile(latencies, 0.99) * 1e3:6.2f}ms")
+    close_password_hasher()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# Measures how the server scales with --workers.
+#
+# For each worker count it starts server_auth.py on a scratch config (self-signed certificate, no DB
+# connections opened up front) and reports:
+#   - connections/s: TLS + websocket handshakes that reach the login prompt, driven by several client processes
+#   - bus messages/s: cross-worker direct-message events relayed through the hub (the path a message to a
+#     player on another worker takes)
+#
+# Usage: python benchmarks/bench_workers.py [--workers 1 2 4 8] [--duration 5] [--clients 4]
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import websockets  # noqa: E402
+
+from bus import Bus, start_hub  # noqa: E402
+
+CONFIG_TEMPLATE = """[Settings]
+Registration = True
+MOTD = True
+
+[Messages]
+motd_file = {root}/motd.txt
+
+[Database]
+host = localhost
+user =
+password =
+database =
+pool_min_size = 0
+
+[SSL]
+certfile = {certfile}
+keyfile = {keyfile}
+
+[Server]
+host = 127.0.0.1
+port = {port}
+bus_socket = {bus_socket}
+
+[Limits]
+# Every benchmark session comes from 127.0.0.1, so the per-address limits must not apply
+ip_message_rate = 1000000000
+ip_message_burst = 1000000000
+max_preauth_per_ip = 1000000000
+"""
+
+
+def make_config(directory, port):
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    if not os.path.exists(certfile):
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile,
+                        '-out', certfile, '-days', '1', '-subj', '/CN=localhost'], check=True, capture_output=True)
+    path = os.path.join(directory, 'config.ini')
+    with open(path, 'w') as file:
+        file.write(CONFIG_TEMPLATE.format(root=os.path.abspath(ROOT), certfile=certfile, keyfile=keyfile, port=port,
+                                          bus_socket=os.path.join(directory, 'bus.sock')))
+    return path
+
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+async def connect_loop(port, duration, concurrency):
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    deadline = time.monotonic() + duration
+    counts = {'ok': 0, 'errors': 0}
+
+    async def worker():
+        while time.monotonic() < deadline:
+            try:
+                async with websockets.connect(f'wss://127.0.0.1:{port}', ssl=ssl_context, compression=None) as ws:
+                    await ws.recv()  # The login prompt
+                counts['ok'] += 1
+            except Exception:
+                counts['errors'] += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts
+
+
+def client_process(port, duration, concurrency, results):
+    results.put(asyncio.run(connect_loop(port, duration, concurrency)))
+
+
+def measure_connections(config, port, workers, duration, clients, concurrency):
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server_auth.py'), '--config', config,
+                               '--workers', str(workers)], cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)  # Give every worker time to bind
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client_process, args=(port, duration, concurrency, results))
+                     for _ in range(clients)]
+        for process in processes:
+            process.start()
+        totals = {'ok': 0, 'errors': 0}
+        for _ in processes:
+            counts = results.get()
+            totals['ok'] += counts['ok']
+            totals['errors'] += counts['errors']
+        for process in processes:
+            process.join()
+        return totals['ok'] / duration, totals['errors']
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def measure_bus(path, workers, messages):
+    hub = await start_hub(path)
+    buses = [Bus(worker_id) for worker_id in range(max(workers, 2))]
+    received = asyncio.Event()
+    delivered = [0]
+
+    async def on_deliver(_event):
+        delivered[0] += 1
+        if delivered[0] == messages:
+            received.set()
+
+    for bus in buses:
+        await bus.connect(path)
+    # Each event reaches every other worker; only the recipient's worker delivers it
+    buses[-1].on('deliver', on_deliver)
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    senders = buses[:-1]
+    for index in range(messages):
+        senders[index % len(senders)].publish('deliver', user='player', message='hello')
+        if index % 1000 == 0:
+            await asyncio.sleep(0)
+    await received.wait()
+    elapsed = time.perf_counter() - start
+
+    for bus in buses:
+        await bus.close()
+    await asyncio.sleep(0.1)  # Let the hub see every worker disconnect
+    hub.close()
+    await hub.wait_closed()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--clients', type=int, default=4, help='client processes generating connections')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent connections per client process')
+    parser.add_argument('--messages', type=int, default=100000, help='bus events per worker count')
+    parser.add_argument('--port', type=int, default=7460)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = make_config(directory, args.port)
+        print(f"{'workers':>7} {'conn/s':>10} {'errors':>7} {'bus msg/s':>12}")
+        for workers in args.workers:
+            rate, errors = measure_connections(config, args.port, workers, args.duration, args.clients,
+                                               args.concurrency)
+            bus_rate = asyncio.run(measure_bus(os.path.join(directory, 'bench-bus.sock'), workers, args.messages))
+            print(f"{workers:>7} {rate:>10.0f} {errors:>7} {bus_rate:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
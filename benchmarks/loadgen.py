@@ -0,0 +1,243 @@
+# Load generator driving the real websocket protocol.
+#
+# Opens many concurrent sessions and scripts login -> lobby -> who -> help -> lobby -> manage -> lobby ->
+# refresh, timing each command from send to its reply. Reports p50/p95/p99 per command, connection setup
+# time and error rates, and writes the results as JSON so runs can be compared between versions.
+#
+# Against a running server (users named bench000000... with a shared password):
+#   python benchmarks/loadgen.py --url wss://localhost:7450 --insecure --password secret
+# Against a throwaway in-process server on the SQLite stand-in:
+#   python benchmarks/loadgen.py --standin --sessions 2000 --output results.json
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import ssl
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import websockets  # noqa: E402
+
+import standin  # noqa: E402
+from sessions import RESUME_TOKEN_PREFIX  # noqa: E402
+
+# (command, reply check) pairs run by every session after logging in; None accepts any reply
+SCRIPT = [
+    ('who', lambda reply: reply.startswith('Connected users')),
+    ('help', lambda reply: reply == 'Help Menu'),
+    ('lobby', None),
+    ('manage', lambda reply: reply == 'Account Management'),
+    ('lobby', None),
+    ('refresh', None),
+]
+
+LOGIN_FAILURES = ('Incorrect username or password.', 'An error occurred', 'The server is busy')
+
+
+class SessionError(Exception):
+    pass
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}  # step -> [seconds]
+        self.errors = {}  # step -> count
+
+    def record(self, step, seconds):
+        self.latencies.setdefault(step, []).append(seconds)
+
+    def error(self, step):
+        self.errors[step] = self.errors.get(step, 0) + 1
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarise(samples, errors):
+    samples = sorted(samples)
+    summary = {'count': len(samples), 'errors': errors,
+               'error_rate': errors / (len(samples) + errors) if samples or errors else 0.0}
+    if samples:
+        summary.update({
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'max_ms': samples[-1] * 1000,
+        })
+    return summary
+
+
+async def expect(websocket, check, timeout):
+    reply = await asyncio.wait_for(websocket.recv(), timeout)
+    while reply.startswith(RESUME_TOKEN_PREFIX):
+        # Sent after login whenever resumption is on; not the reply to anything. It may share a frame with the
+        # reply that follows it
+        _, _, reply = reply.partition('\n')
+        if not reply:
+            reply = await asyncio.wait_for(websocket.recv(), timeout)
+    if check is not None and not check(reply):
+        raise SessionError(f"unexpected reply: {reply[:80]!r}")
+    return reply
+
+
+async def timed(results, step, websocket, message, check, timeout):
+    start = time.perf_counter()
+    try:
+        await websocket.send(message)
+        reply = await expect(websocket, check, timeout)
+    except Exception:
+        results.error(step)
+        raise
+    results.record(step, time.perf_counter() - start)
+    return reply
+
+
+async def run_session(index, args, ssl_context, results):
+    start = time.perf_counter()
+    try:
+        websocket = await asyncio.wait_for(websockets.connect(args.url, ssl=ssl_context, max_queue=None),
+                                           args.timeout)
+        await expect(websocket, lambda reply: reply.startswith("Type 'login'"), args.timeout)
+    except Exception:
+        results.error('connect')
+        return
+    results.record('connect', time.perf_counter() - start)
+
+    try:
+        await timed(results, 'login', websocket, 'login', lambda reply: reply == 'Enter username:', args.timeout)
+        await timed(results, 'username', websocket, standin.username(index % args.users),
+                    lambda reply: reply == 'Enter password:', args.timeout)
+        await timed(results, 'password', websocket, args.password,
+                    lambda reply: not reply.startswith(LOGIN_FAILURES), args.timeout)
+
+        for _ in range(args.iterations):
+            for command, check in SCRIPT:
+                await timed(results, command, websocket, command, check, args.timeout)
+                if args.think_time:
+                    await asyncio.sleep(args.think_time)
+    except Exception:
+        pass
+    finally:
+        await websocket.close()
+
+
+async def run_load(args):
+    ssl_context = None
+    if args.url.startswith('wss://'):
+        ssl_context = ssl.create_default_context()
+        if args.insecure:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+
+    results = Results()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await run_session(index, args, ssl_context, results)
+
+    start = time.perf_counter()
+    tasks = []
+    for index in range(args.sessions):
+        tasks.append(asyncio.create_task(limited(index)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / args.sessions)
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"stand-in server did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=None, help='server to drive (default: the stand-in)')
+    parser.add_argument('--standin', action='store_true', help='start an in-process server on an SQLite stand-in')
+    parser.add_argument('--port', type=int, default=7470, help='stand-in port')
+    parser.add_argument('--bcrypt-rounds', type=int, default=12, help='stand-in password cost factor')
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=1000, help='sessions open at the same time')
+    parser.add_argument('--users', type=int, default=None, help='distinct accounts (default: --sessions)')
+    parser.add_argument('--password', default=standin.PASSWORD)
+    parser.add_argument('--iterations', type=int, default=3, help='passes over the command script per session')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds between commands')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which to open the sessions')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--insecure', action='store_true', help='skip TLS certificate verification')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+    args.users = args.users or args.sessions
+
+    # Thousands of sockets need more than the usual 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = None
+    if args.standin or args.url is None:
+        args.url = f'ws://127.0.0.1:{args.port}'
+        server = multiprocessing.Process(target=standin.run, args=(args.port, args.users, args.bcrypt_rounds),
+                                         daemon=True)
+        server.start()
+        wait_for_port(args.port)
+
+    try:
+        results, elapsed = asyncio.run(run_load(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    steps = list(dict.fromkeys(['connect', 'login', 'username', 'password', *(c for c, _ in SCRIPT)]))
+    report = {
+        'version': git_version(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'url': args.url,
+        'sessions': args.sessions,
+        'concurrency': args.concurrency,
+        'iterations': args.iterations,
+        'elapsed_s': elapsed,
+        'steps': {step: summarise(results.latencies.get(step, []), results.errors.get(step, 0)) for step in steps},
+    }
+    total = sum(summary['count'] for summary in report['steps'].values())
+    report['throughput_per_s'] = total / elapsed if elapsed else 0.0
+
+    print(f"{args.sessions} sessions in {elapsed:.1f}s, {report['throughput_per_s']:.0f} replies/s")
+    print(f"{'step':10} {'count':>7} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for step, summary in report['steps'].items():
+        print(f"{step:10} {summary['count']:>7} {summary['errors']:>6} {summary.get('p50_ms', 0):>8.2f} "
+              f"{summary.get('p95_ms', 0):>8.2f} {summary.get('p99_ms', 0):>8.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# An in-process server on the sqlite backend, for benchmarks that need the real login flow without a MariaDB
+# server.
+#
+# Usage: python benchmarks/standin.py [--port 7470] [--users 1000] [--bcrypt-rounds 12]
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+import bcrypt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import server_auth  # noqa: E402
+from database import SQLITE_SCHEMA  # noqa: E402
+from logs import setup_logging  # noqa: E402
+from settings import load_settings  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+CONFIG_TEMPLATE = """[Settings]
+Registration = True
+MOTD = True
+
+[Messages]
+motd_file = {root}/motd.txt
+
+[Database]
+backend = sqlite
+database = {database}
+
+[Passwords]
+bcrypt_rounds = {rounds}
+
+[SSL]
+certfile =
+keyfile =
+
+[Server]
+host = 127.0.0.1
+port = {port}
+
+[Limits]
+# Every benchmark session comes from 127.0.0.1, so the per-address limits must not apply
+ip_message_rate = 1000000000
+ip_message_burst = 1000000000
+max_preauth_per_ip = 1000000000
+
+[Logging]
+file = {log_file}
+"""
+
+
+def username(index):
+    return f'bench{index:06d}'
+
+
+def create_database(path, users, rounds):
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLITE_SCHEMA)
+    # Every benchmark user shares one password, so one hash (at the configured cost) is enough
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=rounds)).decode()
+    connection.executemany('INSERT OR IGNORE INTO users (email, username, password) VALUES (?, ?, ?)',
+                           [(f'{username(i)}@example.com', username(i), hashed) for i in range(users)])
+    connection.commit()
+    connection.close()
+
+
+def write_config(directory, port, rounds):
+    path = os.path.join(directory, 'config.ini')
+    with open(path, 'w') as file:
+        file.write(CONFIG_TEMPLATE.format(root=os.path.abspath(ROOT), port=port, rounds=rounds,
+                                          database=os.path.join(directory, 'standin.db'),
+                                          log_file=os.path.join(directory, 'server.log')))
+    return path
+
+
+async def serve(config_path, ready=None):
+    settings = load_settings(config_path)
+    setup_logging(settings.logging)
+    await server_auth.init_services(settings)
+    async with server_auth.serve(server_auth.server_handler, settings.server.host, settings.server.port,
+                                 **server_auth.serve_options(settings)):
+        if ready is not None:
+            ready.set()
+        await asyncio.Future()
+
+
+def run(port, users, rounds, directory=None):
+    directory = directory or tempfile.mkdtemp(prefix='uuu-standin-')
+    config_path = write_config(directory, port, rounds)
+    create_database(os.path.join(directory, 'standin.db'), users, rounds)
+    # Relative paths in the server (motd.txt) resolve against the repository root
+    os.chdir(ROOT)
+    try:
+        asyncio.run(serve(config_path))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=7470)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    args = parser.parse_args()
+    print(f"Serving ws://127.0.0.1:{args.port} with {args.users} users (password '{PASSWORD}')")
+    run(args.port, args.users, args.bcrypt_rounds)
+
+
+if __name__ == '__main__':
+    main()
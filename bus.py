@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# An event line may carry a message several frames long, and JSON escaping can take up to 6 bytes per character
+LINE_LIMIT_FRAMES = 64
+
+
+def line_limit(max_frame_bytes):
+    # The StreamReader limit for bus connections; its default of 64KiB is smaller than one large broadcast
+    return max(2 ** 16, max_frame_bytes * LINE_LIMIT_FRAMES)
+
+
+async def read_lines(reader, limit, source):
+    # Yields each line until EOF. A line longer than the reader's limit is logged and skipped whole, instead of
+    # raising out of readline() and ending the connection
+    skipping = False
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.LimitOverrunError as e:
+            # Discard what is buffered so far; the rest of the line goes with the next read
+            await reader.readexactly(e.consumed)
+            if not skipping:
+                logger.warning("Skipping bus event longer than %s bytes from %s", limit, source)
+            skipping = True
+            continue
+        if skipping:
+            skipping = False
+            continue
+        yield line
+
+
+class Bus:
+    # A worker's connection to the hub; events are JSON lines relayed by the hub to every other worker
+    def __init__(self, worker_id, limit=2 ** 16):
+        self.worker_id = worker_id
+        self.limit = limit
+        self.handlers = {}
+        self.published = 0
+        self.received = 0
+        self._writer = None
+        self._reader_task = None
+
+    async def connect(self, path):
+        reader, self._writer = await asyncio.open_unix_connection(path, limit=self.limit)
+        self._reader_task = asyncio.create_task(self._read(reader))
+
+    def on(self, event_type, handler):
+        # Handlers are coroutines called with the decoded event
+        self.handlers[event_type] = handler
+
+    def publish(self, event_type, **fields):
+        if self._writer is None or self._writer.is_closing():
+            return
+        fields['type'] = event_type
+        fields['worker'] = self.worker_id
+        data = json.dumps(fields).encode() + b'\n'
+        if len(data) > self.limit:
+            # The hub and the other workers would only skip it
+            logger.warning("Dropping bus event %s of %s bytes", event_type, len(data), extra={'worker': self.worker_id})
+            return
+        self._writer.write(data)
+        self.published += 1
+
+    async def _read(self, reader):
+        async for line in read_lines(reader, self.limit, 'the hub'):
+            try:
+                event = json.loads(line)
+            except ValueError as e:
+                logger.warning("Skipping malformed bus event: %s", e, extra={'worker': self.worker_id})
+                continue
+            self.received += 1
+            handler = self.handlers.get(event['type'])
+            if handler is not None:
+                try:
+                    await handler(event)
+                except Exception as e:
+                    logger.error("Error handling bus event %s: %s", event['type'], e, extra={'worker': self.worker_id})
+        logger.warning("Worker %s lost its connection to the bus", self.worker_id)
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def start_hub(path, limit=2 ** 16):
+    # Runs in the master process and relays every event to every other worker
+    writers = set()
+
+    async def handle_worker(reader, writer):
+        writers.add(writer)
+        worker_id = None
+        try:
+            async for line in read_lines(reader, limit, 'a worker'):
+                if worker_id is None:
+                    worker_id = json.loads(line).get('worker')
+                for other in writers:
+                    if other is not writer:
+                        other.write(line)
+        finally:
+            writers.discard(writer)
+            writer.close()
+            if worker_id is not None:
+                # Let the others forget every player that was on the lost worker
+                event = json.dumps({'type': 'worker_down', 'worker': worker_id}).encode() + b'\n'
+                for other in writers:
+                    other.write(event)
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle_worker, path, limit=limit)
+
+
+def attach_presence(bus, presence):
+    # Mirror presence across workers and deliver direct messages and broadcasts for remote senders
+    async def on_join(event):
+        presence.add_remote(event['user'], event['worker'], event.get('context'), event.get('login_time'))
+
+    async def on_leave(event):
+        presence.remove_remote(event['user'], event['worker'])
+
+    async def on_context(event):
+        presence.set_remote_context(event['user'], event['worker'], event['context'])
+
+    async def on_active(event):
+        presence.touch_remote(event['user'], event['worker'])
+
+    async def on_deliver(event):
+        websocket = presence.sockets.get(event['user'])
+        if websocket is not None:
+            websocket.send_nowait(event['message'])
+
+    async def on_broadcast(event):
+        presence.broadcast(event['message'], event.get('users'), local_only=True)
+
+    async def on_sync(_event):
+        # A worker just joined the bus and wants to know who is already here
+        for info in presence.local_sessions():
+            bus.publish('join', user=info.username, context=info.context, login_time=info.login_time)
+
+    async def on_worker_down(event):
+        presence.drop_worker(event['worker'])
+
+    bus.on('join', on_join)
+    bus.on('leave', on_leave)
+    bus.on('context', on_context)
+    bus.on('active', on_active)
+    bus.on('deliver', on_deliver)
+    bus.on('broadcast', on_broadcast)
+    bus.on('sync', on_sync)
+    bus.on('worker_down', on_worker_down)
+    presence.bus = bus
+    bus.publish('sync')
+
+
+def attach_resume_tokens(bus, tokens):
+    # Keep every worker's token table in step, since a reconnect may land on any of them. Tokens are signed with
+    # a secret the workers share, so only the table entries travel over the bus
+    async def on_issue(event):
+        tokens._store(event['id'], event['user'], event.get('context'))
+
+    async def on_release(event):
+        tokens._release(event['user'], event['context'], event['expires'])
+
+    async def on_revoke(event):
+        tokens._remove_user(event['user'])
+
+    bus.on('resume_issue', on_issue)
+    bus.on('resume_release', on_release)
+    bus.on('resume_revoke', on_revoke)
+    tokens.bus = bus
@@ -1,85 +1,310 @@
+import argparse
 import asyncio
-import websockets
-import ssl
-import datetime
 import configparser
+import datetime
+import os
+import ssl
+import sys
 import threading
-import queue
+import time
+
+import websockets
+
+# Sent by the server after every login. Never displayed; kept so a dropped connection can pick up where it left off
+RESUME_TOKEN_PREFIX = 'Resume token: '
+PROMPT = '> '
+
 
-def load_config():
+def load_config(path='client_config.ini'):
+    # Read once at startup
     config = configparser.ConfigParser()
-    config.read('client_config.ini')
+    config.read(path)
     settings = config['Settings']
     server = config['Server']
     return {
-        "display_current_time": settings.getboolean('display_current_time'),
+        "display_current_time": settings.getboolean('display_current_time', False),
+        "auto_resume": settings.getboolean('auto_resume', True),
+        "reconnect_attempts": settings.getint('reconnect_attempts', 5),
         "uri": server['uri'],
         "port": server['port']
     }
 
-def read_display_current_time_setting():
-    config = configparser.ConfigParser()
-    config.read('client_config.ini')
-    return config.getboolean('Settings', 'display_current_time')
 
+def create_ssl_context(uri):
+    if not uri.startswith('wss://'):
+        return None
+    # The test server uses a self-signed certificate
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
 
-async def receive_messages(websocket):
-    while True:
-        response = await websocket.recv()
-        display_time = read_display_current_time_setting()
 
-        message_to_display = " ~ " + response
-        if display_time:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            message_to_display = f"{current_time} ~ {response}"
+class Session:
+    # What survives a reconnect
+    def __init__(self):
+        self.token = None
+        self.quitting = False
 
-        print("\r" + message_to_display, end="\n> ", flush=True)  # Overwrite the current line and print the message
+    def take_token(self, response):
+        # Strips the resume token out of a message, which may hold several lines when the server batched them
+        if RESUME_TOKEN_PREFIX not in response:
+            return response
+        lines = []
+        for line in response.split('\n'):
+            if line.startswith(RESUME_TOKEN_PREFIX):
+                self.token = line[len(RESUME_TOKEN_PREFIX):]
+            else:
+                lines.append(line)
+        return '\n'.join(lines)
 
 
-async def send_messages(websocket, message_queue):
-    while True:
-        message_to_send = await asyncio.to_thread(message_queue.get)
-        await websocket.send(message_to_send)
+class Output:
+    # Messages are buffered and written together once the receive loop has caught up, so a burst (a broadcast, a
+    # long who list) costs one terminal write instead of one per frame
+    def __init__(self, display_time, stream=sys.stdout, prompt=True, label=None, max_batch=256):
+        self.display_time = display_time
+        self.stream = stream
+        self.prompt = prompt
+        self.label = label
+        self.max_batch = max_batch
+        self._lines = []
+        self._scheduled = False
+        self._second = None
+        self._timestamp = ''
 
+    def timestamp(self):
+        # Formatted at most once a second
+        second = int(time.time())
+        if second != self._second:
+            self._second = second
+            self._timestamp = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        return self._timestamp
 
-def input_thread(message_queue):
-    while True:
-        message_to_send = input("> ")
-        message_queue.put(message_to_send)
+    def add(self, message):
+        prefix = self.timestamp() if self.display_time else ''
+        if self.label is not None:
+            prefix = f"[{self.label}] {prefix}"
+        self._lines.append(f"{prefix} ~ {message}")
+        if len(self._lines) >= self.max_batch:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
 
+    def flush(self):
+        self._scheduled = False
+        if not self._lines:
+            return
+        text = "\n".join(self._lines)
+        self._lines.clear()
+        if self.prompt:
+            self.stream.write("\r" + text + "\n" + PROMPT)  # Overwrite the current prompt line
+        else:
+            self.stream.write(text + "\n")
+        self.stream.flush()
 
-async def websocket_client():
-    config = load_config()
-    uri = f"{config['uri']}:{config['port']}"
 
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
+async def open_stdin():
+    # Typed lines as an asyncio stream, read by the event loop itself
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (NotImplementedError, ValueError, OSError):
+        # Windows consoles and regular files can't be watched by the event loop; one thread feeds the stream instead
+        def read_lines():
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(reader.feed_data, line.encode())
+            loop.call_soon_threadsafe(reader.feed_eof)
+
+        threading.Thread(target=read_lines, daemon=True).start()
+    return reader
+
 
-    message_queue = queue.Queue()
+async def receive_messages(websocket, output, session):
+    async for response in websocket:
+        response = session.take_token(response)
+        if response:
+            output.add(response)
 
-    # Start the input thread
-    threading.Thread(target=input_thread, args=(message_queue,), daemon=True).start()
 
+async def send_messages(websocket, stdin, session):
+    while True:
+        line = await stdin.readline()
+        if not line:
+            # End of input (Ctrl-D): leave for good
+            session.quitting = True
+            return
+        message = line.decode().rstrip('\r\n')
+        if message == '/quit':
+            session.quitting = True
+        await websocket.send(message)
+
+
+async def run_connection(uri, ssl_context, stdin, output, session):
     async with websockets.connect(uri, ssl=ssl_context) as websocket:
-        # Handle the initial greeting message
+        # Answer the login prompt with the token from the last connection, if there is one
         greeting = await websocket.recv()
-        display_time = read_display_current_time_setting()
-
-        if display_time:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{current_time} ~ {greeting}")
+        if session.token is not None:
+            token, session.token = session.token, None
+            await websocket.send(f"resume {token}")
         else:
-            print(greeting + " ~")
+            output.add(greeting)
+
+        receive_task = asyncio.create_task(receive_messages(websocket, output, session))
+        send_task = asyncio.create_task(send_messages(websocket, stdin, session))
+        done, pending = await asyncio.wait([receive_task, send_task], return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+    return websocket.close_code
+
+
+async def websocket_client(config):
+    uri = f"{config['uri']}:{config['port']}"
+    ssl_context = create_ssl_context(uri)
+    output = Output(config['display_current_time'])
+    session = Session()
+    stdin = await open_stdin()
+
+    print(PROMPT, end="", flush=True)  # Print the initial prompt
+    attempts = 0
+    try:
+        while True:
+            try:
+                close_code = await run_connection(uri, ssl_context, stdin, output, session)
+                attempts = 0
+                if close_code == 1000:
+                    # The server ended the session on purpose (/quit, an idle or login timeout): nothing to resume
+                    break
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                attempts += 1
+                output.add(f"Connection lost: {e}")
+            # Without a token there is nothing to come back to
+            if session.quitting or session.token is None or not config['auto_resume'] \
+                    or attempts > config['reconnect_attempts']:
+                break
+            # Back off 1s, 2s, 4s... between failed attempts
+            delay = min(2 ** max(attempts - 1, 0), 30)
+            output.add(f"Reconnecting in {delay}s...")
+            await asyncio.sleep(delay)
+    finally:
+        output.flush()
+        try:
+            os.set_blocking(sys.stdin.fileno(), True)  # The pipe transport left the terminal non-blocking
+        except (AttributeError, OSError, ValueError):
+            pass
+
+
+def load_script(path):
+    # One command per line; blank lines and '#' comments are skipped, '{n}' becomes the session number
+    with open(path) as file:
+        return [line.rstrip('\r\n') for line in file if line.strip() and not line.lstrip().startswith('#')]
+
+
+async def scripted_session(index, uri, ssl_context, script, args, output, results):
+    # Sends each command once the previous one has been answered (its first frame), then waits out the delay
+    session = Session()
+    frames = asyncio.Queue()
+
+    async def receive(websocket):
+        async for response in websocket:
+            response = session.take_token(response)
+            if response:
+                frames.put_nowait(time.perf_counter())
+                if output is not None:
+                    output.add(response)
+
+    async def next_frame(receiver):
+        # When the next frame arrived, or None once the server has closed the connection (e.g. after /quit)
+        frame = asyncio.create_task(frames.get())
+        done, _ = await asyncio.wait([frame, receiver], timeout=args.timeout, return_when=asyncio.FIRST_COMPLETED)
+        if frame in done:
+            return frame.result()
+        frame.cancel()
+        if receiver in done:
+            receiver.result()  # Raises if the connection was closed with an error
+            return None
+        raise asyncio.TimeoutError
+
+    try:
+        async with websockets.connect(uri, ssl=ssl_context, open_timeout=args.timeout) as websocket:
+            receiver = asyncio.create_task(receive(websocket))
+            try:
+                if await next_frame(receiver) is None:
+                    raise websockets.exceptions.InvalidState("closed before the login prompt")
+                for command in script:
+                    while not frames.empty():
+                        frames.get_nowait()
+                    sent = time.perf_counter()
+                    await websocket.send(command.replace('{n}', str(index)))
+                    received = await next_frame(receiver)
+                    if received is None:
+                        break
+                    results['latencies'].append(received - sent)
+                    if args.delay:
+                        await asyncio.sleep(args.delay)
+            finally:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+        results['completed'] += 1
+    except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+        results['failed'] += 1
+
+
+async def scripted_client(config, args):
+    # Headless: every session runs the script and exits; with --sessions N it doubles as a small load driver
+    uri = f"{config['uri']}:{config['port']}"
+    ssl_context = create_ssl_context(uri)
+    script = load_script(args.script)
+    results = {'completed': 0, 'failed': 0, 'latencies': []}
+
+    start = time.perf_counter()
+    outputs = []
+    sessions = []
+    for index in range(args.sessions):
+        output = None
+        if not args.quiet:
+            output = Output(config['display_current_time'], prompt=False,
+                            label=index if args.sessions > 1 else None)
+            outputs.append(output)
+        sessions.append(scripted_session(index, uri, ssl_context, script, args, output, results))
+    await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - start
+    for output in outputs:
+        output.flush()
+
+    latencies = sorted(results['latencies'])
+    summary = (f"{results['completed']} sessions completed, {results['failed']} failed, "
+               f"{len(latencies)} commands in {elapsed:.2f}s")
+    if latencies:
+        summary += (f"; reply mean {sum(latencies) / len(latencies) * 1000:.1f}ms, "
+                    f"p95 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000:.1f}ms")
+    print(summary, file=sys.stderr)
+    return results['failed'] == 0
+
 
-        print("> ", end="", flush=True)  # Print the initial prompt
+def main():
+    parser = argparse.ArgumentParser(description='uuu websocket client')
+    parser.add_argument('--config', default='client_config.ini', help='path to client_config.ini')
+    parser.add_argument('--script', help='run the commands in this file without a terminal, then exit')
+    parser.add_argument('--sessions', type=int, default=1, help='concurrent sessions running the script')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait after each reply')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for each reply')
+    parser.add_argument('--quiet', action='store_true', help="don't print what the server sends")
+    args = parser.parse_args()
 
-        # Start asynchronous tasks
-        receive_task = asyncio.create_task(receive_messages(websocket))
-        send_task = asyncio.create_task(send_messages(websocket, message_queue))
+    config = load_config(args.config)
+    try:
+        if args.script:
+            sys.exit(0 if asyncio.run(scripted_client(config, args)) else 1)
+        asyncio.run(websocket_client(config))
+    except KeyboardInterrupt:
+        pass
 
-        # Wait for tasks to complete
-        await asyncio.gather(receive_task, send_task)
 
 # Run the client
-asyncio.run(websocket_client())
+if __name__ == '__main__':
+    main()
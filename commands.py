@@ -0,0 +1,112 @@
+import time
+
+from metrics import Histogram
+from screens import command_list_screen, send_screen
+from sessions import get_resume_tokens
+
+# Every table built, so metrics can be reported across all contexts
+command_tables = []
+
+
+class CommandStats(Histogram):
+    def __init__(self):
+        super().__init__()
+        self.errors = 0
+
+
+class Command:
+    def __init__(self, name, description, handler, aliases=()):
+        self.name = name
+        self.description = description
+        self.handler = handler
+        self.aliases = tuple(aliases)
+        self.stats = CommandStats()
+
+
+class CommandTable:
+    def __init__(self, name, unknown_message):
+        self.name = name
+        self.unknown_message = unknown_message
+        self.commands = {}  # Command name -> Command, in the order they were added
+        self._lookup = {}  # Names, aliases and unambiguous prefixes -> Command
+        self._ambiguous = {}  # Prefixes shared by several commands -> their names
+        command_tables.append(self)
+
+    def add(self, name, description, handler, aliases=()):
+        # Handlers are called as handler(context, args)
+        self.commands[name] = Command(name, description, handler, aliases)
+        self._build_lookup()
+
+    def switch(self, name, description, context_name, aliases=()):
+        async def switch_handler(context, _args):
+            await context.switch_context(context_name)
+        self.add(name, description, switch_handler, aliases)
+
+    def _build_lookup(self):
+        # Precompute every prefix once so resolving a command is a single dict lookup
+        prefixes = {}
+        exact = {}
+        for command in self.commands.values():
+            for word in (command.name, *command.aliases):
+                exact[word] = command
+                for end in range(1, len(word)):
+                    prefixes.setdefault(word[:end], set()).add(command.name)
+
+        self._lookup = {}
+        self._ambiguous = {}
+        for prefix, names in prefixes.items():
+            if len(names) == 1:
+                self._lookup[prefix] = self.commands[next(iter(names))]
+            else:
+                self._ambiguous[prefix] = sorted(names)
+        self._lookup.update(exact)  # Full names and aliases always win over prefixes
+
+    def resolve(self, word):
+        return self._lookup.get(word)
+
+    @staticmethod
+    def parse(line):
+        parts = line.strip().split(maxsplit=1)
+        if not parts:
+            return '', ''
+        return parts[0].lower(), parts[1] if len(parts) > 1 else ''
+
+    async def dispatch(self, context, line):
+        word, args = self.parse(line)
+        command = self.resolve(word)
+        if command is None:
+            if word in self._ambiguous:
+                await context.websocket.send(f"Ambiguous command '{word}': {', '.join(self._ambiguous[word])}.")
+            else:
+                await context.websocket.send(self.unknown_message)
+            return
+
+        start = time.perf_counter()
+        try:
+            await command.handler(context, args)
+        except Exception:
+            command.stats.errors += 1
+            raise
+        finally:
+            command.stats.observe(time.perf_counter() - start)
+
+    def listing(self):
+        return {command.name: command.description for command in self.commands.values()}
+
+    def stats(self):
+        return {name: command.stats for name, command in self.commands.items()}
+
+
+# Handlers shared by every context's table
+
+async def list_commands(context, _args):
+    table = context.commands
+    await send_screen(context.websocket, command_list_screen(table.name, table.listing()))
+
+
+async def quit_session(context, _args):
+    # A deliberate quit ends the session for good: its resume token goes with it
+    username = getattr(context.websocket, 'username', None)
+    if username is not None:
+        get_resume_tokens().revoke(username)
+    await context.websocket.close()
@@ -0,0 +1,140 @@
+import logging
+import zlib
+from collections import OrderedDict
+from dataclasses import replace
+
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# What Z_SYNC_FLUSH leaves at the end of every message; permessage-deflate leaves it off the wire
+_EMPTY_BLOCK = b'\x00\x00\xff\xff'
+
+
+class PrecompressedFrames:
+    # Static screens deflated once and sent as-is to every session, instead of being compressed again per send.
+    # Only possible without server context takeover, where each message is compressed on its own
+    def __init__(self, window_bits=12, compress_settings=None, max_entries=256):
+        self.window_bits = window_bits
+        self.compress_settings = compress_settings or {}
+        self.max_entries = max_entries
+        self._frames = OrderedDict()  # UTF-8 payload -> deflated payload, least recently added first
+
+    def __len__(self):
+        return len(self._frames)
+
+    def add(self, data):
+        if data in self._frames:
+            return
+        encoder = zlib.compressobj(wbits=-self.window_bits, **self.compress_settings)
+        deflated = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        self._frames[data] = deflated[:-len(_EMPTY_BLOCK)] if deflated.endswith(_EMPTY_BLOCK) else deflated
+        # Screens replaced after a source file changed age out here
+        while len(self._frames) > self.max_entries:
+            self._frames.popitem(last=False)
+
+    def get(self, data):
+        return self._frames.get(data)
+
+
+class SelectivePerMessageDeflate(PerMessageDeflate):
+    # permessage-deflate that leaves short messages uncompressed (RSV1 clear), where deflate's CPU and framing cost
+    # more than it saves, and sends registered static screens pre-compressed
+    def __init__(self, *args, min_size=0, precompressed=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.precompressed = None
+        if precompressed is not None and self.local_no_context_takeover \
+                and precompressed.window_bits <= self.local_max_window_bits:
+            self.precompressed = precompressed
+        self.encode_cont_data = False
+
+    def encode(self, frame):
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is frames.Opcode.CONT:
+            # Continuation frames follow whatever was decided for the message's first frame
+            return super().encode(frame) if self.encode_cont_data else frame
+
+        size = len(frame.data)
+        if self.precompressed is not None and frame.fin:
+            deflated = self.precompressed.get(frame.data)
+            if deflated is not None:
+                self.encode_cont_data = False
+                metrics.increment('ws_frames', 'precompressed')
+                metrics.increment('ws_payload_bytes', 'raw', size)
+                metrics.increment('ws_payload_bytes', 'sent', len(deflated))
+                return replace(frame, rsv1=True, data=deflated)
+
+        self.encode_cont_data = size >= self.min_size
+        if not self.encode_cont_data:
+            metrics.increment('ws_frames', 'uncompressed')
+            metrics.increment('ws_payload_bytes', 'raw', size)
+            metrics.increment('ws_payload_bytes', 'sent', size)
+            return frame
+
+        frame = super().encode(frame)
+        metrics.increment('ws_frames', 'compressed')
+        metrics.increment('ws_payload_bytes', 'raw', size)
+        metrics.increment('ws_payload_bytes', 'sent', len(frame.data))
+        return frame
+
+
+class SelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    # Negotiates permessage-deflate as usual and hands each connection a SelectivePerMessageDeflate
+    def __init__(self, min_size=0, precompressed=None, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.precompressed = precompressed
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+            precompressed=self.precompressed,
+        )
+
+
+def create_extensions(compression_settings):
+    # The server's extension factories, for serve(extensions=...); [] turns compression off
+    if not compression_settings.enabled:
+        return []
+    return [SelectiveDeflateFactory(
+        min_size=compression_settings.min_size,
+        precompressed=precompressed_frames,
+        server_no_context_takeover=not compression_settings.context_takeover,
+        server_max_window_bits=compression_settings.window_bits,
+        client_max_window_bits=compression_settings.client_window_bits,
+        compress_settings={'level': compression_settings.level, 'memLevel': compression_settings.mem_level},
+    )]
+
+
+# Shared table of pre-compressed screens, created once by the server at startup when enabled
+precompressed_frames = None
+
+
+def init_compression(compression_settings):
+    global precompressed_frames
+    precompressed_frames = None
+    if compression_settings.enabled and compression_settings.precompress_screens:
+        if compression_settings.context_takeover:
+            logger.warning("precompress_screens needs context_takeover = False; screens are compressed per send")
+        else:
+            precompressed_frames = PrecompressedFrames(
+                compression_settings.window_bits,
+                {'level': compression_settings.level, 'memLevel': compression_settings.mem_level})
+    return precompressed_frames
+
+
+def precompress(data):
+    # Called for every rendered screen; a no-op unless pre-compression is on
+    if precompressed_frames is not None:
+        precompressed_frames.add(data)
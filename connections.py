@@ -1,2 +1,179 @@
 # connections.py
-connected_users = {}
+import time
+from bisect import bisect_left, insort
+
+WHO_PAGE_SIZE = 50
+# Activity on this worker reaches the others at most this often per player, so remote idle times are this coarse
+ACTIVITY_PUBLISH_INTERVAL = 10.0
+
+
+class PresenceInfo:
+    __slots__ = ('username', 'websocket', 'worker', 'context', 'login_time', 'last_active', 'last_published')
+
+    def __init__(self, username, websocket, worker=None):
+        self.username = username
+        self.websocket = websocket  # The session's SessionWriter; None for players connected to another worker
+        self.worker = worker
+        self.context = None
+        self.login_time = time.time()
+        self.last_active = time.monotonic()
+        self.last_published = self.last_active  # When other workers last heard this player was active
+
+    @property
+    def idle_time(self):
+        return time.monotonic() - self.last_active
+
+
+class Presence:
+    def __init__(self):
+        self.sessions = {}  # username -> PresenceInfo
+        self.sockets = {}  # username -> the session's SessionWriter
+        self._index = []  # Sorted (lowercase name, name) pairs for paging and prefix search
+        self.bus = None  # Set in multi-worker mode so other workers see this worker's players
+
+    def __contains__(self, username):
+        return username in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _insert(self, info):
+        # Logging in again from a new connection replaces the old entry
+        if info.username not in self.sessions:
+            insort(self._index, (info.username.lower(), info.username))
+        self.sessions[info.username] = info
+
+    def _delete(self, username):
+        del self.sessions[username]
+        self.sockets.pop(username, None)
+        position = bisect_left(self._index, (username.lower(), username))
+        del self._index[position]
+
+    def add(self, username, websocket):
+        info = PresenceInfo(username, websocket)
+        self._insert(info)
+        self.sockets[username] = websocket
+        if self.bus is not None:
+            self.bus.publish('join', user=username, context=None, login_time=info.login_time)
+
+    def remove(self, username, websocket=None):
+        info = self.sessions.get(username)
+        if info is None or info.websocket is None or (websocket is not None and info.websocket is not websocket):
+            return False
+        self._delete(username)
+        if self.bus is not None:
+            self.bus.publish('leave', user=username)
+        return True
+
+    def add_remote(self, username, worker, context=None, login_time=None):
+        # A player on another worker; a local session for the same name takes precedence
+        existing = self.sessions.get(username)
+        if existing is not None and existing.websocket is not None:
+            return
+        info = PresenceInfo(username, None, worker)
+        info.context = context
+        if login_time is not None:
+            info.login_time = login_time
+        self._insert(info)
+
+    def remove_remote(self, username, worker):
+        info = self.sessions.get(username)
+        if info is not None and info.websocket is None and info.worker == worker:
+            self._delete(username)
+
+    def set_remote_context(self, username, worker, context_name):
+        info = self.sessions.get(username)
+        if info is not None and info.websocket is None and info.worker == worker:
+            info.context = context_name
+            info.last_active = time.monotonic()
+
+    def touch_remote(self, username, worker):
+        info = self.sessions.get(username)
+        if info is not None and info.websocket is None and info.worker == worker:
+            info.last_active = time.monotonic()
+
+    def drop_worker(self, worker):
+        for info in [info for info in self.sessions.values() if info.websocket is None and info.worker == worker]:
+            self._delete(info.username)
+
+    def local_sessions(self):
+        return [info for info in self.sessions.values() if info.websocket is not None]
+
+    def get(self, username):
+        return self.sessions.get(username)
+
+    def set_context(self, username, context_name):
+        info = self.sessions.get(username)
+        if info is not None:
+            info.context = context_name
+            info.last_active = time.monotonic()
+            if self.bus is not None and info.websocket is not None:
+                info.last_published = info.last_active
+                self.bus.publish('context', user=username, context=context_name)
+
+    def touch(self, username):
+        info = self.sessions.get(username)
+        if info is not None:
+            info.last_active = time.monotonic()
+            # Other workers only need to know the player isn't idle, not every command
+            if self.bus is not None and info.websocket is not None \
+                    and info.last_active - info.last_published >= ACTIVITY_PUBLISH_INTERVAL:
+                info.last_published = info.last_active
+                self.bus.publish('active', user=username)
+
+    def _range(self, prefix):
+        prefix = prefix.lower()
+        start = bisect_left(self._index, (prefix,))
+        end = bisect_left(self._index, (prefix + '\uffff',)) if prefix else len(self._index)
+        return start, end
+
+    def who(self, prefix='', context=None, page=1, per_page=WHO_PAGE_SIZE):
+        # Returns one page of PresenceInfo in name order plus the total number of matches
+        start, end = self._range(prefix)
+        if context is None:
+            total = end - start
+            first = start + (page - 1) * per_page
+            names = [name for _, name in self._index[first:min(first + per_page, end)]]
+        else:
+            matches = [name for _, name in self._index[start:end] if self.sessions[name].context == context]
+            total = len(matches)
+            names = matches[(page - 1) * per_page:page * per_page]
+        return [self.sessions[name] for name in names], total
+
+    def context_counts(self):
+        counts = {}
+        for info in self.sessions.values():
+            counts[info.context] = counts.get(info.context, 0) + 1
+        return counts
+
+    async def send_to(self, username, message):
+        # Delivers to a player on this worker or, through the bus, on another one
+        info = self.sessions.get(username)
+        if info is None:
+            return False
+        if info.websocket is not None:
+            # Queued without waiting, so a slow recipient never holds up the sender; False if the queue is full
+            return info.websocket.send_nowait(message)
+        if self.bus is not None:
+            self.bus.publish('deliver', user=username, message=message)
+        else:
+            return False
+        return True
+
+    def broadcast(self, message, usernames=None, local_only=False):
+        # Encoded once and queued on every session's writer without awaiting each send in turn
+        if usernames is None:
+            sockets = self.sockets.values()
+        else:
+            sockets = [self.sockets[name] for name in usernames if name in self.sockets]
+        data = message.encode()
+        for websocket in sockets:
+            websocket.send_nowait(data)
+        if self.bus is not None and not local_only:
+            self.bus.publish('broadcast', message=message, users=usernames)
+
+
+presence = Presence()
+
+# username -> websocket, kept in step with presence for code that only needs the socket
+connected_users = presence.sockets
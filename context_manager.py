@@ -1,44 +1,136 @@
+import itertools
+import logging
+import pkgutil
+import time
 from importlib import import_module
 
+from connections import presence
+
+logger = logging.getLogger(__name__)
+
+# Numbers sessions within this process so log lines from one connection can be followed
+session_ids = itertools.count(1)
+
+# Context name -> context class, filled once at startup by register_contexts()
+context_classes = {}
+
+
+def context_class_name(context_name):
+    return ''.join(word.capitalize() for word in context_name.split('_'))
+
+
+def register_contexts(package_name='contexts'):
+    package = import_module(package_name)
+    for module_info in pkgutil.iter_modules(package.__path__):
+        context_name = module_info.name
+        context_module = import_module(f'{package_name}.{context_name}')
+        context_class = getattr(context_module, context_class_name(context_name), None)
+        if context_class is not None:
+            context_classes[context_name] = context_class
+    return context_classes
+
+
 class ContextManager:
+    # One per connection, like the context objects it builds: slots keep idle sessions small
+    __slots__ = ('current_context', 'current_context_name', 'websocket', 'db_config', 'registration_enabled',
+                 'messages', 'username', 'contexts', 'flow', 'session_id')
+
     def __init__(self, websocket, db_config, registration_enabled, messages, username=None):
         self.current_context = None
+        self.current_context_name = None
         self.websocket = websocket
         self.db_config = db_config
         self.registration_enabled = registration_enabled
         self.messages = messages
         self.username = username  # Storing the username
+        self.contexts = {}  # Context instances for this session, built on first use and reused after
+        self.flow = None  # Multi-step exchange (login, password reset...) that receives input before the context
+        self.session_id = next(session_ids)
+
+    def log_fields(self, **fields):
+        # The extra= for a log line about this session
+        return {'session': self.session_id, 'user': self.username, 'context': self.current_context_name, **fields}
 
     async def switch_context(self, new_context_name, additional_args=None):
         await self.set_context(new_context_name, additional_args=additional_args)
 
+    def get_context(self, context_name):
+        context = self.contexts.get(context_name)
+        if context is None:
+            if not context_classes:
+                register_contexts()
+            context_class = context_classes.get(context_name)
+            if context_class is None:
+                raise LookupError(f"Unknown context: {context_name}")
+            context = context_class(self.websocket, self.db_config, self.registration_enabled,
+                                    self.messages, self.switch_context, self.username, self.start_flow)
+            self.contexts[context_name] = context
+        return context
+
     async def set_context(self, context_name, additional_args=None):
+        start = time.perf_counter()
+        previous_context_name = self.current_context_name
         try:
-            username_info = f" for player: {self.username}" if self.username else ""
-            print(f"Loading context: {context_name}{username_info}")
+            context = self.get_context(context_name)
+
+            if self.current_context is not None:
+                await self.current_context.on_exit()
 
-            context_module = import_module(f'contexts.{context_name}')
-            class_name = ''.join(word.capitalize() for word in context_name.split('_'))
-            context_class = getattr(context_module, class_name)
+            self.current_context = context
+            self.current_context_name = context_name
+            if self.username is not None:
+                presence.set_context(self.username, context_name)
 
-            # Initialize the context with the username and additional arguments if provided
-            if additional_args is not None:
-                self.current_context = context_class(self.websocket, self.db_config, self.registration_enabled,
-                                                     self.messages, self.switch_context, self.username, **additional_args)
-            else:
-                self.current_context = context_class(self.websocket, self.db_config, self.registration_enabled,
-                                                     self.messages, self.switch_context, self.username)
+            # Awaited rather than fired off, so a greeting can't outlive the switch or the session
+            await context.on_enter(**(additional_args or {}))
 
-            print(f"Context set to: {context_name}{username_info}")
+            logger.info("Context set to %s", context_name, extra=self.log_fields(
+                event='context_switch', previous=previous_context_name,
+                latency_ms=round((time.perf_counter() - start) * 1000, 3)))
+        except Exception:
+            logger.exception("Error setting context %s", context_name, extra=self.log_fields())
 
-            if hasattr(self.current_context, 'send_greeting'):
-                await self.current_context.send_greeting()
+    async def start_flow(self, flow):
+        self.flow = flow
+        await flow.start()
+        if flow.done and self.flow is flow:
+            self.flow = None
 
-        except Exception as e:
-            print(f"Error in set_context: {e}")
+    def step_timeout(self):
+        # How long the receive loop may wait for the next message; None means no limit
+        return self.flow.step_timeout if self.flow is not None else None
+
+    async def expire_flow(self):
+        flow, self.flow = self.flow, None
+        if flow is not None:
+            await flow.on_timeout()
+
+    async def close(self):
+        self.flow = None
+        if self.current_context is not None:
+            await self.current_context.on_exit()
+        self.current_context = None
+        self.current_context_name = None
+        self.contexts.clear()
 
     async def handle_command(self, command):
-        if self.current_context:
+        start = time.perf_counter()
+        if self.username is not None:
+            presence.touch(self.username)
+        in_flow = self.flow is not None
+        if in_flow:
+            flow = self.flow
+            await flow.feed(command)
+            if flow.done and self.flow is flow:
+                self.flow = None
+        elif self.current_context:
             await self.current_context.handle_command(command)
         else:
-            print("No current context set.")
+            logger.warning("No current context set", extra=self.log_fields())
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Only the command word: the rest may be a private message, and flow replies may be passwords
+            word = None if in_flow else next(iter(command.split(maxsplit=1)), '')
+            logger.debug("Command handled", extra=self.log_fields(
+                event='command', command=word, latency_ms=round((time.perf_counter() - start) * 1000, 3)))
@@ -1,48 +1,27 @@
-import asyncio
-import configparser
-import textwrap
+from commands import CommandTable, list_commands, quit_session
 
 
 class CHelp:
+    __slots__ = ('websocket', 'switch_context')
+
     def __init__(self, websocket, _db_config, _registration_enabled, _messages, switch_context, *_):
         self.websocket = websocket
         self.switch_context = switch_context
 
-        # Define available commands for this context
-        self.available_commands = {
-            'lobby': 'Return to the lobby',
-            'commands': 'List all available commands',
-            'manage': 'Enter account management screen',
-            'messages': 'Enter your message screen',
-            '/quit': 'type /quit to close exit the world'
-            # ... other commands ...
-        }
-
-        # Run the initial lobby setup, like displaying MOTD
-        asyncio.create_task(self.initial_help_setup())
-
-    async def initial_help_setup(self):
+    async def on_enter(self):
         await self.websocket.send("Help Menu")
 
+    async def on_exit(self):
+        pass
+
     async def handle_command(self, command):
-        if command.lower() == 'lobby':
-            # Switch to the help context
-            await self.switch_context('c_lobby')
-        elif command.lower() == 'manage':
-            # Switch to the management context
-            await self.switch_context('c_management')
-        elif command.lower() == 'messages':
-            # Switch to the messages context
-            await self.switch_context('c_messages')
-        elif command.lower() == 'commands':
-            await self.display_available_commands()
-        else:
-            # Handle unrecognized command or general lobby actions
-            await self.websocket.send(
-                "Unrecognized Lobby command. Type 'lobby', 'commands', 'manage', or 'messages' for more information.")
+        await self.commands.dispatch(self, command)
 
-    async def display_available_commands(self):
-        commands_info = "Available Commands:\n"
-        for cmd, description in self.available_commands.items():
-            commands_info += f"- {cmd}: {description}\n"
-        await self.websocket.send(commands_info)
+    # One table drives dispatch and the 'commands' listing
+    commands = CommandTable('CHelp', "Unrecognized Lobby command. Type 'lobby', 'commands', 'manage', or "
+                                     "'messages' for more information.")
+    commands.switch('lobby', 'Return to the lobby', 'c_lobby')
+    commands.add('commands', 'List all available commands', list_commands)
+    commands.switch('manage', 'Enter account management screen', 'c_management')
+    commands.switch('messages', 'Enter your message screen', 'c_messages')
+    commands.add('/quit', 'type /quit to close exit the world', quit_session)
@@ -1,11 +1,13 @@
-import asyncio
-import configparser
-import textwrap
-from connections import connected_users
+from connections import presence, WHO_PAGE_SIZE
+from commands import CommandTable, list_commands, quit_session
+from screens import screen_cache, render_file, send_screen
+from settings import get_settings
 
 
 class CLobby:
-    def __init__(self, websocket, db_config, registration_enabled, messages, switch_context, username):
+    __slots__ = ('websocket', 'db_config', 'registration_enabled', 'messages', 'switch_context', 'username')
+
+    def __init__(self, websocket, db_config, registration_enabled, messages, switch_context, username, *_):
         self.websocket = websocket
         self.db_config = db_config
         self.registration_enabled = registration_enabled
@@ -13,82 +15,65 @@ class CLobby:
         self.switch_context = switch_context
         self.username = username
 
-        # Define available commands for this context
-        self.available_commands = {
-            'refresh': 'refresh screen',
-            'who': 'list connected users',
-            'help': 'Get help about commands',
-            'commands': 'List all available commands',
-            'manage': 'Enter management context',
-            'messages': 'Enter messages context',
-            '/quit': 'type /quit to close exit the world'
-            # ... other commands ...
-        }
-
-        # Run the initial lobby setup, like displaying MOTD
-        asyncio.create_task(self.initial_lobby_setup())
-
-    async def initial_lobby_setup(self):
+    async def on_enter(self):
         await self.display_motd()
 
-    async def display_motd(self):
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        motd_enabled = config.getboolean('Settings', 'MOTD')
+    async def on_exit(self):
+        pass
 
-        if motd_enabled:
-            motd = self.load_motd()
-            await self.websocket.send(motd)
+    async def display_motd(self):
+        if get_settings().motd_enabled:
+            await send_screen(self.websocket, self.load_motd())
         else:
             await self.websocket.send("Welcome to the Lobby")
 
     @staticmethod
     def load_motd():
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        motd_file = config['Messages']['motd_file']
-        try:
-            with open(motd_file, 'r') as file:
-                motd_text = file.read()
+        # Rendered once per wrap width and re-rendered only when motd.txt changes
+        settings = get_settings()
+        motd_file = settings.messages['motd_file']
+        return screen_cache.get('motd', lambda width: render_file(motd_file, width, "MOTD file not found."),
+                                width=settings.screen_width, source=motd_file)
 
-                # Splitting the text into paragraphs and wrapping each paragraph
-                paragraphs = motd_text.split('\n\n')
-                wrapped_paragraphs = [textwrap.fill(paragraph, width=80) for paragraph in paragraphs]
+    async def handle_command(self, command):
+        await self.commands.dispatch(self, command)
 
-                # Joining the paragraphs back together with two newlines as separator
-                motd_text = '\n\n'.join(wrapped_paragraphs)
+    async def list_connected_users(self, args=''):
+        # who [name prefix] [page]
+        prefix, page = '', 1
+        for arg in args.split():
+            if arg.isdigit():
+                page = max(1, int(arg))
+            else:
+                prefix = arg
 
-                return motd_text
-        except FileNotFoundError:
-            return "MOTD file not found."
+        users, total = presence.who(prefix=prefix, page=page)
+        pages = max(1, -(-total // WHO_PAGE_SIZE))
+        if page > pages:
+            # Past the end shows the last page
+            page = pages
+            users, total = presence.who(prefix=prefix, page=page)
+        lines = [f"Connected users (page {page}/{pages}, {total} total):"]
+        for info in users:
+            context = (info.context or '').removeprefix('c_')
+            lines.append(f"{info.username}  [{context}]  idle {format_idle(info.idle_time)}")
+        await self.websocket.send("\n".join(lines))
 
-    async def handle_command(self, command):
-        if command.lower() == 'help':
-            # Switch to the help context
-            await self.switch_context('c_help')
-        elif command.lower() == 'who':
-            await self.list_connected_users()
-        elif command.lower() == 'refresh':
-            await self.switch_context('c_lobby')
-        elif command.lower() == 'manage':
-            # Switch to the management context
-            await self.switch_context('c_management')
-        elif command.lower() == 'messages':
-            # Switch to the messages context
-            await self.switch_context('c_messages')
-        elif command.lower() == 'commands':
-            await self.display_available_commands()
-        else:
-            # Handle unrecognized command or general lobby actions
-            await self.websocket.send(
-                "Unrecognized Lobby command. Type 'help', 'commands', 'manage', or 'messages' for more information.")
+    # One table drives dispatch and the 'commands' listing
+    commands = CommandTable('CLobby', "Unrecognized Lobby command. Type 'help', 'commands', 'manage', or "
+                                      "'messages' for more information.")
+    commands.switch('refresh', 'refresh screen', 'c_lobby')
+    commands.add('who', 'list connected users (who [name] [page])', list_connected_users)
+    commands.switch('help', 'Get help about commands', 'c_help')
+    commands.add('commands', 'List all available commands', list_commands)
+    commands.switch('manage', 'Enter management context', 'c_management')
+    commands.switch('messages', 'Enter messages context', 'c_messages')
+    commands.add('/quit', 'type /quit to close exit the world', quit_session)
 
-    async def list_connected_users(self):
-        user_list = "Connected users:\n" + "\n".join(connected_users.keys())
-        await self.websocket.send(user_list)
 
-    async def display_available_commands(self):
-        commands_info = "Available Commands:\n"
-        for cmd, description in self.available_commands.items():
-            commands_info += f"- {cmd}: {description}\n"
-        await self.websocket.send(commands_info)
+def format_idle(seconds):
+    if seconds < 60:
+        return f"{int(seconds)}s"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}m"
+    return f"{int(seconds // 3600)}h"
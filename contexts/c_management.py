@@ -1,111 +1,120 @@
-import asyncio
-import bcrypt
-from database import create_db_connection
-from mysql.connector import Error
+import logging
+from database import DatabaseError
+from flows import Flow
+from limits import client_ip, get_limiter
+from passwords import get_password_hasher, HasherBusy
+from sessions import get_resume_tokens
+from users import get_user_store
+from commands import CommandTable, list_commands, quit_session
+
+logger = logging.getLogger(__name__)
 
 
 class CManagement:
-    def __init__(self, websocket, db_config, registration_enabled, messages, switch_context, username):
+    __slots__ = ('websocket', 'db_config', 'registration_enabled', 'messages', 'switch_context', 'username',
+                 'start_flow')
+
+    def __init__(self, websocket, db_config, registration_enabled, messages, switch_context, username, start_flow):
         self.websocket = websocket
         self.db_config = db_config
         self.registration_enabled = registration_enabled
         self.messages = messages
         self.switch_context = switch_context
         self.username = username  # Storing the username
+        self.start_flow = start_flow
 
-        # Define available commands for this context
-        self.available_commands = {
-            'lobby': 'Return to the lobby',
-            'reset': 'Reset your password',  # Use lowercase for consistency
-            'commands': 'List all available commands',
-            'messages': 'Enter your message screen',
-            '/quit': 'type /quit to close exit the world'
-            # ... other commands ...
-        }
-
-        asyncio.create_task(self.initial_management_setup())
-
-    async def initial_management_setup(self):
+    async def on_enter(self):
         await self.websocket.send("Account Management")
 
+    async def on_exit(self):
+        pass
+
     async def handle_command(self, command):
-        if command.lower() == 'help':
-            await self.switch_context('c_help')
-        elif command.lower() == 'reset':
-            await self.reset_password()
-        elif command.lower() == 'lobby':
-            await self.switch_context('c_lobby')
-        elif command.lower() == 'messages':
-            await self.switch_context('c_messages')
-        elif command.lower() == 'commands':
-            await self.display_available_commands()
-        else:
-            await self.websocket.send("Unrecognized Lobby command. Type 'help', 'commands', 'manage', or "
-                                      "'messages' for more information.")
+        await self.commands.dispatch(self, command)
+
+    async def reset_password(self, _args=''):
+        await self.start_flow(ResetPasswordFlow(self))
+
+    async def verify_password(self, password):
+        try:
+            user_password_hash = await get_user_store().get_password_hash(self.username)
+        except DatabaseError as e:
+            logger.error("Database error verifying password: %s", e, extra={'user': self.username})
+            return False
+
+        if user_password_hash is None:
+            return False
+        try:
+            return await get_password_hasher().verify(password, user_password_hash)
+        except HasherBusy:
+            return False
+
+    async def update_password_in_database(self, new_password):
+        try:
+            hashed_password = await get_password_hasher().hash(new_password)
+            await get_user_store().update_password(self.username, hashed_password)
+            # A token handed out before the change must not get anyone past the new password
+            get_resume_tokens().revoke(self.username)
+            return True
+        except (DatabaseError, HasherBusy) as e:
+            logger.error("Database error updating password: %s", e, extra={'user': self.username})
+            return False
 
-    async def reset_password(self):
-        await self.websocket.send("Enter your current password:")
-        current_password = await self.websocket.recv()
+    # One table drives dispatch and the 'commands' listing
+    commands = CommandTable('CManagement', "Unrecognized Lobby command. Type 'help', 'commands', 'manage', or "
+                                           "'messages' for more information.")
+    commands.switch('lobby', 'Return to the lobby', 'c_lobby')
+    commands.add('reset', 'Reset your password', reset_password)
+    commands.add('commands', 'List all available commands', list_commands)
+    commands.switch('help', 'Get help about commands', 'c_help')
+    commands.switch('messages', 'Enter your message screen', 'c_messages')
+    commands.add('/quit', 'type /quit to close exit the world', quit_session)
+
+
+class ResetPasswordFlow(Flow):
+    timeout_message = "Password reset timed out."
+    __slots__ = ('management', 'new_password')
+
+    def __init__(self, management):
+        super().__init__(management.websocket)
+        self.management = management
+        self.new_password = None
+
+    async def start(self):
+        await self.prompt("Enter your current password:", 'current')
+
+    async def on_current(self, current_password):
+        # Guessing the current password backs off the same way failed logins do
+        limiter = get_limiter()
+        ip = client_ip(self.websocket)
+        wait = limiter.login_blocked_for(ip, self.management.username)
+        if wait > 0:
+            self.finish()
+            await self.websocket.send(f"Too many failed attempts. Try again in {wait:.0f} seconds.")
+            return
 
         # Verify current password
-        if not await self.verify_password(current_password):
+        if not await self.management.verify_password(current_password):
+            limiter.login_failed(ip, self.management.username)
+            self.finish()
             await self.websocket.send("Incorrect current password.")
             return
 
         # New password input and validation
-        await self.websocket.send("Enter your new password:")
-        new_password = await self.websocket.recv()
-        await self.websocket.send("Confirm your new password:")
-        confirm_password = await self.websocket.recv()
+        await self.prompt("Enter your new password:", 'new')
 
-        if new_password != confirm_password:
+    async def on_new(self, new_password):
+        self.new_password = new_password
+        await self.prompt("Confirm your new password:", 'confirm')
+
+    async def on_confirm(self, confirm_password):
+        self.finish()
+        if self.new_password != confirm_password:
             await self.websocket.send("Passwords do not match.")
             return
 
         # Update password in the database
-        if await self.update_password_in_database(new_password):
+        if await self.management.update_password_in_database(self.new_password):
             await self.websocket.send("Password successfully changed.")
         else:
             await self.websocket.send("Failed to change the password.")
-
-    async def verify_password(self, password):
-        connection = create_db_connection(self.db_config)
-        if connection:
-            try:
-                cursor = connection.cursor()
-                cursor.execute("SELECT password FROM users WHERE username = %s", (self.username,))
-                user_password_hash = cursor.fetchone()
-                cursor.close()
-                return bcrypt.checkpw(password.encode(), user_password_hash[0].encode())
-            except Error as e:
-                print(f"Database error: {e}")
-                return False
-            finally:
-                connection.close()
-        else:
-            return False
-
-    async def update_password_in_database(self, new_password):
-        hashed_password = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
-
-        connection = create_db_connection(self.db_config)
-        if connection:
-            try:
-                cursor = connection.cursor()
-                cursor.execute("UPDATE users SET password = %s WHERE username = %s", (hashed_password, self.username))
-                connection.commit()
-                cursor.close()
-                return True
-            except Error as e:
-                print(f"Database error: {e}")
-                return False
-            finally:
-                connection.close()
-        else:
-            return False
-
-    async def display_available_commands(self):
-        commands_info = "Available Commands:\n"
-        for cmd, description in self.available_commands.items():
-            commands_info += f"- {cmd}: {description}\n"
-        await self.websocket.send(commands_info)
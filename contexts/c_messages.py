@@ -0,0 +1,99 @@
+import datetime
+import logging
+from commands import CommandTable, list_commands, quit_session
+from database import DatabaseError
+from mailboxes import unread_counters, send_message, fetch_messages, mark_read
+from settings import get_settings
+from users import get_user_store
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 1000
+
+
+class CMessages:
+    __slots__ = ('websocket', 'db_config', 'registration_enabled', 'messages', 'switch_context', 'username')
+
+    def __init__(self, websocket, db_config, registration_enabled, messages, switch_context, username, *_):
+        self.websocket = websocket
+        self.db_config = db_config
+        self.registration_enabled = registration_enabled
+        self.messages = messages
+        self.switch_context = switch_context
+        self.username = username
+
+    async def on_enter(self):
+        try:
+            unread = await unread_counters.get(self.username)
+        except DatabaseError as e:
+            logger.error("Database error counting unread messages: %s", e, extra={'user': self.username})
+            await self.websocket.send("Messages")
+            return
+        await self.websocket.send(f"Messages - you have {unread} unread message{'s' if unread != 1 else ''}. "
+                                  f"Type 'inbox' to read them or 'send <player> <message>'.")
+
+    async def on_exit(self):
+        pass
+
+    async def handle_command(self, command):
+        await self.commands.dispatch(self, command)
+
+    async def send(self, args=''):
+        parts = args.split(maxsplit=1)
+        if len(parts) < 2:
+            await self.websocket.send("Usage: send <player> <message>")
+            return
+
+        recipient, body = parts
+        if len(body) > MAX_MESSAGE_LENGTH:
+            await self.websocket.send(f"Messages are limited to {MAX_MESSAGE_LENGTH} characters.")
+            return
+
+        try:
+            if not await get_user_store().username_exists(recipient):
+                await self.websocket.send(f"There is no player called '{recipient}'.")
+                return
+            delivered = await send_message(self.username, recipient, body, get_settings().mailbox_size)
+        except DatabaseError as e:
+            logger.error("Database error sending message: %s", e, extra={'user': self.username})
+            await self.websocket.send("An error occurred. Please try again later.")
+            return
+
+        if delivered:
+            await self.websocket.send(f"Message delivered to {recipient}.")
+        else:
+            await self.websocket.send(f"{recipient} is offline; the message will be waiting for them.")
+
+    async def inbox(self, args=''):
+        page = int(args) if args.strip().isdigit() and int(args) > 0 else 1
+        page_size = get_settings().mailbox_page_size
+        try:
+            rows = await fetch_messages(self.username, page, page_size)
+            await mark_read(self.username, [row[0] for row in rows if not row[4]])
+        except DatabaseError as e:
+            logger.error("Database error reading inbox: %s", e, extra={'user': self.username})
+            await self.websocket.send("An error occurred. Please try again later.")
+            return
+
+        if not rows:
+            await self.websocket.send("No messages." if page == 1 else f"No messages on page {page}.")
+            return
+
+        lines = [f"Inbox (page {page}):"]
+        for _, sender, body, sent_at, is_read in rows:
+            sent = datetime.datetime.fromtimestamp(sent_at).strftime("%Y-%m-%d %H:%M")
+            lines.append(f"{'  ' if is_read else '* '}{sent} {sender}: {body}")
+        if len(rows) == page_size:
+            lines.append(f"Type 'inbox {page + 1}' for older messages.")
+        await self.websocket.send("\n".join(lines))
+
+    # One table drives dispatch and the 'commands' listing
+    commands = CommandTable('CMessages', "Unrecognized Messages command. Type 'send', 'inbox', 'commands' or "
+                                         "'lobby'.")
+    commands.add('send', 'Send a message (send <player> <message>)', send)
+    commands.add('inbox', 'Read your messages (inbox [page])', inbox)
+    commands.add('commands', 'List all available commands', list_commands)
+    commands.switch('lobby', 'Return to the lobby', 'c_lobby')
+    commands.switch('help', 'Get help about commands', 'c_help')
+    commands.switch('manage', 'Enter account management screen', 'c_management')
+    commands.add('/quit', 'type /quit to close exit the world', quit_session)
@@ -1,16 +1,377 @@
-import mysql.connector
-from mysql.connector import Error
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
+try:
+    import mysql.connector
+except ImportError:  # Only the mysql backend needs it
+    mysql = None
 
-def create_db_connection(db_config):
-    try:
-        connection = mysql.connector.connect(
-            host=db_config['host'],
-            user=db_config['user'],
-            password=db_config['password'],
-            database=db_config['database']
+from metrics import metrics, timed_call
+
+logger = logging.getLogger(__name__)
+
+# Tables the sqlite backend creates in a new database file; on MariaDB they are created by the administrator
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    body TEXT NOT NULL,
+    sent_at REAL NOT NULL,
+    is_read INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_messages_recipient_sent ON messages (recipient, sent_at);
+"""
+
+
+class DatabaseError(Exception):
+    # Whatever the backend: a failed query, or no connection to run it on
+    pass
+
+
+class PoolError(DatabaseError):
+    pass
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class QueryError(DatabaseError):
+    pass
+
+
+class MySQLBackend:
+    # MariaDB or MySQL through mysql.connector, with one connection per pool thread and server-side prepared
+    # statements
+    name = 'mysql'
+    max_connections = None  # As many as pool_max_size
+    errors = (mysql.connector.Error,) if mysql is not None else ()
+
+    def __init__(self, db_config):
+        self.db_config = db_config
+
+    def connect(self):
+        if mysql is None:
+            raise PoolError("The mysql backend needs mysql-connector-python.")
+        return mysql.connector.connect(
+            host=self.db_config.host,
+            user=self.db_config.user,
+            password=self.db_config.password,
+            database=self.db_config.database
         )
+
+    @staticmethod
+    def cursor(connection, prepared=False):
+        return connection.cursor(prepared=True) if prepared else connection.cursor()
+
+    @staticmethod
+    def is_healthy(connection):
+        # Pings the server
+        try:
+            return connection.is_connected()
+        except Exception:
+            return False
+
+
+class SQLiteBackend:
+    # An embedded database file for single-node deployments: no server to run and no network round trip per query.
+    # SQLite takes one writer at a time anyway, so the pool holds a single connection used only from one dedicated
+    # thread. WAL mode lets reads carry on during a checkpoint, and a commit is an append to the log
+    name = 'sqlite'
+    max_connections = 1
+    errors = (sqlite3.Error,)
+
+    def __init__(self, db_config):
+        self.path = db_config.database
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=5.0)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode a crash of the process loses nothing; only a power cut can lose the last commits
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SQLITE_SCHEMA)
         return connection
-    except Error as e:
-        print(f"Error connecting to MariaDB Platform: {e}")
-        return None
+
+    @staticmethod
+    def cursor(connection, prepared=False):
+        # sqlite3 keeps its own cache of compiled statements
+        return connection.cursor()
+
+    @staticmethod
+    def is_healthy(connection):
+        return True
+
+
+BACKENDS = {backend.name: backend for backend in (MySQLBackend, SQLiteBackend)}
+
+
+def create_backend(db_config):
+    backend_class = BACKENDS.get(db_config.backend)
+    if backend_class is None:
+        raise ValueError(f"Unknown database backend: {db_config.backend}")
+    return backend_class(db_config)
+
+
+class PooledConnection:
+    # Wraps a DB-API connection so every blocking call runs on the pool's executor, and driver errors come out as
+    # QueryError whichever backend raised them. Queries are passed through as written, in the backend's own
+    # placeholder style: the stores in users.py and mailboxes.py hold SQL for each backend
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+
+    async def _run(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool.executor, func, *args)
+        except self.pool.backend.errors as e:
+            raise QueryError(str(e)) from e
+
+    def _execute(self, query, params, fetch):
+        cursor = self.pool.backend.cursor(self.connection)
+        try:
+            cursor.execute(query, params)
+            if fetch == 'one':
+                return cursor.fetchone()
+            if fetch == 'all':
+                return cursor.fetchall()
+            if fetch == 'id':
+                return cursor.lastrowid
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    def _execute_prepared(self, query, params, fetch):
+        # The prepared cursor is kept per connection and query, so the server parses the statement only once
+        cursor = self.pool.prepared_cursor(self.connection, query)
+        try:
+            cursor.execute(query, params)
+            # Always drain the result so the cursor can be executed again
+            rows = cursor.fetchall() if cursor.description else None
+        except Exception:
+            self.pool.forget_prepared(self.connection, query)
+            raise
+        if fetch == 'one':
+            return rows[0] if rows else None
+        if fetch == 'all':
+            return rows
+        if fetch == 'id':
+            return cursor.lastrowid
+        return cursor.rowcount
+
+    async def _query(self, query, params, fetch, prepared):
+        # Timed on the executor thread, so the figure is the database's time rather than time queued for a thread
+        execute = self._execute_prepared if prepared else self._execute
+        result, seconds = await self._run(timed_call, execute, query, params, fetch)
+        metrics.observe('db_query', seconds)
+        return result
+
+    async def fetchone(self, query, params=(), prepared=False):
+        return await self._query(query, params, 'one', prepared)
+
+    async def fetchall(self, query, params=(), prepared=False):
+        return await self._query(query, params, 'all', prepared)
+
+    async def execute(self, query, params=(), prepared=False):
+        return await self._query(query, params, None, prepared)
+
+    async def insert(self, query, params=(), prepared=False):
+        # The id of the inserted row
+        return await self._query(query, params, 'id', prepared)
+
+    async def commit(self):
+        await self._run(self.connection.commit)
+
+    async def rollback(self):
+        await self._run(self.connection.rollback)
+
+
+class DatabasePool:
+    def __init__(self, backend, min_size=1, max_size=10, acquire_timeout=5.0, health_check_interval=30.0):
+        self.backend = backend
+        if backend.max_connections is not None:
+            max_size = min(max_size, backend.max_connections)
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        # One thread per connection; a backend limited to one connection gets one dedicated thread
+        self.executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix=f'db-{backend.name}')
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._prepared = {}  # connection -> {query: prepared cursor}
+        self._idle = deque()  # (connection, last_used) pairs, most recently used on the right
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+
+        # Counters reported by stats()
+        self._acquired = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _open_connection(self):
+        try:
+            connection = await self._run(self.backend.connect)
+        except self.backend.errors as e:
+            logger.error("Error connecting to the %s database: %s", self.backend.name, e)
+            raise PoolError("Could not connect to the database.") from e
+        self._size += 1
+        self._created += 1
+        return connection
+
+    def _close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.warning("Error closing database connection: %s", e)
+
+    async def _discard(self, connection):
+        self._size -= 1
+        self._discarded += 1
+        self._prepared.pop(connection, None)
+        await self._run(self._close_connection, connection)
+
+    def prepared_cursor(self, connection, query):
+        statements = self._prepared.setdefault(connection, {})
+        cursor = statements.get(query)
+        if cursor is None:
+            cursor = statements[query] = self.backend.cursor(connection, prepared=True)
+        return cursor
+
+    def forget_prepared(self, connection, query):
+        cursor = self._prepared.get(connection, {}).pop(query, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    async def start(self):
+        # Pre-open the minimum number of connections
+        while self._size < self.min_size:
+            connection = await self._open_connection()
+            self._idle.append((connection, time.monotonic()))
+
+    async def _get_connection(self):
+        while self._idle:
+            connection, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.health_check_interval:
+                return connection
+            if await self._run(self.backend.is_healthy, connection):
+                return connection
+            await self._discard(connection)
+        return await self._open_connection()
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self._closed:
+            raise PoolError("Database pool is closed.")
+
+        start = time.perf_counter()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeout(f"Timed out after {self.acquire_timeout}s waiting for a database connection.")
+        finally:
+            self._waiting -= 1
+
+        connection = None
+        try:
+            connection = await self._get_connection()
+            self._acquired += 1
+            metrics.observe('db_acquire', time.perf_counter() - start)
+            yield PooledConnection(self, connection)
+        except BaseException:
+            # The connection may be mid-transaction or broken, so never hand it out again
+            if connection is not None:
+                await self._discard(connection)
+                connection = None
+            raise
+        finally:
+            try:
+                if connection is not None:
+                    if self._closed:
+                        await self._discard(connection)
+                    else:
+                        await self._release(connection)
+            finally:
+                self._semaphore.release()
+
+    async def _release(self, connection):
+        # Ends whatever transaction the borrower left open, reads included. Otherwise, under REPEATABLE READ, the
+        # next borrower would keep reading the snapshot that transaction started with
+        try:
+            await self._run(connection.rollback)
+        except self.backend.errors as e:
+            logger.warning("Discarding connection that failed to roll back: %s", e)
+            await self._discard(connection)
+            return
+        self._idle.append((connection, time.monotonic()))
+
+    async def close(self):
+        self._closed = True
+        while self._idle:
+            connection, _ = self._idle.popleft()
+            await self._discard(connection)
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'in_use': self._size - len(self._idle),
+            'waiting': self._waiting,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'backend': self.backend.name,
+            'acquired': self._acquired,
+            'timeouts': self._timeouts,
+            'created': self._created,
+            'discarded': self._discarded,
+        }
+
+
+# Shared pool used by login and every context, created once by the server at startup
+db_pool = None
+
+
+async def init_db_pool(db_config, backend=None, **kwargs):
+    global db_pool
+    kwargs.setdefault('min_size', db_config.pool_min_size)
+    kwargs.setdefault('max_size', db_config.pool_max_size)
+    kwargs.setdefault('acquire_timeout', db_config.pool_acquire_timeout)
+    kwargs.setdefault('health_check_interval', db_config.pool_health_check_interval)
+    db_pool = DatabasePool(backend or create_backend(db_config), **kwargs)
+    await db_pool.start()
+    return db_pool
+
+
+def get_db_pool():
+    if db_pool is None:
+        raise PoolError("Database pool has not been initialised.")
+    return db_pool
+
+
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
@@ -0,0 +1,34 @@
+from settings import get_settings
+
+
+class Flow:
+    # A multi-step prompt/reply exchange driven by the session's single receive loop.
+    # Each reply is fed to the on_<state> method for the current state; a state of None means finished.
+    timeout_message = "Timed out waiting for a reply."
+    __slots__ = ('websocket', 'state', 'step_timeout')
+
+    def __init__(self, websocket, step_timeout=None):
+        self.websocket = websocket
+        self.state = None
+        self.step_timeout = step_timeout if step_timeout is not None else get_settings().server.flow_step_timeout
+
+    @property
+    def done(self):
+        return self.state is None
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def prompt(self, message, state):
+        self.state = state
+        await self.websocket.send(message)
+
+    def finish(self):
+        self.state = None
+
+    async def feed(self, message):
+        await getattr(self, f'on_{self.state}')(message)
+
+    async def on_timeout(self):
+        self.finish()
+        await self.websocket.send(self.timeout_message)
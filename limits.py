@@ -0,0 +1,200 @@
+import time
+from collections import OrderedDict
+
+
+def client_ip(websocket):
+    # The address the limits are keyed by. Behind a trusted proxy that is the nearest untrusted hop in
+    # X-Forwarded-For, not the proxy itself
+    address = websocket.remote_address
+    ip = address[0] if address else 'unknown'
+    trusted = get_limiter().trusted_proxies
+    if ip not in trusted:
+        return ip
+    forwarded = websocket.request_headers.get('X-Forwarded-For', '')
+    for hop in reversed([hop.strip() for hop in forwarded.split(',') if hop.strip()]):
+        ip = hop
+        if hop not in trusted:
+            break
+    return ip
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now, cost=1.0):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class ExpiringTable:
+    # Keyed state forgotten `ttl` seconds after it was last written. Entries stay in expiry order, so every write
+    # sweeps only the expired entries at the front: each one is removed once, keeping every operation O(1)
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at), soonest to expire first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def set(self, key, value, now):
+        self._entries[key] = (value, now + self.ttl)
+        self._entries.move_to_end(key)
+        self._sweep(now)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def _sweep(self, now):
+        while self._entries:
+            _, expires_at = next(iter(self._entries.values()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+
+class Limiter:
+    # Message rate limits per connection and per IP, failed-login backoff, the pre-auth session cap and the cap on
+    # open connections
+    def __init__(self, message_rate=10.0, message_burst=30, ip_message_rate=50.0, ip_message_burst=150,
+                 max_preauth_per_ip=10, free_login_failures=3, login_backoff_base=1.0, login_backoff_max=300.0,
+                 state_ttl=900.0, max_tracked=100000, trusted_proxies=(), max_connections=0):
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.ip_message_rate = ip_message_rate
+        self.ip_message_burst = ip_message_burst
+        self.max_preauth_per_ip = max_preauth_per_ip
+        self.free_login_failures = free_login_failures
+        self.login_backoff_base = login_backoff_base
+        self.login_backoff_max = login_backoff_max
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.max_connections = max_connections
+
+        self._ip_buckets = ExpiringTable(state_ttl, max_tracked)  # ip -> TokenBucket
+        # ('ip', address) or ('user', username) -> (failures, blocked_until); outlives the longest backoff
+        self._login_failures = ExpiringTable(max(state_ttl, login_backoff_max), max_tracked)
+        self._preauth = {}  # ip -> sessions not yet logged in; entries are removed when they reach zero
+        self._connections = 0  # Open connections, from TCP accept to close
+
+        # Counters reported by stats()
+        self._messages_limited = 0
+        self._preauth_rejected = 0
+        self._logins_throttled = 0
+        self._capacity_rejected = 0
+
+    def connection_bucket(self):
+        return TokenBucket(self.message_rate, self.message_burst)
+
+    def allow_message(self, bucket, ip):
+        now = time.monotonic()
+        ip_bucket = self._ip_buckets.get(ip, now)
+        if ip_bucket is None:
+            ip_bucket = TokenBucket(self.ip_message_rate, self.ip_message_burst, now)
+        self._ip_buckets.set(ip, ip_bucket, now)
+        if bucket.take(now) and ip_bucket.take(now):
+            return True
+        self._messages_limited += 1
+        return False
+
+    def enter_preauth(self, ip):
+        count = self._preauth.get(ip, 0)
+        if count >= self.max_preauth_per_ip:
+            self._preauth_rejected += 1
+            return False
+        self._preauth[ip] = count + 1
+        return True
+
+    def leave_preauth(self, ip):
+        count = self._preauth.get(ip, 0) - 1
+        if count > 0:
+            self._preauth[ip] = count
+        else:
+            self._preauth.pop(ip, None)
+
+    def open_connection(self):
+        self._connections += 1
+
+    def close_connection(self):
+        self._connections -= 1
+
+    def over_capacity(self):
+        # Asked once per handshake, with the connection itself already counted
+        if self.max_connections and self._connections > self.max_connections:
+            self._capacity_rejected += 1
+            return True
+        return False
+
+    def login_blocked_for(self, ip, username):
+        # Seconds until another attempt is allowed for this address or account, whichever is longer
+        now = time.monotonic()
+        blocked_until = 0.0
+        for key in (('ip', ip), ('user', username)):
+            entry = self._login_failures.get(key, now)
+            if entry is not None:
+                blocked_until = max(blocked_until, entry[1])
+        if blocked_until > now:
+            self._logins_throttled += 1
+            return blocked_until - now
+        return 0.0
+
+    def login_failed(self, ip, username):
+        now = time.monotonic()
+        for key in (('ip', ip), ('user', username)):
+            entry = self._login_failures.get(key, now)
+            failures = (entry[0] if entry is not None else 0) + 1
+            blocked_until = now
+            if failures > self.free_login_failures:
+                # 1s, 2s, 4s... after the free attempts, up to the maximum
+                excess = failures - self.free_login_failures - 1
+                blocked_until = now + min(self.login_backoff_base * 2 ** min(excess, 32), self.login_backoff_max)
+            self._login_failures.set(key, (failures, blocked_until), now)
+
+    def login_succeeded(self, username):
+        # Only the account is cleared; the address keeps its record so one valid login can't reset guessing
+        self._login_failures.pop(('user', username))
+
+    def stats(self):
+        return {
+            'tracked_ips': len(self._ip_buckets),
+            'tracked_logins': len(self._login_failures),
+            'preauth_sessions': sum(self._preauth.values()),
+            'connections': self._connections,
+            'messages_limited': self._messages_limited,
+            'preauth_rejected': self._preauth_rejected,
+            'logins_throttled': self._logins_throttled,
+            'capacity_rejected': self._capacity_rejected,
+        }
+
+
+# Shared limiter used by every connection, created once by the server at startup
+limiter = None
+
+
+def init_limiter(**kwargs):
+    global limiter
+    limiter = Limiter(**kwargs)
+    return limiter
+
+
+def get_limiter():
+    global limiter
+    if limiter is None:
+        limiter = Limiter()
+    return limiter
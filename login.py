@@ -1,134 +1,198 @@
-import bcrypt
+import logging
 import random
 import string
 import re
-from mysql.connector import Error
-from database import create_db_connection
-from connections import connected_users  # Import the connected_users dictionary
-
-
-async def check_credentials(websocket, db_config):
-    await websocket.send("Enter username:")
-    username = await websocket.recv()
-    if not username.strip():
-        await websocket.send("Username cannot be blank.")
+from database import DatabaseError
+from flows import Flow
+from passwords import get_password_hasher, HasherBusy
+from users import get_user_store
+from connections import presence
+from limits import client_ip, get_limiter
+from metrics import metrics
+from sessions import get_resume_tokens
+
+logger = logging.getLogger(__name__)
+
+
+async def check_credentials(websocket, username, password):
+    # Repeated failures from an address or against an account back off exponentially before any DB or bcrypt work
+    limiter = get_limiter()
+    ip = client_ip(websocket)
+    wait = limiter.login_blocked_for(ip, username)
+    if wait > 0:
+        metrics.increment('login_failures', 'throttled')
+        await websocket.send(f"Too many failed logins. Try again in {wait:.0f} seconds.")
         return False, None
 
-    await websocket.send("Enter password:")
-    password = await websocket.recv()
-    if not password.strip():
-        await websocket.send("Password cannot be blank.")
-        return False, None
-
-    connection = None
     try:
-        connection = create_db_connection(db_config)
-        if connection:
-            cursor = connection.cursor()
-            cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
-            user_password_hash = cursor.fetchone()
-            cursor.close()
-
-            if user_password_hash is not None:
-                authenticated = bcrypt.checkpw(password.encode(), user_password_hash[0].encode())
-                if authenticated:
-                    connected_users[username] = websocket  # Add the user to the connected users
-                    return True, username
-                else:
-                    await websocket.send("Incorrect username or password.")
-                    return False, None
+        # The connection goes back to the pool before the (slow) bcrypt check
+        user_password_hash = await get_user_store().get_password_hash(username)
+
+        if user_password_hash is not None:
+            hasher = get_password_hasher()
+            authenticated = await hasher.verify(password, user_password_hash)
+            if authenticated:
+                if hasher.needs_rehash(user_password_hash):
+                    await rehash_password(username, password)
+                limiter.login_succeeded(username)
+                presence.add(username, websocket)  # Add the user to the connected users
+                metrics.increment('logins')
+                return True, username
             else:
+                metrics.increment('login_failures', 'bad_password')
+                limiter.login_failed(ip, username)
                 await websocket.send("Incorrect username or password.")
                 return False, None
-    except Error as e:
-        print(f"Database error: {e}")
+        else:
+            metrics.increment('login_failures', 'unknown_user')
+            limiter.login_failed(ip, username)
+            await websocket.send("Incorrect username or password.")
+            return False, None
+    except HasherBusy:
+        metrics.increment('login_failures', 'busy')
+        await websocket.send("The server is busy. Please try again in a moment.")
+        return False, None
+    except DatabaseError as e:
+        metrics.increment('login_failures', 'error')
+        logger.error("Database error during login: %s", e, extra={'user': username})
         await websocket.send("An error occurred. Please try again later.")
         return False, None
-    finally:
-        if connection:
-            connection.close()
 
 
-async def register_user(websocket, db_config):
-    cursor = None
-    connection = None
+async def rehash_password(username, password):
+    # Upgrade a hash made with an outdated cost factor while we still have the plain password
     try:
-        # Loop for email validation
-        while True:
-            await websocket.send("Enter email address for registration:")
-            email = await websocket.recv()
-
-            # Validate email format and check for blank email
-            if not re.match(r"[^@]+@[^@]+\.[^@]+", email) or not email.strip():
-                await websocket.send("Invalid or blank email format. Please enter a valid email address.")
-                continue
-
-            connection = create_db_connection(db_config)
-            if connection:
-                cursor = connection.cursor()
-                cursor.execute("SELECT email FROM users WHERE email = %s", (email,))
-                existing_email = cursor.fetchone()
-
-                if existing_email:
-                    await websocket.send("Email already exists. Did you forget your password?")
-                    return False
-
-                # Break the loop if email validation is successful
-                break
-
-        # Loop for username validation
-        while True:
-            await websocket.send("Enter a username for registration:")
-            username = await websocket.recv()
-
-            if not username.strip():
-                await websocket.send("Username cannot be blank. Please enter a valid username.")
-                continue
-
-            cursor.execute("SELECT username FROM users WHERE username = %s", (username,))
-            existing_username = cursor.fetchone()
-
-            if existing_username:
-                await websocket.send("Username already exists. Please choose a different one.")
-                continue
-
-            # Break the loop if username validation is successful
-            break
-
-        # Proceed with registration using validated email and username
-        # Generate a random password and hash it
-        password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-
-        cursor.execute("INSERT INTO users (email, username, password) VALUES (%s, %s, %s)",
-                       (email, username, hashed_password))
-        connection.commit()
-
-        await websocket.send(f"Registration successful. Your username is '{username}' "
-                             f"and your password is '{password}'.")
-        return True
-
-    except Error as e:
-        print(f"Database error: {e}")
-        return False
-
-    finally:
-        if cursor is not None:
-            cursor.close()
-        if connection is not None:
-            connection.close()
-
-
-async def handle_authentication(websocket, db_config, registration_enabled):
-    await websocket.send("Type 'login' to login or 'register' to create a new account.")
-    command = await websocket.recv()
-
-    if command.lower() == 'login':
-        auth_status, username = await check_credentials(websocket, db_config)
-        return auth_status, 'login', username
-    elif command.lower() == 'register' and registration_enabled:
-        reg_status = await register_user(websocket, db_config)
-        return reg_status, 'register', None
-    else:
-        await websocket.send("Unrecognized command. Type 'login' to login or 'register' to create a new account.")
-        return False, 'unknown', None
+        hashed_password = await get_password_hasher().hash(password)
+        await get_user_store().update_password(username, hashed_password)
+    except (DatabaseError, HasherBusy) as e:
+        logger.warning("Could not rehash password: %s", e, extra={'user': username})
+
+
+async def register_user(websocket, email, username):
+    # Generate a random password and hash it
+    password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    hashed_password = await get_password_hasher().hash(password)
+
+    await get_user_store().create_user(email, username, hashed_password)
+    metrics.increment('registrations')
+
+    await websocket.send(f"Registration successful. Your username is '{username}' "
+                         f"and your password is '{password}'.")
+
+
+class AuthFlow(Flow):
+    # Login and registration as a state machine; nothing is held (no DB connection, no recv) between replies
+    timeout_message = "Login timed out."
+    __slots__ = ('registration_enabled', 'on_login', 'username', 'email')
+
+    def __init__(self, websocket, registration_enabled, on_login, step_timeout=None):
+        super().__init__(websocket, step_timeout)
+        self.registration_enabled = registration_enabled
+        self.on_login = on_login  # Awaited with the username (and a context to restore) once authenticated
+        self.username = None
+        self.email = None
+
+    async def start(self):
+        self.username = None
+        self.email = None
+        await self.prompt("Type 'login' to login or 'register' to create a new account.", 'command')
+
+    async def on_command(self, command):
+        if command.lower() == 'login':
+            await self.prompt("Enter username:", 'username')
+        elif command.lower().startswith('resume '):
+            await self.resume(command[len('resume '):])
+        elif command.lower() == 'register' and self.registration_enabled:
+            await self.prompt("Enter email address for registration:", 'email')
+        else:
+            await self.websocket.send("Unrecognized command. Type 'login' to login or 'register' "
+                                      "to create a new account.")
+            await self.start()
+
+    async def on_username(self, username):
+        if not username.strip():
+            await self.websocket.send("Username cannot be blank.")
+            await self.start()
+            return
+        self.username = username
+        await self.prompt("Enter password:", 'password')
+
+    async def on_password(self, password):
+        if not password.strip():
+            await self.websocket.send("Password cannot be blank.")
+            await self.start()
+            return
+
+        auth_status, username = await check_credentials(self.websocket, self.username, password)
+        if auth_status:
+            self.finish()
+            await self.on_login(username)
+        else:
+            await self.start()
+
+    async def resume(self, token):
+        # A token from an earlier login skips the password (and bcrypt) and puts the player back where they were
+        restored = get_resume_tokens().resume(token)
+        if restored is None:
+            metrics.increment('login_failures', 'bad_token')
+            await self.websocket.send("That session can no longer be resumed. Please log in.")
+            await self.start()
+            return
+        username, context = restored
+        # The token may belong to a session this worker still has open; only one of them can be the player
+        existing = presence.get(username)
+        if existing is not None and existing.websocket is not None and existing.websocket is not self.websocket:
+            await existing.websocket.close(1000, "Resumed elsewhere.")
+        presence.add(username, self.websocket)
+        metrics.increment('resumes')
+        self.finish()
+        await self.on_login(username, context)
+
+    async def on_email(self, email):
+        # Validate email format and check for blank email
+        if not re.match(r"[^@]+@[^@]+\.[^@]+", email) or not email.strip():
+            await self.prompt("Invalid or blank email format. Please enter a valid email address.", 'email')
+            return
+
+        try:
+            if await get_user_store().email_exists(email):
+                await self.websocket.send("Email already exists. Did you forget your password?")
+                await self.start()
+                return
+        except DatabaseError as e:
+            await self.registration_failed(e)
+            return
+
+        self.email = email
+        await self.prompt("Enter a username for registration:", 'new_username')
+
+    async def on_new_username(self, username):
+        if not username.strip():
+            await self.prompt("Username cannot be blank. Please enter a valid username.", 'new_username')
+            return
+
+        try:
+            if await get_user_store().username_exists(username):
+                await self.prompt("Username already exists. Please choose a different one.", 'new_username')
+                return
+
+            # Proceed with registration using validated email and username
+            await register_user(self.websocket, self.email, username)
+        except HasherBusy:
+            await self.websocket.send("The server is busy. Please try again in a moment.")
+        except DatabaseError as e:
+            await self.registration_failed(e)
+            return
+
+        # Back to the login prompt so the new account can be used straight away
+        await self.start()
+
+    async def registration_failed(self, error):
+        logger.error("Database error during registration: %s", error)
+        await self.websocket.send("An error occurred. Please try again later.")
+        await self.start()
+
+    async def on_timeout(self):
+        # A half-finished login is dropped rather than kept around
+        await super().on_timeout()
+        await self.websocket.close()
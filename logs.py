@@ -0,0 +1,195 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is written as a field
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: time, level, logger, message, then session/user/context/latency and any other extras
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Lets through at most `rate` records per second for each sampled event; the rest are counted, not written
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)  # event name -> records per second
+        self._buckets = {}  # event name -> (tokens, last refill)
+        self.suppressed = {}  # event name -> records dropped since the last one let through
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event)
+        if rate is None:
+            return True
+
+        now = time.monotonic()
+        tokens, last = self._buckets.get(event, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[event] = (tokens, now)
+            self.suppressed[event] = self.suppressed.get(event, 0) + 1
+            return False
+        self._buckets[event] = (tokens - 1, now)
+        # The next record through says how many it stands for
+        suppressed = self.suppressed.pop(event, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # The event loop only ever puts on the queue; when the writer falls behind, records are dropped instead of waiting
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the message and traceback now, while the arguments are current, but keep the extra fields
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingWriter:
+    # Background thread that drains the queue and writes records in batches, one write and flush per batch
+    def __init__(self, log_queue, stream, formatter, batch_size=100, flush_interval=0.5, close_stream=False):
+        self.queue = log_queue
+        self.stream = stream
+        self.close_stream = close_stream  # The stream is a log file opened for this writer, not stderr
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # Whatever is still queued is written before the thread exits
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        try:
+            self.stream.flush()
+            if self.close_stream:
+                self.stream.close()
+        except (OSError, ValueError):
+            pass
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # Take whatever else is already waiting, up to a batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception as e:
+                lines.append(json.dumps({'level': 'ERROR', 'logger': __name__,
+                                         'message': f"Unformattable log record: {e}"}))
+        if lines:
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+
+# The running pipeline, replaced by every setup_logging() call (each worker process sets up its own)
+_handler = None
+_writer = None
+
+
+def setup_logging(log_settings):
+    global _handler, _writer
+    stop_logging()
+
+    if log_settings.file:
+        stream = open(log_settings.file, 'a', encoding='utf-8')
+    else:
+        stream = sys.stderr
+    if log_settings.format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    log_queue = queue.Queue(maxsize=log_settings.queue_size)
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(SamplingFilter(log_settings.sample_rates))
+    _writer = BatchingWriter(log_queue, stream, formatter, log_settings.batch_size, log_settings.flush_interval,
+                             close_stream=bool(log_settings.file))
+    _writer.start()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    # Set on the root logger so records below the level are never even built
+    root.setLevel(log_settings.level.upper())
+    logging.getLogger('websockets').setLevel(log_settings.websockets_level.upper())
+    return _handler
+
+
+def stop_logging():
+    global _handler, _writer
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def logging_stats():
+    if _handler is None:
+        return {}
+    return {'queued': _handler.queue.qsize(), 'dropped': _handler.dropped}
+
+
+atexit.register(stop_logging)
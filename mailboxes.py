@@ -0,0 +1,169 @@
+import logging
+import time
+from database import get_db_pool, DatabaseError
+from connections import presence
+
+logger = logging.getLogger(__name__)
+
+
+class MessageStore:
+    # Every messages-table query in one place. Each backend's subclass holds its own SQL
+    backend = None
+    placeholder = None
+    queries = {}
+
+    async def count_unread(self, recipient):
+        async with get_db_pool().acquire() as connection:
+            row = await connection.fetchone(self.queries['count_unread'], (recipient,), prepared=True)
+        return row[0]
+
+    async def add(self, sender, recipient, body, mailbox_size):
+        # Stores the message unread and returns its id; the mailbox is trimmed in the same transaction
+        async with get_db_pool().acquire() as connection:
+            message_id = await connection.insert(self.queries['insert'], (sender, recipient, body, time.time()),
+                                                 prepared=True)
+            await self._trim(connection, recipient, mailbox_size)
+            await connection.commit()
+        return message_id
+
+    async def _trim(self, connection, recipient, mailbox_size):
+        # Keep each mailbox bounded by dropping whatever falls beyond the newest mailbox_size messages
+        oldest_kept = await connection.fetchone(self.queries['oldest_kept'], (recipient, mailbox_size - 1),
+                                                prepared=True)
+        if oldest_kept is not None:
+            await connection.execute(self.queries['trim'], (recipient, oldest_kept[0]), prepared=True)
+
+    async def fetch(self, recipient, page, page_size):
+        async with get_db_pool().acquire() as connection:
+            return await connection.fetchall(self.queries['fetch'], (recipient, page_size, (page - 1) * page_size),
+                                             prepared=True)
+
+    async def mark_delivered(self, message_id):
+        async with get_db_pool().acquire() as connection:
+            await connection.execute(self.queries['mark_delivered'], (message_id,), prepared=True)
+            await connection.commit()
+
+    async def mark_read(self, recipient, message_ids):
+        # The id list varies in length, so this one is built per call rather than prepared
+        placeholders = ', '.join([self.placeholder] * len(message_ids))
+        async with get_db_pool().acquire() as connection:
+            await connection.execute(self.queries['mark_read'].format(ids=placeholders), (recipient, *message_ids))
+            await connection.commit()
+
+
+class MySQLMessageStore(MessageStore):
+    backend = 'mysql'
+    placeholder = '%s'
+    queries = {
+        'count_unread': "SELECT COUNT(*) FROM messages WHERE recipient = %s AND is_read = 0",
+        'insert': "INSERT INTO messages (sender, recipient, body, sent_at, is_read) VALUES (%s, %s, %s, %s, 0)",
+        'oldest_kept': "SELECT id FROM messages WHERE recipient = %s ORDER BY sent_at DESC, id DESC LIMIT 1 OFFSET %s",
+        'trim': "DELETE FROM messages WHERE recipient = %s AND id < %s",
+        'fetch': "SELECT id, sender, body, sent_at, is_read FROM messages WHERE recipient = %s "
+                 "ORDER BY sent_at DESC, id DESC LIMIT %s OFFSET %s",
+        'mark_delivered': "UPDATE messages SET is_read = 1 WHERE id = %s",
+        'mark_read': "UPDATE messages SET is_read = 1 WHERE recipient = %s AND id IN ({ids})",
+    }
+
+
+class SQLiteMessageStore(MessageStore):
+    backend = 'sqlite'
+    placeholder = '?'
+    queries = {
+        'count_unread': "SELECT COUNT(*) FROM messages WHERE recipient = ? AND is_read = 0",
+        'insert': "INSERT INTO messages (sender, recipient, body, sent_at, is_read) VALUES (?, ?, ?, ?, 0)",
+        # SQLite takes LIMIT in a subquery, so the trim is a single statement
+        'trim': "DELETE FROM messages WHERE recipient = ?1 AND id < (SELECT id FROM messages WHERE recipient = ?1 "
+                "ORDER BY sent_at DESC, id DESC LIMIT 1 OFFSET ?2)",
+        'fetch': "SELECT id, sender, body, sent_at, is_read FROM messages WHERE recipient = ? "
+                 "ORDER BY sent_at DESC, id DESC LIMIT ? OFFSET ?",
+        'mark_delivered': "UPDATE messages SET is_read = 1 WHERE id = ?",
+        'mark_read': "UPDATE messages SET is_read = 1 WHERE recipient = ? AND id IN ({ids})",
+    }
+
+    async def _trim(self, connection, recipient, mailbox_size):
+        await connection.execute(self.queries['trim'], (recipient, mailbox_size - 1), prepared=True)
+
+
+MESSAGE_STORES = {store.backend: store for store in (MySQLMessageStore, SQLiteMessageStore)}
+
+# Shared store used by the messages context and login, created once by the server at startup
+message_store = None
+
+
+def init_message_store(backend=None):
+    # The backend defaults to the one the shared pool was opened with
+    global message_store
+    message_store = MESSAGE_STORES[backend or get_db_pool().backend.name]()
+    return message_store
+
+
+def get_message_store():
+    global message_store
+    if message_store is None:
+        message_store = init_message_store()
+    return message_store
+
+
+class UnreadCounters:
+    # Per-user unread counts kept in memory; a user's count is read from the database once, then kept current
+    def __init__(self):
+        self._counts = {}
+
+    async def get(self, username):
+        count = self._counts.get(username)
+        if count is None:
+            count = self._counts[username] = await get_message_store().count_unread(username)
+        return count
+
+    def increment(self, username):
+        # Users whose count was never loaded are skipped; the first get() counts the new message anyway
+        if username in self._counts:
+            self._counts[username] += 1
+
+    def decrement(self, username, count):
+        if username in self._counts:
+            self._counts[username] = max(0, self._counts[username] - count)
+
+    def forget(self, username):
+        self._counts.pop(username, None)
+
+
+unread_counters = UnreadCounters()
+
+
+async def send_message(sender, recipient, body, mailbox_size):
+    # Stored unread for the recipient's history; online players (on any worker) also get it straight away, and it
+    # is marked read only once it has actually been queued for them
+    store = get_message_store()
+    message_id = await store.add(sender, recipient, body, mailbox_size)
+    delivered = recipient in presence and await presence.send_to(recipient, f"[Message from {sender}] {body}")
+    if delivered:
+        await store.mark_delivered(message_id)
+    else:
+        unread_counters.increment(recipient)
+    return delivered
+
+
+async def fetch_messages(recipient, page, page_size):
+    return await get_message_store().fetch(recipient, page, page_size)
+
+
+async def mark_read(recipient, message_ids):
+    # Only the messages the player has just been shown; unread ones on other pages stay unread
+    if not message_ids:
+        return
+    await get_message_store().mark_read(recipient, message_ids)
+    unread_counters.decrement(recipient, len(message_ids))
+
+
+async def announce_unread(websocket, username):
+    # Sent at login; also loads the user's unread counter so the messages screen never has to count
+    try:
+        unread = await unread_counters.get(username)
+    except DatabaseError as e:
+        logger.error("Database error counting unread messages: %s", e, extra={'user': username})
+        return
+    if unread:
+        await websocket.send(f"You have {unread} unread message{'s' if unread != 1 else ''}. "
+                             f"Type 'messages' to read them.")
@@ -0,0 +1,125 @@
+import asyncio
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    # Cumulative latency counts, only ever updated from the event loop thread
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = buckets
+        self.calls = 0
+        self.total_time = 0.0
+        self.buckets = [0] * (len(buckets) + 1)
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.total_time += seconds
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+
+
+class Metrics:
+    # Server-wide counters and timings, read by the admin endpoint
+    def __init__(self):
+        self.counters = {}  # (name, label) -> count
+        self.histograms = {}  # name -> Histogram
+        self.loop_lag = 0.0  # Seconds the last lag probe woke up late
+        self.loop_lag_max = 0.0
+
+    def increment(self, name, label=None, amount=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+
+metrics = Metrics()
+
+
+def timed_call(func, *args):
+    # Runs on an executor thread; the caller records the time back on the loop, so histograms need no lock
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+async def monitor_loop_lag(interval=0.5):
+    # A sleep that wakes up late means something blocked the loop for that long
+    loop = asyncio.get_running_loop()
+    lag_histogram = metrics.histogram('event_loop_lag')
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.loop_lag = lag
+        metrics.loop_lag_max = max(metrics.loop_lag_max, lag)
+        lag_histogram.observe(lag)
+
+
+class SamplingProfiler:
+    # Samples the event loop thread's stack from a background thread, so it still sees a loop that is stuck
+    def __init__(self, interval=0.005, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = {}  # 'file:function:line;...' (outermost first) -> count
+        self.started_at = None
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        if self.running:
+            return
+        self._target = thread_id or threading.main_thread().ident
+        self.samples = {}
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def report(self, top=20):
+        # Hottest stacks first, one "count stack" line each (the collapsed format flame graph tools read)
+        total = sum(self.samples.values())
+        duration = time.monotonic() - self.started_at if self.started_at is not None else 0.0
+        lines = [f"# {total} samples over {duration:.1f}s"]
+        for stack, count in sorted(self.samples.items(), key=lambda item: item[1], reverse=True)[:top]:
+            lines.append(f"{count} {stack}")
+        return '\n'.join(lines) + '\n'
+
+
+profiler = SamplingProfiler()
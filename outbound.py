@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import websockets
+
+from metrics import metrics
+
+try:
+    from websockets.frames import Opcode
+    from websockets.legacy.protocol import WebSocketCommonProtocol
+except ImportError:  # Older websockets releases
+    Opcode = WebSocketCommonProtocol = None
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop', 'disconnect', 'block')
+
+# Every live session's writer, for the admin endpoint's per-session view
+active_writers = set()
+
+
+class SessionWriter:
+    # The session's only way to its socket. Contexts, flows and other sessions queue messages here, and one task
+    # writes them out in order, coalescing whatever is queued together into a single frame.
+    __slots__ = ('websocket', 'max_queue', 'policy', 'coalesce', 'max_frame_bytes', 'session_id', 'username',
+                 '_queue', '_wakeup', '_space', '_idle', '_task', 'closed',
+                 'max_depth', 'messages', 'frames', 'dropped', 'send_time', 'max_send_time')
+
+    def __init__(self, websocket, max_queue=256, policy='drop', coalesce=True, max_frame_bytes=16384,
+                 session_id=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.coalesce = coalesce
+        self.max_frame_bytes = max_frame_bytes
+        self.session_id = session_id
+        self.username = None
+
+        self._queue = deque()  # (UTF-8 payload, time queued, sent as its own frame)
+        self._wakeup = asyncio.Event()
+        # Set whenever the writer takes messages off the queue; only the 'block' policy waits for room
+        self._space = asyncio.Event() if policy == 'block' else None
+        self._idle = asyncio.Event()  # Set while nothing is queued or being written
+        self._idle.set()
+        self._task = None
+        self.closed = False
+
+        # Reported by stats()
+        self.max_depth = 0
+        self.messages = 0
+        self.frames = 0
+        self.dropped = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    # The parts of the websocket API the rest of the server uses
+
+    @property
+    def remote_address(self):
+        return self.websocket.remote_address
+
+    @property
+    def request_headers(self):
+        return self.websocket.request_headers
+
+    async def send(self, message):
+        # Under the 'block' policy the sender waits for room; that only ever slows down this session's own handler
+        if self.policy == 'block':
+            while len(self._queue) >= self.max_queue and not self.closed:
+                self._space.clear()
+                await self._space.wait()
+        self.send_nowait(message)
+
+    async def send_encoded(self, data):
+        # Pre-encoded UTF-8 text, e.g. a cached screen. It goes out as a frame of its own, never coalesced, so a
+        # pre-compressed copy can be sent in its place
+        if self.policy == 'block':
+            while len(self._queue) >= self.max_queue and not self.closed:
+                self._space.clear()
+                await self._space.wait()
+        self._enqueue(data, alone=True)
+
+    def send_nowait(self, message):
+        # For messages from other sessions, the bus and broadcasts, which must never wait on this player's socket
+        return self._enqueue(message.encode() if isinstance(message, str) else message)
+
+    async def flush(self, timeout=5.0):
+        # Wait until everything queued so far has been written, or the timeout passes
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def close(self, code=1000, reason='', timeout=5.0):
+        # Let what is already queued (e.g. a goodbye message) go out before the closing handshake
+        await self.flush(timeout)
+        await self.websocket.close(code, reason)
+
+    def fail_connection(self, code=1006, reason=''):
+        self._shutdown()
+        self.websocket.fail_connection(code, reason)
+
+    # The writer itself
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        active_writers.add(self)
+        return self
+
+    async def stop(self):
+        self._shutdown()
+        active_writers.discard(self)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _shutdown(self):
+        self.closed = True
+        self._queue.clear()
+        self._idle.set()
+        if self._space is not None:
+            self._space.set()
+
+    def _enqueue(self, data, alone=False):
+        if self.closed:
+            return False
+        if len(self._queue) >= self.max_queue:
+            if self.policy == 'disconnect':
+                metrics.increment('slow_consumers', 'disconnected')
+                logger.warning("Disconnecting slow consumer", extra={'session': self.session_id,
+                                                                      'user': self.username})
+                self.fail_connection(1008, "Not reading fast enough.")
+            else:
+                self.dropped += 1
+                metrics.increment('slow_consumers', 'dropped')
+            return False
+
+        self._queue.append((data, time.perf_counter(), alone))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._idle.clear()
+        self._wakeup.set()
+        return True
+
+    def _next_frame(self):
+        data, queued_at, alone = self._queue.popleft()
+        if not self.coalesce or alone or not self._queue:
+            return data, queued_at, 1
+        # Several small messages queued together become one frame, one line each
+        parts = [data]
+        size = len(data)
+        while self._queue and not self._queue[0][2] and size + 1 + len(self._queue[0][0]) <= self.max_frame_bytes:
+            size += 1 + len(self._queue[0][0])
+            parts.append(self._queue.popleft()[0])
+        return b'\n'.join(parts), queued_at, len(parts)
+
+    async def _write(self, data):
+        # write_frame() and ensure_open() are the legacy protocol's; anything else gets the string API
+        if Opcode is None or not isinstance(self.websocket, WebSocketCommonProtocol):
+            await self.websocket.send(data.decode())
+            return
+        await self.websocket.ensure_open()
+        await self.websocket.write_frame(True, Opcode.TEXT, data)
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue:
+                    data, queued_at, count = self._next_frame()
+                    if self._space is not None:
+                        self._space.set()
+                    # Blocks here, not in the sender, while the client's TCP window is full
+                    await self._write(data)
+
+                    elapsed = time.perf_counter() - queued_at
+                    self.messages += count
+                    self.frames += 1
+                    self.send_time += elapsed
+                    self.max_send_time = max(self.max_send_time, elapsed)
+                    metrics.observe('send', elapsed)
+                self._idle.set()
+        except (websockets.exceptions.ConnectionClosed, websockets.exceptions.InvalidState):
+            # The receive loop sees the close too and ends the session
+            self._shutdown()
+        except Exception:
+            # Nothing would write this session's messages any more, so end it rather than leave it looking alive;
+            # failing the connection ends the receive loop, which cleans up presence
+            logger.exception("Session writer failed", extra={'session': self.session_id, 'user': self.username})
+            self.fail_connection(1011, "Internal error.")
+
+    def stats(self):
+        return {
+            'session': self.session_id,
+            'user': self.username,
+            'policy': self.policy,
+            'queued': len(self._queue),
+            'max_depth': self.max_depth,
+            'messages': self.messages,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'mean_send_ms': self.send_time / self.frames * 1000 if self.frames else 0.0,
+            'max_send_ms': self.max_send_time * 1000,
+        }
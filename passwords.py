@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import metrics, timed_call
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    # bcrypt releases the GIL while hashing, so a small thread pool keeps it off the event loop
+    def __init__(self, workers=2, max_queue=32, rounds=12):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+        self._pending = 0  # Jobs running or queued on the executor
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    async def _submit(self, func, *args):
+        # Reject straight away instead of letting a login burst queue up unbounded work
+        if self._pending >= self.workers + self.max_queue:
+            self._rejected += 1
+            raise HasherBusy("Password hashing queue is full.")
+
+        self._pending += 1
+        try:
+            result, seconds = await asyncio.get_running_loop().run_in_executor(self.executor, timed_call, func, *args)
+        except Exception:
+            # e.g. a malformed stored hash
+            self._failed += 1
+            raise
+        finally:
+            self._pending -= 1
+        self._completed += 1
+        metrics.observe('bcrypt', seconds)
+        return result
+
+    async def hash(self, password):
+        salt = bcrypt.gensalt(rounds=self.rounds)
+        hashed = await self._submit(bcrypt.hashpw, password.encode(), salt)
+        return hashed.decode()
+
+    async def verify(self, password, hashed):
+        return await self._submit(bcrypt.checkpw, password.encode(), hashed.encode())
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like $2b$12$<salt+hash>, the middle field being the cost factor
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'rounds': self.rounds,
+            'pending': self._pending,
+            'completed': self._completed,
+            'failed': self._failed,
+            'rejected': self._rejected,
+        }
+
+
+# Shared hasher used by login and every context, created once by the server at startup
+password_hasher = None
+
+
+def init_password_hasher(**kwargs):
+    global password_hasher
+    password_hasher = PasswordHasher(**kwargs)
+    return password_hasher
+
+
+def get_password_hasher():
+    global password_hasher
+    if password_hasher is None:
+        password_hasher = PasswordHasher()
+    return password_hasher
+
+
+def close_password_hasher():
+    global password_hasher
+    if password_hasher is not None:
+        password_hasher.close()
+        password_hasher = None
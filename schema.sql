@@ -0,0 +1,10 @@
+-- Direct messages between players (contexts/c_messages.py)
+CREATE TABLE IF NOT EXISTS messages (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    sender VARCHAR(255) NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    body TEXT NOT NULL,
+    sent_at DOUBLE NOT NULL,
+    is_read TINYINT NOT NULL DEFAULT 0,
+    INDEX idx_messages_recipient_sent (recipient, sent_at)
+);
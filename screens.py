@@ -0,0 +1,120 @@
+import os
+import textwrap
+import time
+
+from compression import precompress
+
+try:
+    from websockets.frames import Opcode
+    from websockets.legacy.protocol import WebSocketCommonProtocol
+except ImportError:  # Older websockets releases
+    Opcode = WebSocketCommonProtocol = None
+
+DEFAULT_WIDTH = 80
+
+
+class Screen:
+    # A rendered screen kept both as text and as the UTF-8 payload of its websocket text frame
+    def __init__(self, text):
+        self.text = text
+        self.data = text.encode('utf-8')
+        precompress(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class _CacheEntry:
+    def __init__(self, screen, source, mtime):
+        self.screen = screen
+        self.source = source
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ScreenCache:
+    def __init__(self, check_interval=2.0):
+        # Source files are stat()ed at most once per interval, so a hot screen costs a dict lookup
+        self.check_interval = check_interval
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, render, width=DEFAULT_WIDTH, source=None):
+        key = (name, width)
+        entry = self._entries.get(key)
+        if entry is not None and entry.source == source and not self._is_stale(entry):
+            self.hits += 1
+            return entry.screen
+
+        self.misses += 1
+        mtime = _mtime(source) if source else None
+        screen = Screen(render(width))
+        self._entries[key] = _CacheEntry(screen, source, mtime)
+        return screen
+
+    def _is_stale(self, entry):
+        if entry.source is None:
+            return False
+        now = time.monotonic()
+        if now - entry.checked_at < self.check_interval:
+            return False
+        entry.checked_at = now
+        return _mtime(entry.source) != entry.mtime
+
+    def invalidate(self, name=None):
+        if name is None:
+            self._entries.clear()
+        else:
+            for key in [key for key in self._entries if key[0] == name]:
+                del self._entries[key]
+
+
+screen_cache = ScreenCache()
+
+
+def wrap_paragraphs(text, width=DEFAULT_WIDTH):
+    # Splitting the text into paragraphs and wrapping each paragraph
+    paragraphs = text.split('\n\n')
+    wrapped_paragraphs = [textwrap.fill(paragraph, width=width) for paragraph in paragraphs]
+
+    # Joining the paragraphs back together with two newlines as separator
+    return '\n\n'.join(wrapped_paragraphs)
+
+
+def render_file(path, width=DEFAULT_WIDTH, missing="File not found."):
+    try:
+        with open(path, 'r') as file:
+            return wrap_paragraphs(file.read(), width)
+    except FileNotFoundError:
+        return missing
+
+
+def render_command_list(available_commands):
+    lines = ["Available Commands:"]
+    lines.extend(f"- {cmd}: {description}" for cmd, description in available_commands.items())
+    return '\n'.join(lines) + '\n'
+
+
+def command_list_screen(name, available_commands):
+    return screen_cache.get(('commands', name), lambda _width: render_command_list(available_commands))
+
+
+async def send_screen(websocket, screen):
+    # Write the pre-encoded payload straight out as a text frame instead of re-encoding the string
+    send_encoded = getattr(websocket, 'send_encoded', None)
+    if send_encoded is not None:
+        await send_encoded(screen.data)
+        return
+    if Opcode is None or not isinstance(websocket, WebSocketCommonProtocol):
+        await websocket.send(screen.text)
+        return
+    await websocket.ensure_open()
+    await websocket.write_frame(True, Opcode.TEXT, screen.data)
@@ -1,56 +1,393 @@
+import argparse
 import asyncio
+import logging
+import multiprocessing
+import signal
+from http import HTTPStatus
 import websockets
-import ssl
-import configparser
-from context_manager import ContextManager
-from login import handle_authentication  # Updated import
-from connections import connected_users  # Import the connected_users dictionary
-
-
-# Function to load configuration
-def load_config():
-    config = configparser.ConfigParser()
-    config.read('config.ini')
-    registration = config.getboolean('Settings', 'Registration')
-    motd_enabled = config.getboolean('Settings', 'MOTD')
-    db_config = config['Database']
-    ssl_config = config['SSL']
-    server_config = config['Server']
-    messages = config['Messages']
-    return registration, motd_enabled, db_config, ssl_config, server_config, messages
+# The server runs on websockets' legacy asyncio implementation: SessionProtocol, the writer's write_frame() and the
+# handler's (websocket, path) signature all belong to it
+from websockets.legacy.server import WebSocketServerProtocol, serve
+from websockets.protocol import State
+from admin import start_admin_server
+from bus import Bus, line_limit, start_hub, attach_presence, attach_resume_tokens
+from context_manager import ContextManager, register_contexts
+from database import init_db_pool, close_db_pool
+from passwords import init_password_hasher, close_password_hasher
+from users import init_user_store
+from settings import load_settings, get_settings, install_reload_handler, watch_settings
+from limits import client_ip, get_limiter, init_limiter
+from login import AuthFlow
+from mailboxes import announce_unread, init_message_store, unread_counters
+from connections import presence
+from logs import setup_logging
+from outbound import SessionWriter, active_writers
+from sessions import RESUME_TOKEN_PREFIX, get_resume_tokens, init_resume_tokens
+from metrics import metrics, monitor_loop_lag, profiler
+from shutdown import drain, offer_handover, take_over, confirm_takeover
+import tls
+from compression import create_extensions, init_compression
+
+logger = logging.getLogger(__name__)
+
+# Tasks that run for the life of the server; shutdown() cancels them
+background_tasks = set()
+
+
+def start_background_task(coro, name):
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def stop_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class SessionProtocol(WebSocketServerProtocol):
+    # Counts every open connection, handshakes included, and turns new ones away with a 503 once the worker is
+    # full: before a session, its writer or any context object exists for them
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        get_limiter().open_connection()
+
+    def connection_lost(self, exc):
+        get_limiter().close_connection()
+        super().connection_lost(exc)
+
+    async def process_request(self, path, request_headers):
+        if get_limiter().over_capacity():
+            metrics.increment('connections_rejected', 'capacity')
+            return HTTPStatus.SERVICE_UNAVAILABLE, [('Retry-After', '30')], b"Server full, try again later.\n"
+        return None
+
+
+def serve_options(settings):
+    # serve() arguments shared by every listener
+    return {
+        'create_protocol': SessionProtocol,
+        'extensions': create_extensions(settings.compression),
+        # Otherwise websockets adds its own permessage-deflate to an empty extension list
+        'compression': 'deflate' if settings.compression.enabled else None,
+        # Pings find half-open connections the TCP layer would only notice much later
+        'ping_interval': settings.server.ping_interval or None,
+        'ping_timeout': settings.server.ping_timeout or None,
+    }
 
 
 async def server_handler(websocket, path):
-    registration, motd_enabled, db_config, ssl_config, server_config, messages = load_config()
+    # Settings are parsed once at startup; this is just a reference to the current snapshot
+    settings = get_settings()
+    limiter = get_limiter()
+    ip = client_ip(websocket)
 
-    while True:
-        player_context_manager = ContextManager(websocket, db_config, registration, messages)
+    # Sessions that haven't logged in yet are capped per address; each can cost a bcrypt check per attempt
+    if not limiter.enter_preauth(ip):
+        metrics.increment('connections_rejected', 'preauth_limit')
+        await websocket.close(1008, "Too many connections from your address.")
+        return
+    preauth = True
 
-        auth_status, action, username = await handle_authentication(websocket, db_config, registration)
+    # Everything the session sends goes through its writer; the raw websocket is only read from here
+    outbound = settings.outbound
+    writer = SessionWriter(websocket, max_queue=outbound.queue_size, policy=outbound.slow_consumer_policy,
+                           coalesce=outbound.coalesce, max_frame_bytes=outbound.max_frame_bytes).start()
+    player_context_manager = ContextManager(writer, settings.database, settings.registration, settings.messages)
+    writer.session_id = player_context_manager.session_id
 
-        if auth_status:
-            player_context_manager.username = username
-            await player_context_manager.set_context('c_lobby')
+    async def on_login(username, context=None):
+        nonlocal preauth
+        limiter.leave_preauth(ip)
+        preauth = False
+        player_context_manager.username = username
+        writer.username = username
+        await player_context_manager.set_context(context or 'c_lobby')
+        await announce_unread(writer, username)
+        # A fresh single-use token every login, so a dropped connection can come back without the password
+        if settings.sessions.resume_enabled:
+            await writer.send(f"{RESUME_TOKEN_PREFIX}{get_resume_tokens().issue(username, context)}")
+
+    # The single receive loop: every message goes to the active flow (login, password reset...) or the context
+    metrics.increment('sessions_opened')
+    await player_context_manager.start_flow(AuthFlow(writer, settings.registration, on_login))
+    bucket = limiter.connection_bucket()
+    dropped = 0  # Messages dropped in a row by the rate limit
+    # Logging in has a budget from connecting; after that, the session is closed once it goes quiet for too long
+    loop = asyncio.get_running_loop()
+    preauth_deadline = loop.time() + settings.server.preauth_timeout if settings.server.preauth_timeout else None
+    last_message = loop.time()
+    try:
+        while True:
+            if preauth:
+                deadline = preauth_deadline
+            else:
+                deadline = last_message + settings.server.idle_timeout if settings.server.idle_timeout else None
+            timeout = player_context_manager.step_timeout()
+            if deadline is not None:
+                remaining = max(0.0, deadline - loop.time())
+                timeout = remaining if timeout is None else min(timeout, remaining)
             try:
-                while True:
-                    message = await websocket.recv()
-                    await player_context_manager.handle_command(message)
-            except websockets.exceptions.ConnectionClosed:
-                print(f"Connection closed for {username}.")
-                if username in connected_users:
-                    del connected_users[username]  # Remove user from connected users
-                break
-        else:
-            await handle_authentication(websocket, db_config, registration)
+                message = await asyncio.wait_for(websocket.recv(), timeout)
+            except asyncio.TimeoutError:
+                if deadline is not None and loop.time() >= deadline:
+                    await close_inactive(writer, player_context_manager, preauth, settings)
+                    break
+                await player_context_manager.expire_flow()
+                continue
+            last_message = loop.time()
+
+            if not limiter.allow_message(bucket, ip):
+                dropped += 1
+                metrics.increment('messages_limited')
+                if dropped == 1:
+                    await writer.send("You are sending messages too quickly. Slow down.")
+                elif dropped >= settings.limits.disconnect_after:
+                    logger.warning("Closing flooding connection", extra=player_context_manager.log_fields(ip=ip))
+                    # No closing handshake: its reply would sit behind the flood in the incoming queue
+                    writer.fail_connection(1008, "Sending too fast.")
+                    break
+                continue
+            dropped = 0
+            if drain.stopping:
+                # Nothing new starts once a shutdown has begun; the notice has already gone out
+                await writer.send("The server is shutting down.")
+                continue
+            with drain.command():
+                await player_context_manager.handle_command(message)
+    except websockets.exceptions.ConnectionClosed as e:
+        logger.info("Connection closed", extra=player_context_manager.log_fields(
+            event='session_closed', code=e.rcvd.code if e.rcvd is not None else None))
+    finally:
+        # Every way out of the loop ends here, so presence can't keep a dead socket
+        if preauth:
+            limiter.leave_preauth(ip)
+        username = player_context_manager.username
+        if username is not None and presence.remove(username, writer):
+            unread_counters.forget(username)
+            # A resume lands in the context the player was last in; the token's TTL starts now
+            get_resume_tokens().release(username, player_context_manager.current_context_name)
+        await player_context_manager.close()
+        await writer.stop()
+        metrics.increment('sessions_closed')
+
+
+async def close_inactive(writer, player_context_manager, preauth, settings):
+    metrics.increment('sessions_timed_out', 'preauth' if preauth else 'idle')
+    logger.info("Closing inactive session", extra=player_context_manager.log_fields(
+        event='session_timeout', preauth=preauth))
+    if preauth:
+        await writer.send(AuthFlow.timeout_message)
+        await writer.close(1000, "Login timed out.")
+        return
+    await writer.send(settings.messages.get('idle_notice', "Disconnected after a long time without activity."))
+    # Like /quit, the session is over for good; coming back means logging in again
+    get_resume_tokens().revoke(player_context_manager.username)
+    await writer.close(1000, "Idle timeout.")
+
+
+async def init_services(settings, **pool_kwargs):
+    # Everything a worker shares between connections; pool_kwargs can swap in a stand-in database
+    register_contexts()
+    await init_db_pool(settings.database, **pool_kwargs)
+    init_password_hasher(workers=settings.passwords.hash_workers,
+                         max_queue=settings.passwords.hash_max_queue,
+                         rounds=settings.passwords.bcrypt_rounds)
+    limits = settings.limits
+    init_limiter(message_rate=limits.message_rate, message_burst=limits.message_burst,
+                 ip_message_rate=limits.ip_message_rate, ip_message_burst=limits.ip_message_burst,
+                 max_preauth_per_ip=limits.max_preauth_per_ip, free_login_failures=limits.free_login_failures,
+                 login_backoff_base=limits.login_backoff_base, login_backoff_max=limits.login_backoff_max,
+                 state_ttl=limits.state_ttl, max_tracked=limits.max_tracked,
+                 trusted_proxies=settings.ssl.trusted_proxies, max_connections=limits.max_connections)
+    init_compression(settings.compression)
+    init_resume_tokens(secret=settings.sessions.resume_secret, ttl=settings.sessions.resume_ttl,
+                       max_sessions=settings.sessions.resume_max_sessions)
+    init_message_store(settings.database.backend)
+    init_user_store(settings.database.backend, queries=settings.queries,
+                    cache_ttl=settings.database.lookup_cache_ttl,
+                    negative_cache_ttl=settings.database.lookup_cache_negative_ttl,
+                    cache_size=settings.database.lookup_cache_size)
 
 
 # Start the websocket server
-async def start_server():
-    _, _, _, ssl_config, server_config, _ = load_config()
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    ssl_context.load_cert_chain(ssl_config['certfile'], ssl_config['keyfile'])
-    async with websockets.serve(server_handler, server_config['host'], int(server_config['port']), ssl=ssl_context):
-        await asyncio.Future()
+async def start_server(config_file='config.ini', worker_id=None, bus_path=None, takeover=False):
+    settings = load_settings(config_file)
+    setup_logging(settings.logging)
+
+    # With --takeover, serve the running server's own listening sockets instead of binding new ones
+    handover_connection = None
+    admin_listeners = []
+    if takeover:
+        listeners, handover_connection = take_over(settings.server.handover_socket)
+        # The metrics port comes over with the game ports; tell them apart by port
+        admin_listeners = [listener for listener in listeners
+                           if listener.getsockname()[1] == settings.metrics.port]
+        listeners = [listener for listener in listeners if listener not in admin_listeners]
+        if not settings.metrics.enabled:
+            for listener in admin_listeners:
+                listener.close()
+
+    await init_services(settings)
+
+    # Pick up config.ini changes on SIGHUP or when the file is modified
+    install_reload_handler()
+    start_background_task(watch_settings(), 'settings-watcher')
+
+    # In multi-worker mode, share presence and message delivery with the other workers
+    bus = None
+    if bus_path is not None:
+        bus = Bus(worker_id, limit=line_limit(settings.outbound.max_frame_bytes))
+        await bus.connect(bus_path)
+        attach_presence(bus, presence)
+        attach_resume_tokens(bus, get_resume_tokens())
+
+    # Local metrics endpoint; each worker listens on its own port (port + worker id)
+    admin_servers = []
+    if settings.metrics.enabled:
+        profiler.interval = settings.metrics.profile_interval
+        admin_servers = await start_admin_server(settings.metrics.host, settings.metrics.port + (worker_id or 0),
+                                                 sockets=admin_listeners)
+        start_background_task(monitor_loop_lag(settings.metrics.loop_lag_interval), 'loop-lag-monitor')
+
+    # Workers forked from the master already have its context, so they share its session ticket key
+    ssl_context = tls.tls_context or tls.init_tls(settings.ssl)
+    options = serve_options(settings)
+    if handover_connection is not None:
+        servers = [await serve(server_handler, ssl=ssl_context, sock=listener, **options)
+                   for listener in listeners]
+        confirm_takeover(handover_connection)
+        logger.info("Took over %s listening sockets", len(listeners), extra={'event': 'handover'})
+    else:
+        servers = [await serve(server_handler, settings.server.host, settings.server.port,
+                               ssl=ssl_context, reuse_port=bus_path is not None, **options)]
+
+    # SIGTERM or SIGINT starts a graceful shutdown, and so does a replacement process taking over the sockets
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    if worker_id is None:
+        listening = [listener for server in (*servers, *admin_servers) for listener in server.sockets]
+        start_background_task(offer_handover(settings.server.handover_socket, listening, stop.set), 'handover')
+
+    await stop.wait()
+    for admin_server in admin_servers:
+        # After a handover the replacement serves metrics on the same socket
+        admin_server.close()
+    await shutdown(servers, get_settings())
+    if bus is not None:
+        await bus.close()
+
+
+async def shutdown(servers, settings):
+    # Stop accepting, tell every session, let commands in progress finish, then close connections and the pools
+    logger.info("Shutting down", extra={'event': 'shutdown', 'sessions': len(active_writers)})
+    drain.stopping = True
+    await stop_background_tasks()
+    for server in servers:
+        # Only this process's listener closes; after a handover the replacement keeps accepting on the same socket
+        server.server.close()
+
+    # Connections accepted just before are let through their handshake rather than refused with a 503
+    deadline = asyncio.get_running_loop().time() + settings.server.drain_timeout
+    while any(websocket.state is State.CONNECTING for server in servers for websocket in server.websockets):
+        if asyncio.get_running_loop().time() > deadline:
+            break
+        await asyncio.sleep(0.05)
+
+    notice = settings.messages.get('shutdown_notice', "The server is restarting. Please reconnect in a moment.")
+    writers = list(active_writers)
+    for writer in writers:
+        writer.send_nowait(notice)
+
+    if not await drain.wait(max(0.0, deadline - asyncio.get_running_loop().time())):
+        logger.warning("Shutting down with commands still in progress", extra=drain.stats())
+    if writers:
+        await asyncio.wait([asyncio.create_task(writer.flush()) for writer in writers])
+
+    # Closes every session with 1001 (going away) and waits for their handlers to finish
+    for server in servers:
+        server.close()
+    for server in servers:
+        await server.wait_closed()
+
+    await close_db_pool()
+    close_password_hasher()
+    logger.info("Shutdown complete", extra={'event': 'shutdown'})
+
+
+def run_worker(config_file, worker_id, bus_path):
+    try:
+        asyncio.run(start_server(config_file, worker_id, bus_path))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_workers(config_file, workers, bus_path):
+    setup_logging(get_settings().logging)
+    tls.init_tls(get_settings().ssl)
+    # Every worker listens on the same port (SO_REUSEPORT) and the kernel spreads connections between them
+    hub = await start_hub(bus_path, limit=line_limit(get_settings().outbound.max_frame_bytes))
+    processes = []
+    for worker_id in range(workers):
+        process = multiprocessing.Process(target=run_worker, args=(config_file, worker_id, bus_path),
+                                          name=f'uuu-worker-{worker_id}')
+        process.start()
+        processes.append(process)
+    logger.info("Started %s workers sharing %s", workers, bus_path)
+
+    # Run until every worker has exited or the master is told to stop, then have the workers shut down gracefully
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    workers_done = asyncio.gather(*(asyncio.to_thread(process.join) for process in processes))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait([workers_done, stopping], return_when=asyncio.FIRST_COMPLETED)
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()  # SIGTERM: each worker drains its own sessions
+    # Room for the drain plus the closing handshakes; a worker still running after that is killed
+    done, _ = await asyncio.wait([workers_done], timeout=get_settings().server.drain_timeout + 15)
+    if not done:
+        logger.warning("Killing workers that did not shut down in time")
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+        await workers_done
+    stopping.cancel()
+    hub.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='uuu websocket server')
+    parser.add_argument('--config', default='config.ini', help='path to config.ini')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes sharing the port (default: [Server] workers)')
+    parser.add_argument('--takeover', action='store_true',
+                        help='take over the listening socket of the server running on this config, which then '
+                             'drains and exits')
+    args = parser.parse_args()
+
+    settings = load_settings(args.config)
+    workers = args.workers if args.workers is not None else settings.server.workers
+    if args.takeover and workers > 1:
+        parser.error('--takeover needs a single process; workers share the port through SO_REUSEPORT instead')
+    try:
+        if workers > 1:
+            asyncio.run(run_workers(args.config, workers, settings.server.bus_socket))
+        else:
+            asyncio.run(start_server(args.config, takeover=args.takeover))
+    except KeyboardInterrupt:
+        pass
+
 
 # Run the server
-asyncio.run(start_server())
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+
+# Sent to the client after every login; a client that finds this prefix can reconnect with 'resume <token>'
+RESUME_TOKEN_PREFIX = 'Resume token: '
+
+# Used when no secret is configured. Workers forked from the master share it, so any of them can check a token
+_default_secret = secrets.token_bytes(32)
+
+
+class ResumeEntry:
+    __slots__ = ('username', 'context', 'expires_at')
+
+    def __init__(self, username, context, expires_at):
+        self.username = username
+        self.context = context
+        self.expires_at = expires_at  # None while the session is still connected
+
+
+class ResumeTokens:
+    # Signed, single-use tokens that let a dropped player reconnect without the login prompt or bcrypt.
+    # A token is '<id>.<signature>': the HMAC rejects forged or altered tokens before any lookup, and the table
+    # holds what the token stands for (player, last context, expiry), so it can be revoked or rotated.
+    # The TTL runs from the disconnect, not the login: a token is kept for as long as its session is connected,
+    # then for ttl seconds in the bounded table of disconnected sessions.
+    def __init__(self, secret=None, ttl=3600.0, max_sessions=10000):
+        self.secret = secret.encode() if isinstance(secret, str) and secret else (secret or _default_secret)
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._live = {}  # token id -> ResumeEntry of a connected session
+        self._entries = OrderedDict()  # token id -> ResumeEntry of a disconnected session, soonest expiry first
+        self._by_user = {}  # username -> token id
+        self.bus = None  # Set in multi-worker mode so a player can resume on any worker
+
+        # Counters reported by stats()
+        self._issued = 0
+        self._resumed = 0
+        self._rejected = 0
+        self._evicted = 0
+
+    def _sign(self, token_id):
+        digest = hmac.new(self.secret, token_id.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def _store(self, token_id, username, context):
+        self._remove_user(username)
+        self._live[token_id] = ResumeEntry(username, context, None)
+        self._by_user[username] = token_id
+
+    def _release(self, username, context, expires_at):
+        # The session has ended: from now on its token expires, and it joins the bounded table
+        token_id = self._by_user.get(username)
+        if token_id is None:
+            return
+        entry = self._live.pop(token_id, None) or self._entries.pop(token_id, None)
+        if entry is None:
+            return
+        entry.context = context
+        entry.expires_at = expires_at
+        self._entries[token_id] = entry
+        self._evict()
+
+    def _evict(self):
+        # Entries are appended as sessions end, so expired ones collect at the front; so does anything beyond
+        # the limit
+        now = time.time()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at >= now and len(self._entries) <= self.max_sessions:
+                break
+            self._entries.popitem(last=False)
+            self._by_user.pop(entry.username, None)
+            self._evicted += 1
+
+    def _remove_user(self, username):
+        token_id = self._by_user.pop(username, None)
+        if token_id is not None:
+            self._live.pop(token_id, None)
+            self._entries.pop(token_id, None)
+
+    def issue(self, username, context=None):
+        # Replaces any earlier token for the player
+        token_id = secrets.token_urlsafe(16)
+        self._store(token_id, username, context)
+        self._issued += 1
+        if self.bus is not None:
+            self.bus.publish('resume_issue', id=token_id, user=username, context=context)
+        return f"{token_id}.{self._sign(token_id)}"
+
+    def resume(self, token):
+        # (username, last context) for a valid token, which is used up; None otherwise
+        try:
+            token_id, signature = token.strip().split('.')
+        except ValueError:
+            self._rejected += 1
+            return None
+        if not hmac.compare_digest(signature, self._sign(token_id)):
+            self._rejected += 1
+            return None
+
+        # A session still connected can be taken over: the server may not have noticed the drop yet
+        entry = self._live.pop(token_id, None) or self._entries.pop(token_id, None)
+        if entry is None or (entry.expires_at is not None and entry.expires_at < time.time()):
+            # Used already, revoked, expired, or evicted to make room
+            if entry is not None:
+                self._by_user.pop(entry.username, None)
+            self._rejected += 1
+            return None
+        self._by_user.pop(entry.username, None)
+        self._resumed += 1
+        if self.bus is not None:
+            self.bus.publish('resume_revoke', user=entry.username)
+        return entry.username, entry.context
+
+    def release(self, username, context):
+        # Called when a session ends: a resume puts the player back where they were, for up to ttl seconds
+        expires_at = time.time() + self.ttl
+        self._release(username, context, expires_at)
+        if self.bus is not None:
+            self.bus.publish('resume_release', user=username, context=context, expires=expires_at)
+
+    def revoke(self, username):
+        # After /quit or a password change the old token must not bring the session back
+        self._remove_user(username)
+        if self.bus is not None:
+            self.bus.publish('resume_revoke', user=username)
+
+    def stats(self):
+        return {
+            'sessions': len(self._live) + len(self._entries),
+            'issued': self._issued,
+            'resumed': self._resumed,
+            'rejected': self._rejected,
+            'evicted': self._evicted,
+        }
+
+
+# Shared token table used by login and every session, created once by the server at startup
+resume_tokens = None
+
+
+def init_resume_tokens(**kwargs):
+    global resume_tokens
+    resume_tokens = ResumeTokens(**kwargs)
+    return resume_tokens
+
+
+def get_resume_tokens():
+    global resume_tokens
+    if resume_tokens is None:
+        resume_tokens = ResumeTokens()
+    return resume_tokens
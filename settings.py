@@ -0,0 +1,346 @@
+import asyncio
+import configparser
+import logging
+import os
+import signal
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
+CONFIG_FILE = 'config.ini'
+
+logger = logging.getLogger(__name__)
+
+# Records per second let through for high-volume log events; the rest are counted and skipped
+DEFAULT_SAMPLE_RATES = {'context_switch': 20.0, 'command': 50.0}
+
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    host: str
+    user: str
+    password: str
+    database: str  # The database name, or the database file for the sqlite backend
+    backend: str = 'mysql'  # mysql (MariaDB or MySQL) or sqlite
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_acquire_timeout: float = 5.0
+    pool_health_check_interval: float = 30.0
+    lookup_cache_ttl: float = 30.0
+    lookup_cache_negative_ttl: float = 5.0
+    lookup_cache_size: int = 10000
+
+
+@dataclass(frozen=True)
+class PasswordSettings:
+    hash_workers: int = 2
+    hash_max_queue: int = 32
+    bcrypt_rounds: int = 12
+
+
+@dataclass(frozen=True)
+class SSLSettings:
+    certfile: str
+    keyfile: str
+    min_version: str = '1.3'
+    ciphers: str = 'ECDHE+AESGCM:ECDHE+CHACHA20'  # For TLS 1.2 clients, if min_version allows them
+    session_tickets: bool = True
+    plaintext: bool = False  # TLS is terminated by a local proxy; serve plain ws:// behind it
+    trusted_proxies: Tuple[str, ...] = ('127.0.0.1', '::1')  # Whose X-Forwarded-For gives the client address
+
+
+@dataclass(frozen=True)
+class ServerSettings:
+    host: str
+    port: int
+    flow_step_timeout: float = 60.0
+    workers: int = 1
+    bus_socket: str = '/tmp/uuu-server-bus.sock'
+    drain_timeout: float = 30.0  # How long a shutdown waits for commands in progress
+    handover_socket: str = '/tmp/uuu-server-handover.sock'
+    ping_interval: float = 20.0  # Keepalive pings that find half-open connections; 0 turns them off
+    ping_timeout: float = 20.0
+    idle_timeout: float = 1800.0  # Logged-in sessions that send nothing for this long are closed; 0 for never
+    preauth_timeout: float = 120.0  # Time allowed from connecting to logging in; 0 for no limit
+
+
+@dataclass(frozen=True)
+class OutboundSettings:
+    queue_size: int = 256
+    slow_consumer_policy: str = 'drop'  # drop, disconnect or block
+    coalesce: bool = True
+    max_frame_bytes: int = 16384
+
+
+@dataclass(frozen=True)
+class CompressionSettings:
+    enabled: bool = True
+    min_size: int = 256  # Messages shorter than this go uncompressed
+    window_bits: int = 12
+    client_window_bits: int = 12
+    level: int = 6
+    mem_level: int = 5
+    context_takeover: bool = True  # Off: more CPU and bytes per message, no compressor kept per session
+    precompress_screens: bool = False  # Needs context_takeover = False
+
+
+@dataclass(frozen=True)
+class LimitSettings:
+    message_rate: float = 10.0
+    message_burst: int = 30
+    ip_message_rate: float = 50.0
+    ip_message_burst: int = 150
+    disconnect_after: int = 50  # Messages dropped in a row before a flooding connection is closed
+    max_preauth_per_ip: int = 10
+    max_connections: int = 10000  # Per worker, handshakes included; further connections get a 503. 0 for no cap
+    free_login_failures: int = 3
+    login_backoff_base: float = 1.0
+    login_backoff_max: float = 300.0
+    state_ttl: float = 900.0
+    max_tracked: int = 100000
+
+
+@dataclass(frozen=True)
+class SessionSettings:
+    resume_enabled: bool = True
+    resume_secret: str = ''  # Empty for a random secret per server start; set it so tokens survive a restart
+    resume_ttl: float = 3600.0
+    resume_max_sessions: int = 10000
+
+
+@dataclass(frozen=True)
+class MetricsSettings:
+    enabled: bool = False
+    host: str = '127.0.0.1'
+    port: int = 9450
+    loop_lag_interval: float = 0.5
+    profile_interval: float = 0.005
+
+
+@dataclass(frozen=True)
+class LoggingSettings:
+    level: str = 'INFO'
+    websockets_level: str = 'WARNING'  # The websockets library logs every connection at INFO
+    format: str = 'json'
+    file: str = ''  # Empty for stderr
+    batch_size: int = 100
+    flush_interval: float = 0.5
+    queue_size: int = 10000
+    sample_rates: Mapping[str, float] = field(default_factory=lambda: MappingProxyType(dict(DEFAULT_SAMPLE_RATES)))
+
+
+@dataclass(frozen=True)
+class Settings:
+    registration: bool
+    motd_enabled: bool
+    screen_width: int
+    mailbox_size: int
+    mailbox_page_size: int
+    messages: Mapping[str, str]
+    database: DatabaseSettings
+    passwords: PasswordSettings
+    queries: Mapping[str, str]
+    ssl: SSLSettings
+    server: ServerSettings
+    outbound: OutboundSettings = OutboundSettings()
+    compression: CompressionSettings = CompressionSettings()
+    limits: LimitSettings = LimitSettings()
+    sessions: SessionSettings = SessionSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    logging: LoggingSettings = LoggingSettings()
+    path: str = CONFIG_FILE
+    mtime: float = 0.0
+
+
+def _section(config, name):
+    return config[name] if config.has_section(name) else config[configparser.DEFAULTSECT]
+
+
+def parse_settings(path=CONFIG_FILE):
+    # No interpolation, so '%s' placeholders in [DatabaseQueries] are read verbatim
+    config = configparser.ConfigParser(interpolation=None)
+    with open(path) as file:
+        mtime = os.fstat(file.fileno()).st_mtime
+        config.read_file(file)
+
+    database = config['Database']
+    passwords = _section(config, 'Passwords')
+    outbound = _section(config, 'Outbound')
+    compression = _section(config, 'Compression')
+    limits = _section(config, 'Limits')
+    sessions = _section(config, 'Sessions')
+    metrics = _section(config, 'Metrics')
+    logs = _section(config, 'Logging')
+    return Settings(
+        registration=config.getboolean('Settings', 'Registration'),
+        motd_enabled=config.getboolean('Settings', 'MOTD'),
+        screen_width=config.getint('Settings', 'screen_width', fallback=80),
+        mailbox_size=config.getint('Messages', 'mailbox_size', fallback=100),
+        mailbox_page_size=config.getint('Messages', 'mailbox_page_size', fallback=10),
+        messages=MappingProxyType(dict(config['Messages'])),
+        database=DatabaseSettings(
+            # Only the mysql backend connects to a server
+            host=database.get('host', 'localhost'),
+            user=database.get('user', ''),
+            password=database.get('password', ''),
+            database=database['database'],
+            backend=database.get('backend', 'mysql'),
+            pool_min_size=database.getint('pool_min_size', 1),
+            pool_max_size=database.getint('pool_max_size', 10),
+            pool_acquire_timeout=database.getfloat('pool_acquire_timeout', 5.0),
+            pool_health_check_interval=database.getfloat('pool_health_check_interval', 30.0),
+            lookup_cache_ttl=database.getfloat('lookup_cache_ttl', 30.0),
+            lookup_cache_negative_ttl=database.getfloat('lookup_cache_negative_ttl', 5.0),
+            lookup_cache_size=database.getint('lookup_cache_size', 10000),
+        ),
+        passwords=PasswordSettings(
+            hash_workers=passwords.getint('hash_workers', 2),
+            hash_max_queue=passwords.getint('hash_max_queue', 32),
+            bcrypt_rounds=passwords.getint('bcrypt_rounds', 12),
+        ),
+        queries=MappingProxyType(dict(_section(config, 'DatabaseQueries'))),
+        ssl=SSLSettings(
+            certfile=config.get('SSL', 'certfile', fallback=''),
+            keyfile=config.get('SSL', 'keyfile', fallback=''),
+            min_version=config.get('SSL', 'min_version', fallback='1.3'),
+            ciphers=config.get('SSL', 'ciphers', fallback='ECDHE+AESGCM:ECDHE+CHACHA20'),
+            session_tickets=config.getboolean('SSL', 'session_tickets', fallback=True),
+            plaintext=config.getboolean('SSL', 'plaintext', fallback=False),
+            trusted_proxies=tuple(address.strip() for address in
+                                  config.get('SSL', 'trusted_proxies', fallback='127.0.0.1, ::1').split(',')
+                                  if address.strip()),
+        ),
+        server=ServerSettings(
+            host=config['Server']['host'],
+            port=config.getint('Server', 'port'),
+            flow_step_timeout=config.getfloat('Server', 'flow_step_timeout', fallback=60.0),
+            workers=config.getint('Server', 'workers', fallback=1),
+            bus_socket=config.get('Server', 'bus_socket', fallback='/tmp/uuu-server-bus.sock'),
+            drain_timeout=config.getfloat('Server', 'drain_timeout', fallback=30.0),
+            handover_socket=config.get('Server', 'handover_socket', fallback='/tmp/uuu-server-handover.sock'),
+            ping_interval=config.getfloat('Server', 'ping_interval', fallback=20.0),
+            ping_timeout=config.getfloat('Server', 'ping_timeout', fallback=20.0),
+            idle_timeout=config.getfloat('Server', 'idle_timeout', fallback=1800.0),
+            preauth_timeout=config.getfloat('Server', 'preauth_timeout', fallback=120.0),
+        ),
+        outbound=OutboundSettings(
+            queue_size=outbound.getint('queue_size', 256),
+            slow_consumer_policy=outbound.get('slow_consumer_policy', 'drop'),
+            coalesce=outbound.getboolean('coalesce', True),
+            max_frame_bytes=outbound.getint('max_frame_bytes', 16384),
+        ),
+        compression=CompressionSettings(
+            enabled=compression.getboolean('enabled', True),
+            min_size=compression.getint('min_size', 256),
+            window_bits=compression.getint('window_bits', 12),
+            client_window_bits=compression.getint('client_window_bits', 12),
+            level=compression.getint('level', 6),
+            mem_level=compression.getint('mem_level', 5),
+            context_takeover=compression.getboolean('context_takeover', True),
+            precompress_screens=compression.getboolean('precompress_screens', False),
+        ),
+        limits=LimitSettings(
+            message_rate=limits.getfloat('message_rate', 10.0),
+            message_burst=limits.getint('message_burst', 30),
+            ip_message_rate=limits.getfloat('ip_message_rate', 50.0),
+            ip_message_burst=limits.getint('ip_message_burst', 150),
+            disconnect_after=limits.getint('disconnect_after', 50),
+            max_preauth_per_ip=limits.getint('max_preauth_per_ip', 10),
+            max_connections=limits.getint('max_connections', 10000),
+            free_login_failures=limits.getint('free_login_failures', 3),
+            login_backoff_base=limits.getfloat('login_backoff_base', 1.0),
+            login_backoff_max=limits.getfloat('login_backoff_max', 300.0),
+            state_ttl=limits.getfloat('state_ttl', 900.0),
+            max_tracked=limits.getint('max_tracked', 100000),
+        ),
+        sessions=SessionSettings(
+            resume_enabled=sessions.getboolean('resume_enabled', True),
+            resume_secret=sessions.get('resume_secret', ''),
+            resume_ttl=sessions.getfloat('resume_ttl', 3600.0),
+            resume_max_sessions=sessions.getint('resume_max_sessions', 10000),
+        ),
+        metrics=MetricsSettings(
+            enabled=metrics.getboolean('enabled', False),
+            host=metrics.get('host', '127.0.0.1'),
+            port=metrics.getint('port', 9450),
+            loop_lag_interval=metrics.getfloat('loop_lag_interval', 0.5),
+            profile_interval=metrics.getfloat('profile_interval', 0.005),
+        ),
+        logging=LoggingSettings(
+            level=logs.get('level', 'INFO'),
+            websockets_level=logs.get('websockets_level', 'WARNING'),
+            format=logs.get('format', 'json'),
+            file=logs.get('file', ''),
+            batch_size=logs.getint('batch_size', 100),
+            flush_interval=logs.getfloat('flush_interval', 0.5),
+            queue_size=logs.getint('queue_size', 10000),
+            # sample_<event> = records per second, e.g. sample_context_switch = 20
+            sample_rates=MappingProxyType({**DEFAULT_SAMPLE_RATES,
+                                           **{key[len('sample_'):]: float(value) for key, value in logs.items()
+                                              if key.startswith('sample_')}}),
+        ),
+        path=path,
+        mtime=mtime,
+    )
+
+
+# The current settings; replaced wholesale on reload so readers never see a half-updated object
+_settings = None
+
+
+def load_settings(path=CONFIG_FILE):
+    global _settings
+    _settings = parse_settings(path)
+    return _settings
+
+
+def get_settings():
+    if _settings is None:
+        return load_settings()
+    return _settings
+
+
+def reload_settings():
+    global _settings
+    path = _settings.path if _settings else CONFIG_FILE
+    try:
+        new_settings = parse_settings(path)
+    except (OSError, KeyError, ValueError, configparser.Error) as e:
+        # Keep serving with the old settings rather than half-applying a broken file
+        logger.error("Error reloading %s, keeping previous settings: %s", path, e)
+        return _settings
+    _settings = new_settings
+    logger.info("Reloaded settings from %s", path)
+    return _settings
+
+
+async def _reload_in_thread():
+    await asyncio.to_thread(reload_settings)
+
+
+def install_reload_handler():
+    # SIGHUP reloads the config file; not available on Windows
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(_reload_in_thread()))
+    except (AttributeError, NotImplementedError):
+        pass
+
+
+async def watch_settings(interval=5.0):
+    # Polls the file's mtime in the background so the request path never touches the disk. Each mtime is tried
+    # once: after an edit that fails to parse, the old snapshot stays in place until the file changes again
+    last_mtime = get_settings().mtime
+    while True:
+        await asyncio.sleep(interval)
+        settings = get_settings()
+        try:
+            mtime = (await asyncio.to_thread(os.stat, settings.path)).st_mtime
+        except OSError:
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        # A SIGHUP may have loaded this version already
+        if mtime != settings.mtime:
+            await _reload_in_thread()
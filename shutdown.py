@@ -0,0 +1,95 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+HANDOVER_READY = b'ready'
+MAX_LISTENERS = 16
+
+
+class Drain:
+    # Commands being handled right now. A shutdown waits for them, so a registration or password change is never
+    # cut off between its queries, and refuses to start new ones
+    def __init__(self):
+        self.stopping = False
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextlib.contextmanager
+    def command(self):
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def wait(self, timeout):
+        # True once nothing is in flight, False if the deadline passed first
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self):
+        return {'stopping': self.stopping, 'in_flight': self._in_flight}
+
+
+# Shared by every session in the process
+drain = Drain()
+
+
+async def offer_handover(path, listeners, on_handover):
+    # The running server waits here for a replacement started with --takeover. The listening sockets are passed
+    # over the Unix socket (SCM_RIGHTS), so both processes accept on them until the new one says it is serving;
+    # then this one stops accepting and drains. The kernel never sees the port closed. Cancelling the task closes
+    # the handover socket; the path is left alone, since a replacement may already have bound its own there
+    if os.path.exists(path):
+        os.unlink(path)
+    loop = asyncio.get_running_loop()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen(1)
+        server.setblocking(False)
+        while True:
+            connection, _ = await loop.sock_accept(server)
+            with connection:
+                try:
+                    socket.send_fds(connection, [b'uuu'], [listener.fileno() for listener in listeners])
+                    reply = await loop.sock_recv(connection, len(HANDOVER_READY))
+                except OSError as e:
+                    logger.warning("Socket handover failed: %s", e)
+                    continue
+            if reply == HANDOVER_READY:
+                logger.info("Listening sockets handed over to a new process", extra={'event': 'handover'})
+                on_handover()
+                return
+            logger.warning("Replacement process went away before serving; still accepting")
+
+
+def take_over(path):
+    # Called by the replacement at startup: the running server's listening sockets (the metrics endpoint's too, if
+    # it has one), and the connection to tell it when they are being served
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        _, fds, _, _ = socket.recv_fds(connection, 16, MAX_LISTENERS)
+    except OSError:
+        connection.close()
+        raise
+    if not fds:
+        connection.close()
+        raise OSError(f"No listening sockets received from {path}")
+    return [socket.socket(fileno=fd) for fd in fds], connection
+
+
+def confirm_takeover(connection):
+    with connection:
+        connection.sendall(HANDOVER_READY)
@@ -0,0 +1,35 @@
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+
+from compression import SelectivePerMessageDeflate
+
+
+def deflate(min_size=64):
+    return SelectivePerMessageDeflate(False, False, 15, 15, min_size=min_size)
+
+
+def test_short_message_is_sent_uncompressed():
+    frame = deflate().encode(Frame(Opcode.TEXT, b'hello'))
+    assert not frame.rsv1
+    assert frame.data == b'hello'
+
+
+def test_long_message_is_compressed_and_decodes():
+    data = b'The quick brown fox jumps over the lazy dog. ' * 20
+    frame = deflate().encode(Frame(Opcode.TEXT, data))
+    assert frame.rsv1
+    assert len(frame.data) < len(data)
+    assert PerMessageDeflate(False, False, 15, 15).decode(frame).data == data
+
+
+def test_continuation_follows_the_first_frame():
+    extension = deflate()
+    first = extension.encode(Frame(Opcode.TEXT, b'short', fin=False))
+    rest = extension.encode(Frame(Opcode.CONT, b'x' * 200))
+    assert not first.rsv1
+    assert rest.data == b'x' * 200
+
+
+def test_control_frames_pass_through():
+    ping = Frame(Opcode.PING, b'ping')
+    assert deflate().encode(ping) is ping
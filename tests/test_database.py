@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from database import DatabasePool, PoolTimeout, QueryError, SQLiteBackend
+from settings import DatabaseSettings
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rollbacks = 0
+        self.closed = False
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBackend:
+    name = 'fake'
+    max_connections = None
+    errors = ()
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self):
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
+
+    @staticmethod
+    def is_healthy(connection):
+        return True
+
+
+def sqlite_pool(tmp_path):
+    return DatabasePool(SQLiteBackend(DatabaseSettings(host='', user='', password='', backend='sqlite',
+                                                       database=str(tmp_path / 'test.db'))))
+
+
+def test_connection_is_rolled_back_before_reuse():
+    async def run():
+        pool = DatabasePool(FakeBackend(), min_size=1, max_size=1)
+        await pool.start()
+        async with pool.acquire() as first:
+            pass
+        async with pool.acquire() as second:
+            assert second.connection is first.connection
+        await pool.close()
+        return first.connection
+
+    connection = asyncio.run(run())
+    assert connection.rollbacks == 2
+    assert connection.closed
+
+
+def test_failed_borrow_discards_the_connection():
+    async def run():
+        pool = DatabasePool(FakeBackend(), max_size=1)
+        with pytest.raises(RuntimeError):
+            async with pool.acquire():
+                raise RuntimeError("query failed")
+        stats = pool.stats()
+        await pool.close()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats['size'] == 0
+    assert stats['discarded'] == 1
+
+
+def test_acquire_times_out_when_the_pool_is_exhausted():
+    async def run():
+        pool = DatabasePool(FakeBackend(), max_size=1, acquire_timeout=0.05)
+        async with pool.acquire():
+            with pytest.raises(PoolTimeout):
+                async with pool.acquire():
+                    pass
+        stats = pool.stats()
+        await pool.close()
+        return stats
+
+    assert asyncio.run(run())['timeouts'] == 1
+
+
+def test_sqlite_queries_and_errors(tmp_path):
+    async def run():
+        pool = sqlite_pool(tmp_path)
+        await pool.start()
+        async with pool.acquire() as connection:
+            user_id = await connection.insert("INSERT INTO users (email, username, password) VALUES (?, ?, ?)",
+                                              ('a@example.com', 'alice', 'hash'))
+            await connection.commit()
+            row = await connection.fetchone("SELECT username FROM users WHERE id = ?", (user_id,), prepared=True)
+        with pytest.raises(QueryError):
+            async with pool.acquire() as connection:
+                await connection.execute("SELECT * FROM no_such_table")
+        await pool.close()
+        return row
+
+    assert asyncio.run(run()) == ('alice',)
+
+
+def test_uncommitted_writes_are_not_left_open(tmp_path):
+    async def run():
+        pool = sqlite_pool(tmp_path)
+        await pool.start()
+        async with pool.acquire() as connection:
+            await connection.execute("INSERT INTO users (email, username, password) VALUES (?, ?, ?)",
+                                     ('b@example.com', 'bob', 'hash'))
+        async with pool.acquire() as connection:
+            row = await connection.fetchone("SELECT COUNT(*) FROM users")
+        await pool.close()
+        return row
+
+    assert asyncio.run(run()) == (0,)
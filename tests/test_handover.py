@@ -0,0 +1,66 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from test_server import write_config
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def fetch_metrics(port):
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=2) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def start(config, *args):
+    return subprocess.Popen([sys.executable, 'server_auth.py', '--config', config, *args], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def test_takeover_with_metrics_enabled(tmp_path):
+    # The metrics port is handed over with the game port, so the replacement does not try to bind it again
+    game_port, metrics_port = free_port(), free_port()
+    handover_socket = tmp_path / 'handover.sock'
+    config = write_config(tmp_path, f"\n[Metrics]\nenabled = True\nport = {metrics_port}\n")
+    with open(config) as file:
+        text = file.read().replace('keyfile =', 'keyfile =\nplaintext = True')
+        text = text.replace('port = 0', f'port = {game_port}\nhandover_socket = {handover_socket}\ndrain_timeout = 1')
+    with open(config, 'w') as file:
+        file.write(text)
+
+    old = start(config)
+    new = None
+    try:
+        assert wait_for(lambda: handover_socket.exists() and fetch_metrics(metrics_port))
+        new = start(config, '--takeover')
+        assert old.wait(timeout=15) == 0, old.stderr.read().decode()
+        assert new.poll() is None, new.stderr.read().decode()
+        assert fetch_metrics(metrics_port)
+        with socket.create_connection(('127.0.0.1', game_port), timeout=2):
+            pass
+    finally:
+        for process in (old, new):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait(timeout=15)
@@ -0,0 +1,80 @@
+import time
+
+import limits
+from limits import ExpiringTable, Limiter, TokenBucket, client_ip
+
+
+class FakeWebSocket:
+    def __init__(self, address, forwarded=None):
+        self.remote_address = (address, 1234)
+        self.request_headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+    assert all(bucket.take(0.0) for _ in range(3))
+    assert not bucket.take(0.0)
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+
+
+def test_expiring_table_forgets_old_and_excess_entries():
+    table = ExpiringTable(ttl=10, max_entries=2)
+    table.set('a', 1, now=0)
+    assert table.get('a', now=5) == 1
+    assert table.get('a', now=10) is None
+    table.set('b', 2, now=1)
+    table.set('c', 3, now=2)
+    table.set('d', 4, now=3)
+    assert len(table) == 2
+    assert table.get('b', now=3) is None
+
+
+def test_login_backoff_after_the_free_failures(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    limiter = Limiter(free_login_failures=2, login_backoff_base=1.0, login_backoff_max=4.0)
+    for _ in range(2):
+        limiter.login_failed('10.0.0.1', 'alice')
+    assert limiter.login_blocked_for('10.0.0.1', 'alice') == 0.0
+
+    delays = []
+    for _ in range(4):
+        limiter.login_failed('10.0.0.1', 'alice')
+        delays.append(limiter.login_blocked_for('10.0.0.1', 'alice'))
+    assert delays == [1.0, 2.0, 4.0, 4.0]
+
+    # A success clears the account, but the address keeps its record
+    limiter.login_succeeded('alice')
+    assert limiter.login_blocked_for('10.0.0.2', 'alice') == 0.0
+    assert limiter.login_blocked_for('10.0.0.1', 'bob') == 4.0
+
+
+def test_preauth_sessions_are_capped_per_address():
+    limiter = Limiter(max_preauth_per_ip=2)
+    assert limiter.enter_preauth('10.0.0.1')
+    assert limiter.enter_preauth('10.0.0.1')
+    assert not limiter.enter_preauth('10.0.0.1')
+    assert limiter.enter_preauth('10.0.0.2')
+    limiter.leave_preauth('10.0.0.1')
+    assert limiter.enter_preauth('10.0.0.1')
+    assert limiter.stats()['preauth_rejected'] == 1
+
+
+def test_message_rate_is_limited_per_connection_and_address():
+    limiter = Limiter(message_rate=0.0, message_burst=2, ip_message_rate=0.0, ip_message_burst=3)
+    first, second = limiter.connection_bucket(), limiter.connection_bucket()
+    assert limiter.allow_message(first, '10.0.0.1')
+    assert limiter.allow_message(first, '10.0.0.1')
+    assert not limiter.allow_message(first, '10.0.0.1')
+    # A second connection from the same address only has what is left of the address's burst
+    assert limiter.allow_message(second, '10.0.0.1')
+    assert not limiter.allow_message(second, '10.0.0.1')
+    assert limiter.allow_message(limiter.connection_bucket(), '10.0.0.2')
+
+
+def test_client_ip_behind_a_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(limits, 'limiter', Limiter(trusted_proxies=('127.0.0.1', '10.0.0.9')))
+    assert client_ip(FakeWebSocket('203.0.113.5', '198.51.100.1')) == '203.0.113.5'
+    assert client_ip(FakeWebSocket('127.0.0.1', '198.51.100.1, 10.0.0.9')) == '198.51.100.1'
+    assert client_ip(FakeWebSocket('127.0.0.1')) == '127.0.0.1'
@@ -0,0 +1,21 @@
+import asyncio
+
+from connections import WHO_PAGE_SIZE, presence
+from contexts.c_lobby import CLobby
+from test_sessions import FakeWriter
+
+
+def test_who_past_the_last_page_shows_the_last_page():
+    writer = FakeWriter()
+    names = [f'player{i:03}' for i in range(WHO_PAGE_SIZE + 1)]
+    for name in names:
+        presence.add(name, FakeWriter())
+    try:
+        lobby = CLobby(writer, None, False, {}, None, 'player000')
+        asyncio.run(lobby.list_connected_users('player 5'))
+    finally:
+        for name in names:
+            presence.remove(name)
+    lines = writer.sent[-1].split('\n')
+    assert lines[0] == f"Connected users (page 2/2, {WHO_PAGE_SIZE + 1} total):"
+    assert lines[1].startswith(names[-1])
@@ -0,0 +1,16 @@
+import logging
+
+import logs
+from settings import load_settings
+from test_server import write_config
+
+
+def test_stop_logging_flushes_and_closes_the_file(tmp_path):
+    log_settings = load_settings(write_config(tmp_path)).logging
+    logs.setup_logging(log_settings)
+    stream = logs._writer.stream
+    logging.getLogger('test').warning("last words")
+
+    logs.stop_logging()
+    assert stream.closed
+    assert "last words" in (tmp_path / 'server.log').read_text()
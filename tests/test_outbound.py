@@ -0,0 +1,103 @@
+import asyncio
+
+from outbound import SessionWriter
+
+
+class FakeWebSocket:
+    # The string API only, so the writer sends through send()
+    def __init__(self, fail=False):
+        self.frames = []
+        self.failed = None
+        self.fail = fail
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def send(self, message):
+        if self.fail:
+            raise RuntimeError("broken")
+        await self.released.wait()
+        self.frames.append(message)
+
+    def fail_connection(self, code, reason):
+        self.failed = (code, reason)
+
+
+def test_messages_queued_together_share_a_frame():
+    async def run():
+        websocket = FakeWebSocket()
+        writer = SessionWriter(websocket)
+        for i in range(3):
+            writer.send_nowait(f'line {i}')
+        await writer.send_encoded(b'screen')
+        writer.send_nowait('after')
+        writer.start()
+        await writer.flush()
+        await writer.stop()
+        return websocket.frames, writer.stats()
+
+    frames, stats = asyncio.run(run())
+    assert frames == ['line 0\nline 1\nline 2', 'screen', 'after']
+    assert stats['messages'] == 5
+    assert stats['frames'] == 3
+
+
+def test_drop_policy_drops_when_the_queue_is_full():
+    async def run():
+        websocket = FakeWebSocket()
+        writer = SessionWriter(websocket, max_queue=2, policy='drop')
+        results = [writer.send_nowait(f'line {i}') for i in range(3)]
+        return results, writer.stats(), websocket.failed
+
+    results, stats, failed = asyncio.run(run())
+    assert results == [True, True, False]
+    assert stats['dropped'] == 1
+    assert failed is None
+
+
+def test_disconnect_policy_fails_the_connection():
+    async def run():
+        websocket = FakeWebSocket()
+        writer = SessionWriter(websocket, max_queue=2, policy='disconnect')
+        results = [writer.send_nowait(f'line {i}') for i in range(3)]
+        return results, writer.closed, websocket.failed
+
+    results, closed, failed = asyncio.run(run())
+    assert results == [True, True, False]
+    assert closed
+    assert failed == (1008, "Not reading fast enough.")
+
+
+def test_block_policy_waits_for_room():
+    async def run():
+        websocket = FakeWebSocket()
+        websocket.released.clear()
+        writer = SessionWriter(websocket, max_queue=1, policy='block', coalesce=False).start()
+        await writer.send('first')
+        await asyncio.sleep(0)  # The writer takes it and waits on the socket
+        await writer.send('second')
+        third = asyncio.create_task(writer.send('third'))
+        await asyncio.sleep(0.01)
+        waiting = not third.done()
+        websocket.released.set()
+        await third
+        await writer.flush()
+        await writer.stop()
+        return waiting, websocket.frames, writer.stats()
+
+    waiting, frames, stats = asyncio.run(run())
+    assert waiting
+    assert frames == ['first', 'second', 'third']
+    assert stats['dropped'] == 0
+
+
+def test_writer_error_fails_the_connection():
+    async def run():
+        websocket = FakeWebSocket(fail=True)
+        writer = SessionWriter(websocket, session_id='s1').start()
+        writer.send_nowait('hello')
+        await asyncio.sleep(0.01)
+        return writer.closed, websocket.failed
+
+    closed, failed = asyncio.run(run())
+    assert closed
+    assert failed == (1011, "Internal error.")
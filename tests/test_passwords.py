@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from passwords import HasherBusy, PasswordHasher
+
+
+def test_hash_and_verify():
+    async def run():
+        hasher = PasswordHasher(rounds=4)
+        try:
+            hashed = await hasher.hash('secret')
+            return hashed, await hasher.verify('secret', hashed), await hasher.verify('wrong', hashed)
+        finally:
+            hasher.close()
+
+    hashed, right, wrong = asyncio.run(run())
+    assert hashed.startswith('$2b$04$')
+    assert right and not wrong
+
+
+def test_needs_rehash_when_the_cost_differs():
+    hasher = PasswordHasher(rounds=12)
+    assert not hasher.needs_rehash('$2b$12$' + 'x' * 53)
+    assert hasher.needs_rehash('$2b$10$' + 'x' * 53)
+    assert hasher.needs_rehash('not a bcrypt hash')
+    hasher.close()
+
+
+def test_full_queue_is_rejected():
+    async def run():
+        hasher = PasswordHasher(workers=1, max_queue=0, rounds=4)
+        try:
+            running = asyncio.create_task(hasher.hash('first'))
+            await asyncio.sleep(0)
+            with pytest.raises(HasherBusy):
+                await hasher.hash('second')
+            await running
+            return hasher.stats()
+        finally:
+            hasher.close()
+
+    stats = asyncio.run(run())
+    assert stats['rejected'] == 1
+    assert stats['completed'] == 1
+    assert stats['pending'] == 0
+
+
+def test_failed_hash_is_counted_as_failed():
+    async def run():
+        hasher = PasswordHasher(rounds=4)
+        try:
+            with pytest.raises(ValueError):
+                await hasher.verify('secret', 'not a bcrypt hash')
+            return hasher.stats()
+        finally:
+            hasher.close()
+
+    stats = asyncio.run(run())
+    assert stats['failed'] == 1
+    assert stats['completed'] == 0
@@ -0,0 +1,67 @@
+import asyncio
+
+import websockets
+
+import server_auth
+from settings import load_settings
+
+CONFIG = """[Settings]
+Registration = True
+MOTD = True
+
+[Messages]
+motd_file = {directory}/motd.txt
+
+[Database]
+backend = sqlite
+database = {directory}/uuu.db
+
+[Passwords]
+bcrypt_rounds = 4
+
+[SSL]
+certfile =
+keyfile =
+
+[Server]
+host = 127.0.0.1
+port = 0
+
+[Compression]
+# Every message goes through permessage-deflate
+min_size = 0
+
+[Logging]
+file = {directory}/server.log
+"""
+
+
+def write_config(directory, extra=''):
+    (directory / 'motd.txt').write_text("Welcome to the test server.")
+    path = directory / 'config.ini'
+    path.write_text(CONFIG.format(directory=directory) + extra)
+    return str(path)
+
+
+def test_serve_accepts_a_session(tmp_path):
+    settings = load_settings(write_config(tmp_path))
+
+    async def run():
+        await server_auth.init_services(settings)
+        server = await server_auth.serve(server_auth.server_handler, '127.0.0.1', 0,
+                                         **server_auth.serve_options(settings))
+        try:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f'ws://127.0.0.1:{port}') as websocket:
+                greeting = await asyncio.wait_for(websocket.recv(), 5)
+                await websocket.send('register')
+                prompt = await asyncio.wait_for(websocket.recv(), 5)
+        finally:
+            server.close()
+            await server.wait_closed()
+            await server_auth.close_db_pool()
+        return greeting, prompt
+
+    greeting, prompt = asyncio.run(run())
+    assert 'login' in greeting
+    assert 'email' in prompt.lower()
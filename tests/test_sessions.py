@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import sessions
+from connections import presence
+from login import AuthFlow
+from sessions import ResumeTokens
+
+
+class FakeWriter:
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000, reason=''):
+        self.closed = (code, reason)
+
+
+def test_resume_after_session_longer_than_ttl(monkeypatch):
+    tokens = ResumeTokens(secret='test', ttl=60)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    token = tokens.issue('alice', 'c_lobby')
+
+    # Connected for ten times the TTL, then dropped
+    now += 600
+    tokens.release('alice', 'c_messages')
+    now += 30
+    assert tokens.resume(token) == ('alice', 'c_messages')
+
+
+def test_token_expires_ttl_after_disconnect(monkeypatch):
+    tokens = ResumeTokens(secret='test', ttl=60)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    token = tokens.issue('alice')
+    tokens.release('alice', 'c_lobby')
+
+    now += 61
+    assert tokens.resume(token) is None
+
+
+def test_token_is_single_use_and_signed():
+    tokens = ResumeTokens(secret='test', ttl=60)
+    token = tokens.issue('alice')
+    token_id, signature = token.split('.')
+    assert tokens.resume(f"{token_id}.{signature[::-1]}") is None
+    assert tokens.resume(token) == ('alice', None)
+    assert tokens.resume(token) is None
+
+
+def test_resume_closes_the_session_still_connected(monkeypatch):
+    tokens = ResumeTokens(secret='test', ttl=60)
+    monkeypatch.setattr(sessions, 'resume_tokens', tokens)
+    token = tokens.issue('alice', 'c_lobby')
+    old, new = FakeWriter(), FakeWriter()
+    presence.add('alice', old)
+    logins = []
+
+    async def on_login(username, context=None):
+        logins.append((username, context))
+
+    try:
+        asyncio.run(AuthFlow(new, False, on_login, step_timeout=1).resume(token))
+        assert old.closed == (1000, "Resumed elsewhere.")
+        assert presence.get('alice').websocket is new
+        assert logins == [('alice', 'c_lobby')]
+    finally:
+        presence.remove('alice')
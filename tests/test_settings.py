@@ -0,0 +1,27 @@
+import asyncio
+import os
+
+import settings
+from test_server import write_config
+
+
+def test_watcher_tries_a_broken_edit_once(tmp_path, monkeypatch):
+    path = write_config(tmp_path)
+    settings.load_settings(path)
+    attempts = []
+    reload_settings = settings.reload_settings
+    monkeypatch.setattr(settings, 'reload_settings', lambda: attempts.append(1) or reload_settings())
+
+    with open(path, 'a') as file:
+        file.write("[Server]\nport = not a number\n")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    async def watch():
+        watcher = asyncio.create_task(settings.watch_settings(interval=0.01))
+        await asyncio.sleep(0.2)
+        watcher.cancel()
+
+    asyncio.run(watch())
+    assert len(attempts) == 1
+    assert settings.get_settings().path == path
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import database
+from mailboxes import MySQLMessageStore, SQLiteMessageStore
+from settings import DatabaseSettings
+from users import MySQLUserStore, SQLiteUserStore
+
+
+def with_sqlite_pool(tmp_path, test):
+    async def run():
+        await database.init_db_pool(DatabaseSettings(host='', user='', password='', backend='sqlite',
+                                                     database=str(tmp_path / 'test.db')))
+        try:
+            return await test()
+        finally:
+            await database.close_db_pool()
+
+    return asyncio.run(run())
+
+
+def test_sqlite_user_store(tmp_path):
+    store = SQLiteUserStore()
+
+    async def test():
+        assert not await store.username_exists('alice')
+        await store.create_user('alice@example.com', 'alice', 'hash1')
+        await store.update_password('alice', 'hash2')
+        return (await store.username_exists('alice'), await store.email_exists('alice@example.com'),
+                await store.get_password_hash('alice'), await store.get_password_hash('bob'))
+
+    assert with_sqlite_pool(tmp_path, test) == (True, True, 'hash2', None)
+
+
+def test_duplicate_user_is_a_query_error(tmp_path):
+    store = SQLiteUserStore()
+
+    async def test():
+        await store.create_user('alice@example.com', 'alice', 'hash')
+        with pytest.raises(database.QueryError):
+            await store.create_user('other@example.com', 'alice', 'hash')
+
+    with_sqlite_pool(tmp_path, test)
+
+
+def test_configured_queries_must_match_the_backend():
+    with pytest.raises(ValueError, match='uses %s'):
+        SQLiteUserStore({'user_check_query': "SELECT password FROM users WHERE username = %s"})
+    with pytest.raises(ValueError, match='placeholder'):
+        SQLiteUserStore({'insert_user_query': "INSERT INTO users (email, username, password) VALUES (?, ?, 'x')"})
+    with pytest.raises(ValueError, match='placeholder'):
+        MySQLUserStore({'user_check_query': "SELECT password FROM users WHERE username = ?"})
+    # A literal percent sign is not a placeholder
+    MySQLUserStore({'user_check_query': "SELECT password FROM users WHERE username = %s AND email LIKE '%%@%%'"})
+
+
+def test_sqlite_message_store_trims_and_pages(tmp_path):
+    store = SQLiteMessageStore()
+
+    async def test():
+        ids = [await store.add('bob', 'alice', f'message {i}', mailbox_size=3) for i in range(5)]
+        await store.mark_delivered(ids[-1])
+        unread = await store.count_unread('alice')
+        first_page = await store.fetch('alice', 1, 2)
+        second_page = await store.fetch('alice', 2, 2)
+        await store.mark_read('alice', [row[0] for row in first_page])
+        return unread, first_page, second_page, await store.count_unread('alice')
+
+    unread, first_page, second_page, unread_after = with_sqlite_pool(tmp_path, test)
+    assert unread == 2
+    assert [row[2] for row in first_page] == ['message 4', 'message 3']
+    assert [row[2] for row in second_page] == ['message 2']
+    assert unread_after == 1
+
+
+def test_message_stores_use_their_backends_placeholders():
+    for store, placeholder in ((MySQLMessageStore, '%s'), (SQLiteMessageStore, '?')):
+        other = '?' if placeholder == '%s' else '%s'
+        assert all(other not in query for query in store.queries.values())
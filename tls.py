@@ -0,0 +1,55 @@
+import ssl
+
+TLS_VERSIONS = {
+    '1.2': ssl.TLSVersion.TLSv1_2,
+    '1.3': ssl.TLSVersion.TLSv1_3,
+}
+
+
+def create_ssl_context(ssl_settings):
+    # The server's TLS context, or None when TLS is terminated by a local proxy and the server speaks plain ws://
+    if ssl_settings.plaintext:
+        return None
+    if ssl_settings.min_version not in TLS_VERSIONS:
+        raise ValueError(f"Unsupported TLS version: {ssl_settings.min_version}")
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(ssl_settings.certfile, ssl_settings.keyfile)
+    context.minimum_version = TLS_VERSIONS[ssl_settings.min_version]
+    # Only used below TLS 1.3, whose suites all use ephemeral (EC)DHE key exchange anyway
+    context.set_ciphers(ssl_settings.ciphers)
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_NO_RENEGOTIATION | ssl.OP_CIPHER_SERVER_PREFERENCE
+
+    # A returning client resumes with a ticket instead of a full handshake: no certificate signature, no key
+    # agreement with the certificate. Tickets are stateless, so they work on any worker holding the same ticket key;
+    # without them, resumption falls back to this process's own session cache
+    if not ssl_settings.session_tickets:
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+
+# Shared context used by every connection. Created once by the server at startup; workers forked from the master
+# inherit it, and with it the session ticket key, so a ticket from one worker resumes on another
+tls_context = None
+
+
+def init_tls(ssl_settings):
+    global tls_context
+    tls_context = create_ssl_context(ssl_settings)
+    return tls_context
+
+
+def tls_stats():
+    # Handshake counts from OpenSSL; a hit is a resumed session, whether from a ticket or the session cache
+    if tls_context is None:
+        return None
+    stats = tls_context.session_stats()
+    handshakes = stats['accept_good']
+    return {
+        'handshakes': handshakes,
+        'full': handshakes - stats['hits'],
+        'resumed': stats['hits'],
+        'failed': stats['accept'] - handshakes,
+        'resumption_rate': stats['hits'] / handshakes if handshakes else 0.0,
+        'cache_size': stats['number'],
+    }
@@ -0,0 +1,183 @@
+import time
+from collections import OrderedDict
+
+from database import get_db_pool
+
+# The parameters each users-table query is run with, in order
+QUERY_PARAMETERS = {
+    'user_check_query': ('username',),
+    'username_check_query': ('username',),
+    'email_check_query': ('email',),
+    'insert_user_query': ('email', 'username', 'password'),
+    'update_password_query': ('password', 'username'),
+}
+
+
+class LookupCache:
+    # Short-lived cache of yes/no answers; "doesn't exist" answers get their own (shorter) TTL
+    def __init__(self, ttl=30.0, negative_ttl=5.0, max_entries=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (exists, expires_at), oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, key, exists):
+        ttl = self.ttl if exists else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (exists, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UserStore:
+    # Every users-table query in one place, run as prepared statements. Each backend's subclass holds its own SQL,
+    # written with that backend's placeholder; [DatabaseQueries] in config.ini can replace any of it
+    backend = None
+    placeholder = None
+    default_queries = {}
+
+    def __init__(self, queries=None, cache_ttl=30.0, negative_cache_ttl=5.0, cache_size=10000):
+        self.queries = {**self.default_queries, **self.check_queries(queries or {})}
+        self.usernames = LookupCache(cache_ttl, negative_cache_ttl, cache_size)
+        self.emails = LookupCache(cache_ttl, negative_cache_ttl, cache_size)
+
+    @classmethod
+    def count_placeholders(cls, query):
+        return query.count(cls.placeholder)
+
+    @classmethod
+    def check_queries(cls, queries):
+        # A configured query must take its parameters in this backend's placeholder style, or it would fail (or
+        # bind the wrong values) on first use rather than at startup
+        for name, query in queries.items():
+            parameters = QUERY_PARAMETERS.get(name)
+            if parameters is None:
+                continue
+            if cls.count_placeholders(query) != len(parameters):
+                raise ValueError(f"[DatabaseQueries] {name} must take {len(parameters)} {cls.placeholder} "
+                                 f"placeholder(s) for the {cls.backend} backend ({', '.join(parameters)}): {query}")
+        return queries
+
+    async def _fetchone(self, query_name, params):
+        async with get_db_pool().acquire() as connection:
+            return await connection.fetchone(self.queries[query_name], params, prepared=True)
+
+    async def _execute(self, query_name, params):
+        async with get_db_pool().acquire() as connection:
+            await connection.execute(self.queries[query_name], params, prepared=True)
+            await connection.commit()
+
+    async def get_password_hash(self, username):
+        row = await self._fetchone('user_check_query', (username,))
+        return row[0] if row is not None else None
+
+    async def username_exists(self, username):
+        exists = self.usernames.get(username)
+        if exists is None:
+            exists = await self._fetchone('username_check_query', (username,)) is not None
+            self.usernames.set(username, exists)
+        return exists
+
+    async def email_exists(self, email):
+        exists = self.emails.get(email)
+        if exists is None:
+            exists = await self._fetchone('email_check_query', (email,)) is not None
+            self.emails.set(email, exists)
+        return exists
+
+    async def create_user(self, email, username, hashed_password):
+        try:
+            await self._execute('insert_user_query', (email, username, hashed_password))
+        finally:
+            self.usernames.invalidate(username)
+            self.emails.invalidate(email)
+
+    async def update_password(self, username, hashed_password):
+        try:
+            await self._execute('update_password_query', (hashed_password, username))
+        finally:
+            self.usernames.invalidate(username)
+
+    def stats(self):
+        return {'usernames': self.usernames.stats(), 'emails': self.emails.stats()}
+
+
+class MySQLUserStore(UserStore):
+    backend = 'mysql'
+    placeholder = '%s'
+    default_queries = {
+        'user_check_query': "SELECT password FROM users WHERE username = %s",
+        'username_check_query': "SELECT username FROM users WHERE username = %s",
+        'email_check_query': "SELECT email FROM users WHERE email = %s",
+        'insert_user_query': "INSERT INTO users (email, username, password) VALUES (%s, %s, %s)",
+        'update_password_query': "UPDATE users SET password = %s WHERE username = %s",
+    }
+
+    @classmethod
+    def count_placeholders(cls, query):
+        # A literal percent sign is written %%
+        return query.replace('%%', '').count('%s')
+
+
+class SQLiteUserStore(UserStore):
+    backend = 'sqlite'
+    placeholder = '?'
+    default_queries = {
+        'user_check_query': "SELECT password FROM users WHERE username = ?",
+        'username_check_query': "SELECT username FROM users WHERE username = ?",
+        'email_check_query': "SELECT email FROM users WHERE email = ?",
+        'insert_user_query': "INSERT INTO users (email, username, password) VALUES (?, ?, ?)",
+        'update_password_query': "UPDATE users SET password = ? WHERE username = ?",
+    }
+
+    @classmethod
+    def check_queries(cls, queries):
+        for name, query in queries.items():
+            if '%s' in query:
+                raise ValueError(f"[DatabaseQueries] {name} uses %s, which the sqlite backend doesn't replace; "
+                                 f"write its placeholders as ?: {query}")
+        return super().check_queries(queries)
+
+
+USER_STORES = {store.backend: store for store in (MySQLUserStore, SQLiteUserStore)}
+
+# Shared store used by login and every context, created once by the server at startup
+user_store = None
+
+
+def init_user_store(backend=None, **kwargs):
+    # The backend defaults to the one the shared pool was opened with
+    global user_store
+    user_store = USER_STORES[backend or get_db_pool().backend.name](**kwargs)
+    return user_store
+
+
+def get_user_store():
+    global user_store
+    if user_store is None:
+        user_store = init_user_store()
+    return user_store